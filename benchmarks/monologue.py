@@ -0,0 +1,251 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Replay synthetic event streams through the monologue detection handlers.
+
+The bot runs against a stub client and a stub source, so no homeserver or network access is
+needed. Run from the repository root, e.g.::
+
+    python -m benchmarks.monologue --rooms 10000 --users-per-room 5 --events 200000
+"""
+from __future__ import annotations
+
+from typing import Any, Iterator, NamedTuple
+from types import SimpleNamespace
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import time
+import tracemalloc
+
+from mautrix.types import (ContentURI, EventType, ImageInfo, MessageType, RoomID,
+                           TextMessageEventContent, UserID)
+
+from disruptor.bot import DisruptorBot
+from disruptor.metrics import Metrics
+from disruptor.ratelimit import Limit, MemoryBackend, RateLimiter
+from disruptor.sendqueue import SendQueue
+from disruptor.source import AbstractSource, DisruptionContext
+from disruptor.source.abstract import Image
+from disruptor.state import IdleEvictingDict, MonologueInfo
+
+BOT_MXID = UserID("@disruptor:example.com")
+
+
+class StubClient:
+    mxid: UserID
+    latency: float
+    sent: int
+
+    def __init__(self, latency: float) -> None:
+        self.mxid = BOT_MXID
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message_event(self, room_id: RoomID, event_type: EventType, content: Any
+                                 ) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+class StubSource(AbstractSource):
+    type_name = "benchmark_stub"
+    latency: float
+
+    async def fetch(self) -> Image:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return Image(title="cat.jpg", url=ContentURI("mxc://example.com/cat"),
+                     info=ImageInfo(mimetype="image/jpeg", size=1024, width=64, height=64),
+                     external_url=None)
+
+    async def fetch_with_context(self, ctx: DisruptionContext) -> Image:
+        return await self.fetch()
+
+
+class StubEvent:
+    __slots__ = ("sender", "room_id", "content", "client", "replies")
+
+    def __init__(self, sender: UserID, room_id: RoomID, body: str, client: StubClient) -> None:
+        self.sender = sender
+        self.room_id = room_id
+        self.content = TextMessageEventContent(msgtype=MessageType.TEXT, body=body)
+        self.client = client
+
+    async def reply(self, text: str) -> None:
+        await self.client.send_message_event(self.room_id, EventType.ROOM_MESSAGE, text)
+
+
+class SyntheticEvent(NamedTuple):
+    kind: str
+    room_id: RoomID
+    sender: UserID
+
+
+def make_bot(args: argparse.Namespace) -> tuple[DisruptorBot, StubClient]:
+    # Mirrors the in-memory state set up by DisruptorBot.start() without the parts that need
+    # a running maubot instance (config file, database, web server).
+    bot = DisruptorBot.__new__(DisruptorBot)
+    client = StubClient(args.send_latency)
+    config = {
+        "min_monologue_size": args.min_monologue_size,
+        "max_monologue_delay": 300,
+        "disrupt_cooldown": 10,
+        "user_ratelimit.message": "user ratelimited",
+        "room_ratelimit.message": "room ratelimited",
+        "disruption.deadline": args.deadline,
+        "disruption.hedge_after": 0,
+    }
+    bot.client = client
+    bot.config = config
+    bot.log = logging.getLogger("benchmark.disruptor")
+    bot.metrics = Metrics()
+    bot.media_index = None
+    bot.history = None
+    bot.monologue_size = IdleEvictingDict(MonologueInfo, ttl=300)
+    bot.user_limit = Limit(name="user", rate=3, per=3600)
+    bot.room_limit = Limit(name="room", rate=3, per=86400)
+    bot.ratelimiter = RateLimiter(MemoryBackend())
+    bot.source_generation = 0
+    source = StubSource(bot, {})
+    source.latency = args.fetch_latency
+    bot.source = source
+    bot.fallback_source = None
+    bot.send_queue = SendQueue(bot._send_disruption, bot.log.getChild("send_queue"),
+                               concurrency=args.send_concurrency, max_age=args.deadline or 60)
+    bot.send_queue.start()
+    return bot, client
+
+
+def generate_events(args: argparse.Namespace) -> Iterator[SyntheticEvent]:
+    rng = random.Random(args.seed)
+    rooms = [RoomID(f"!room{i}:example.com") for i in range(args.rooms)]
+    users = {room_id: [UserID(f"@user{i}_{j}:example.com") for j in range(args.users_per_room)]
+             for i, room_id in enumerate(rooms)}
+    speaker: dict[RoomID, UserID] = {}
+    for _ in range(args.events):
+        room_id = rng.choice(rooms)
+        # Keep the same speaker with the given probability to produce monologues
+        if room_id not in speaker or rng.random() > args.monologue_probability:
+            speaker[room_id] = rng.choice(users[room_id])
+        if rng.random() < args.cat_ratio:
+            yield SyntheticEvent("cat", room_id, speaker[room_id])
+        elif rng.random() < args.encrypted_ratio:
+            yield SyntheticEvent("encrypted", room_id, speaker[room_id])
+        else:
+            yield SyntheticEvent("message", room_id, speaker[room_id])
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    bot, client = make_bot(args)
+    events = list(generate_events(args))
+    latencies: list[float] = []
+    contended: dict[RoomID, int] = {}
+
+    async def handle(evt: SyntheticEvent) -> None:
+        info = bot.monologue_size.get(evt.room_id)
+        if info is not None and info.lock.locked():
+            contended[evt.room_id] = contended.get(evt.room_id, 0) + 1
+        start = time.perf_counter()
+        if evt.kind == "cat":
+            await bot.cat_command(StubEvent(evt.sender, evt.room_id, "\U0001f408", client))
+        elif evt.kind == "encrypted":
+            content = SimpleNamespace(relates_to=SimpleNamespace(rel_type=None))
+            await bot.encrypted_monologue_detector(SimpleNamespace(
+                sender=evt.sender, room_id=evt.room_id, content=content))
+        else:
+            await bot.normal_monologue_detector(StubEvent(evt.sender, evt.room_id, "hello",
+                                                          client))
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for i in range(0, len(events), args.burst):
+        await asyncio.gather(*(handle(evt) for evt in events[i:i + args.burst]))
+    # Disruptions are sent in the background, wait for the queue to drain
+    while not bot.send_queue.idle:
+        await asyncio.sleep(0.001)
+    duration = time.perf_counter() - start
+    await bot.send_queue.stop()
+    mem_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracked_rooms = len(bot.monologue_size)
+    return {
+        "events": len(events),
+        "duration_s": duration,
+        "events_per_s": len(events) / duration if duration else 0,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "latency_mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0,
+        "disruptions_sent": client.sent,
+        "tracked_rooms": tracked_rooms,
+        "contended_events": sum(contended.values()),
+        "contended_rooms": len(contended),
+        "max_contention_per_room": max(contended.values(), default=0),
+        # Includes the latency samples and other harness allocations, so it's an upper bound
+        "memory_per_room_bytes": (mem_after - mem_before) / tracked_rooms if tracked_rooms else 0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--users-per-room", type=int, default=5)
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--burst", type=int, default=50,
+                        help="number of events dispatched concurrently")
+    parser.add_argument("--monologue-probability", type=float, default=0.8,
+                        help="probability that the next message in a room is by the same user")
+    parser.add_argument("--min-monologue-size", type=int, default=10)
+    parser.add_argument("--cat-ratio", type=float, default=0.01,
+                        help="fraction of events that are manual cat requests")
+    parser.add_argument("--encrypted-ratio", type=float, default=0.5,
+                        help="fraction of non-cat events that are encrypted")
+    parser.add_argument("--fetch-latency", type=float, default=0.0,
+                        help="simulated source fetch latency in seconds")
+    parser.add_argument("--send-latency", type=float, default=0.0,
+                        help="simulated message send latency in seconds")
+    parser.add_argument("--send-concurrency", type=int, default=4,
+                        help="maximum number of disruptions sent at the same time")
+    parser.add_argument("--deadline", type=float, default=15,
+                        help="disruption deadline in seconds (0 for no limit)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="output results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print(f"{key:>26}: {value:.3f}" if isinstance(value, float)
+                  else f"{key:>26}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,30 +13,36 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Type, Tuple, Optional
-from collections import defaultdict
-from time import time
+from typing import Type, Tuple, Optional, Dict, Any
 import asyncio
+import time
 
-from attr import dataclass
 import magic
 
+from mautrix.util.async_db import UpgradeTable
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from mautrix.types import (EventType, UserID, RoomID, MediaMessageEventContent, ContentURI,
                            MessageType, EncryptedEvent, BaseMessageEventContent, RelationType,
                            EncryptedMegolmEventContent)
 
-from maubot import Plugin, MessageEvent
-from maubot.handlers import event, command
-
-from .source import AbstractSource, CancelDisruption, DisruptionContext
+from aiohttp.web import Request, Response
 
-try:
-    from PIL import Image
-    from io import BytesIO
-except ImportError:
-    Image = None
-    BytesIO = None
+from maubot import Plugin, MessageEvent
+from maubot.handlers import event, command, web
+
+from .source import (AbstractSource, CancelDisruption, SourceUnavailable, DisruptionContext,
+                     Readiness)
+from .source.abstract import Image, MediaTooLarge, SNIFF_SIZE, CHUNK_SIZE
+from .db import DBManager, upgrade_table
+from .dedup import MediaIndex
+from .history import ImageHistory
+from .metrics import Metrics
+from .state import IdleEvictingDict, MonologueInfo
+from .ratelimit import RateLimiter, Limit, MemoryBackend, DatabaseBackend
+from .workers import WorkerPool, LoopLagMonitor
+from .http import HTTPClient
+from .tasks import TaskCoordinator, BreakerState
+from .sendqueue import SendQueue, QueuedSend
 
 
 class Config(BaseProxyConfig):
@@ -52,95 +58,204 @@ class Config(BaseProxyConfig):
         helper.copy("room_ratelimit.rate")
         helper.copy("room_ratelimit.per")
         helper.copy("room_ratelimit.message")
-
-
-class MonologueInfo:
-    user_id: Optional[UserID]
-    streak: int
-    last_message: float
-    prev_disrupt: float
-    lock: asyncio.Lock
-
-    def __init__(self, user_id: Optional[UserID] = None, streak: int = 0, last_message: float = 0,
-                 prev_disrupt: float = 0) -> None:
-        self.user_id = user_id
-        self.streak = streak
-        self.last_message = last_message
-        self.prev_disrupt = prev_disrupt
-        self.lock = asyncio.Lock()
-
-    def message(self, user_id: UserID) -> None:
-        if self.user_id == user_id:
-            self.streak += 1
-        else:
-            self.user_id = user_id
-            self.streak = 1
-        self.last_message = time()
-
-    def reset(self) -> None:
-        self.user_id = None
-        self.streak = 0
-
-    def is_outdated(self, max_delay: int) -> bool:
-        return self.last_message != 0 and self.last_message + max_delay < time()
-
-    def should_disrupt(self, min_count: int, disrupt_cooldown: int) -> bool:
-        return self.streak >= min_count and self.prev_disrupt + disrupt_cooldown < time()
-
-    def __repr__(self) -> str:
-        return str(self)
-
-    def __str__(self) -> str:
-        return (f"MonologueInfo(user_id={self.user_id}, streak={self.streak}, "
-                f"last_message={self.last_message}, prev_disrupt={self.prev_disrupt})")
-
-
-@dataclass
-class ManualRateLimit:
-    rate: float = 3.0
-    per: float = 3600.0
-    allowance: float = 0.0
-    last_request: float = 0.0
-
-    def __attrs_post_init__(self) -> None:
-        self.allowance = self.rate
-
-    def request(self) -> bool:
-        now = time()
-        time_passed = now - self.last_request
-        self.last_request = now
-        self.allowance += time_passed * (self.rate / self.per)
-        if self.allowance > self.rate:
-            self.allowance = self.rate
-        if self.allowance < 1.0:
-            return False
-        else:
-            self.allowance -= 1.0
-            return True
+        helper.copy("ratelimit_storage.type")
+        helper.copy("ratelimit_storage.flush_interval")
+        helper.copy("media_dedup.enabled")
+        helper.copy("media_dedup.size")
+        helper.copy("media_dedup.persist")
+        helper.copy("history.enabled")
+        helper.copy("history.size")
+        helper.copy("history.min_reuse_interval")
+        helper.copy("disruption.deadline")
+        helper.copy("disruption.hedge_after")
+        helper.copy("disruption.fallback_source")
+        helper.copy("workers.type")
+        helper.copy("workers.max_workers")
+        helper.copy("workers.queue_size")
+        helper.copy("workers.lag_interval")
+        helper.copy("send_queue.concurrency")
+        helper.copy("send_queue.per_room")
+        helper.copy("send_queue.max_age")
+        helper.copy("send_queue.retry_backoff")
+        helper.copy("send_queue.max_retry_backoff")
+        helper.copy("background.max_tasks")
+        helper.copy("background.breaker_threshold")
+        helper.copy("background.breaker_backoff")
+        helper.copy("background.breaker_max_backoff")
 
 
 class DisruptorBot(Plugin):
-    monologue_size: Dict[RoomID, MonologueInfo]
-    manual_room_ratelimits: Dict[RoomID, ManualRateLimit]
-    manual_user_ratelimits: Dict[UserID, ManualRateLimit]
+    monologue_size: IdleEvictingDict[RoomID, MonologueInfo]
+    ratelimiter: RateLimiter
+    user_limit: Limit
+    room_limit: Limit
     source: AbstractSource
+    fallback_source: Optional[AbstractSource]
     reload_lock: asyncio.Lock
+    reusable_sources: Dict[Tuple[str, str], AbstractSource]
+    source_generation: int
+    db: DBManager
+    media_index: Optional[MediaIndex]
+    history: Optional[ImageHistory]
+    metrics: Metrics
+    workers: WorkerPool
+    http_client: HTTPClient
+    lag_monitor: LoopLagMonitor
+    tasks: TaskCoordinator
+    send_queue: SendQueue
 
     async def start(self):
         await super().start()
         self.config.load_and_update()
-
-        self.monologue_size = defaultdict(lambda: MonologueInfo())
-        self.manual_room_ratelimits = defaultdict(lambda: ManualRateLimit(
-            rate=float(self.config["room_ratelimit.rate"]),
-            per=float(self.config["room_ratelimit.per"])))
-        self.manual_user_ratelimits = defaultdict(lambda: ManualRateLimit(
-            rate=float(self.config["user_ratelimit.rate"]),
-            per=float(self.config["user_ratelimit.per"])))
+        self.db = DBManager(self.database)
+        self.metrics = Metrics()
+        self.http_client = HTTPClient(self.http, None, self.log.getChild("http"))
+        self.workers = WorkerPool(self.metrics, kind=self.config["workers.type"],
+                                  max_workers=self.config["workers.max_workers"],
+                                  queue_size=self.config["workers.queue_size"])
+        self.lag_monitor = LoopLagMonitor(self.metrics, self.log.getChild("loop"),
+                                          interval=self.config["workers.lag_interval"])
+        self.lag_monitor.start()
+        self.tasks = TaskCoordinator(self.log.getChild("tasks"),
+                                     max_tasks=self.config["background.max_tasks"],
+                                     threshold=self.config["background.breaker_threshold"],
+                                     backoff=self.config["background.breaker_backoff"],
+                                     max_backoff=self.config["background.breaker_max_backoff"])
+        self.media_index = None
+        if self.config["media_dedup.enabled"]:
+            self.media_index = MediaIndex(
+                max_size=self.config["media_dedup.size"],
+                db=self.db if self.config["media_dedup.persist"] else None)
+            await self.media_index.load()
+        self.history = None
+        if self.config["history.enabled"]:
+            self.history = ImageHistory(
+                max_size=self.config["history.size"],
+                min_reuse_interval=self.config["history.min_reuse_interval"], db=self.db)
+            await self.history.load()
+
+        self.monologue_size = IdleEvictingDict(MonologueInfo, ttl=0)
+        self._load_limits()
+        if self.config["ratelimit_storage.type"] == "database":
+            flush_interval = self.config["ratelimit_storage.flush_interval"]
+            backend = DatabaseBackend(self.db, self.log.getChild("ratelimit"),
+                                      flush_interval=flush_interval)
+        else:
+            backend = MemoryBackend()
+        self.ratelimiter = RateLimiter(backend)
+        await self.ratelimiter.start()
+        self.send_queue = SendQueue(self._send_disruption, self.log.getChild("send_queue"),
+                                    concurrency=self.config["send_queue.concurrency"],
+                                    per_room=self.config["send_queue.per_room"],
+                                    max_age=self.config["send_queue.max_age"],
+                                    retry_backoff=self.config["send_queue.retry_backoff"],
+                                    max_retry_backoff=self.config["send_queue.max_retry_backoff"])
+        self.send_queue.start()
         self.reload_lock = asyncio.Lock()
-
-        self.source = AbstractSource.create(self, self.config["source"])
-        await self.source.prepare()
+        self.reusable_sources = {}
+        self.source_generation = 0
+
+        self.source = await self._build_source(self.config["source"])
+        self.log.debug(f"Source tree prepared, readiness: {self.source.readiness.value}")
+        self.fallback_source = None
+        if self.config["disruption.fallback_source"]:
+            self.fallback_source = await self._build_source(
+                self.config["disruption.fallback_source"], prefix="fallback")
+
+    def _load_limits(self) -> None:
+        # Entries that have been idle for longer than the TTL behave exactly like new entries,
+        # so they can be evicted to keep memory usage flat in bots that are in lots of rooms.
+        self.monologue_size.ttl = max(self.config["max_monologue_delay"],
+                                      self.config["disrupt_cooldown"])
+        self.user_limit = Limit(name="user", rate=float(self.config["user_ratelimit.rate"]),
+                                per=float(self.config["user_ratelimit.per"]))
+        self.room_limit = Limit(name="room", rate=float(self.config["room_ratelimit.rate"]),
+                                per=float(self.config["room_ratelimit.per"]))
+
+    async def _build_source(self, config: Dict[str, Any], prefix: Optional[str] = None,
+                            old: Optional[AbstractSource] = None) -> AbstractSource:
+        """Create and prepare a source tree.
+
+        If an old tree is given, nodes whose path and config didn't change are moved into the
+        new tree as-is instead of being created again, so they keep their caches. If preparing
+        the tree fails, the nodes that were created for it are stopped before the error is
+        raised.
+        """
+        self.reusable_sources = {(node.path, node.config_hash): node
+                                 for node in old.walk()} if old else {}
+        try:
+            source = AbstractSource.create(self, config)
+            if prefix:
+                source.path = f"{prefix}/{source.path}"
+                source.log = self.log.getChild("source").getChild(prefix)
+            source = self.reusable_sources.get((source.path, source.config_hash), source)
+            try:
+                await source.prepare()
+            except Exception:
+                # New nodes belong to the current generation, so this doesn't stop the reused
+                # nodes, which are still in use by the old tree
+                if source.generation != self.source_generation:
+                    raise
+                try:
+                    await source.stop()
+                except Exception:
+                    self.log.exception(f"Failed to stop partially prepared {source.path}")
+                raise
+        finally:
+            self.reusable_sources = {}
+        for node in source.walk():
+            node.generation = self.source_generation
+        return source
+
+    async def _retire_source(self, old: AbstractSource, new: Optional[AbstractSource]) -> None:
+        kept = set(new.walk()) if new else set()
+        if old in kept:
+            return
+        reused = sum(1 for node in old.walk() if node in kept)
+        self.log.debug(f"Stopping {old.path} after config reload ({reused} nodes reused)")
+        try:
+            # Let disruptions that already started with the old tree finish first
+            await asyncio.sleep(self.config["disruption.deadline"] or 60)
+        finally:
+            # Stop the old tree right away if the plugin is stopped before the delay is over
+            try:
+                await old.stop()
+            except Exception:
+                self.log.exception(f"Failed to stop retired source {old.path}")
+
+    async def on_external_config_update(self) -> None:
+        # Only the limits and source trees are reloaded, the sections that base-config.yaml
+        # documents as needing a restart keep their old values until then.
+        async with self.reload_lock:
+            self.config.load_and_update()
+            self._load_limits()
+            self.source_generation += 1
+            old_source, old_fallback = self.source, self.fallback_source
+            source = await self._build_source(self.config["source"], old=old_source)
+            fallback = None
+            if self.config["disruption.fallback_source"]:
+                fallback = await self._build_source(self.config["disruption.fallback_source"],
+                                                    prefix="fallback", old=old_fallback)
+            # Disruptions that already started keep using the old trees
+            self.source, self.fallback_source = source, fallback
+            self.tasks.spawn(self, self._retire_source(old_source, source), limited=False)
+            if old_fallback:
+                self.tasks.spawn(self, self._retire_source(old_fallback, fallback),
+                                 limited=False)
+            self.log.info(f"Reloaded config, source tree readiness: {source.readiness.value}")
+
+    async def stop(self) -> None:
+        await self.send_queue.stop()
+        # Stops the trees that were replaced by a config reload but haven't been retired yet
+        await self.tasks.cancel(self)
+        await self.source.stop()
+        if self.fallback_source:
+            await self.fallback_source.stop()
+        # Sources cancel their own tasks when stopped, this catches anything left over
+        await self.tasks.stop()
+        await self.ratelimiter.stop()
+        self.lag_monitor.stop()
+        self.workers.shutdown()
 
     @event.on(EventType.ROOM_ENCRYPTED)
     async def encrypted_monologue_detector(self, evt: EncryptedEvent) -> None:
@@ -167,38 +282,166 @@ class DisruptorBot(Plugin):
                 await self.disrupt(user_id, room_id)
                 monologue.reset()
 
-    async def reupload(self, url: str) -> Tuple[ContentURI, str, bytes]:
-        resp = await self.http.get(url, headers={"User-Agent": self.config["user_agent"]})
-        data = await resp.read()
-        mime_type = magic.from_buffer(data, mime=True)
+    async def reupload(self, url: str, max_bytes: Optional[int] = None
+                       ) -> Tuple[ContentURI, str, bytes]:
+        async with self.http_client.get(url, headers={"User-Agent": self.config["user_agent"]}
+                                        ) as resp:
+            if max_bytes and (resp.content_length or 0) > max_bytes:
+                raise MediaTooLarge(resp.url, resp.content_length, max_bytes)
+            data = bytearray()
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                data += chunk
+                if max_bytes and len(data) > max_bytes:
+                    raise MediaTooLarge(resp.url, len(data), max_bytes)
+        data = bytes(data)
+        mime_type = await self.workers.run(magic.from_buffer, data[:SNIFF_SIZE], mime=True)
         mxc = await self.client.upload_media(data, mime_type)
         return mxc, mime_type, data
 
     @command.passive(r"^\U0001f408\ufe0f?$")
     async def cat_command(self, evt: MessageEvent, _: str) -> None:
-        if self.manual_user_ratelimits[evt.sender].request():
-            if self.manual_room_ratelimits[evt.room_id].request():
-                await self.disrupt(evt.sender, evt.room_id)
-            else:
-                await evt.reply(self.config["room_ratelimit.message"])
-                self.manual_user_ratelimits[evt.sender].allowance += 1
+        limited = await self.ratelimiter.check((self.user_limit, evt.sender),
+                                               (self.room_limit, evt.room_id))
+        if limited is None:
+            await self.disrupt(evt.sender, evt.room_id)
         else:
-            await evt.reply(self.config["user_ratelimit.message"])
+            self.metrics.disruptions.inc(outcome="ratelimited")
+            await evt.reply(self.config[f"{limited.name}_ratelimit.message"])
+
+    async def _fetch_hedged(self, ctx: DisruptionContext) -> Image:
+        hedge_after = self.config["disruption.hedge_after"]
+        primary = asyncio.create_task(self.source.fetch_with_context(ctx))
+        pending = {primary}
+        try:
+            if not self.fallback_source or not hedge_after:
+                return await primary
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if done:
+                return primary.result()
+            self.log.debug(f"Primary fetch for {ctx.room_id} is taking more than {hedge_after} "
+                           "seconds, sending hedged request to fallback source")
+            hedge = asyncio.create_task(self.fallback_source.fetch_with_context(ctx))
+            pending.add(hedge)
+            errors = {}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.metrics.hedged_fetches.inc(
+                            winner="primary" if task is primary else "fallback")
+                        return task.result()
+                    errors[task] = task.exception()
+            self.metrics.hedged_fetches.inc(winner="none")
+            raise errors[primary]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _recycle(self, room_id: RoomID) -> Optional[Image]:
+        if not self.history:
+            return None
+        return self.history.pick(room_id)
 
     async def disrupt(self, user_id: UserID, room_id: RoomID) -> None:
         ctx = DisruptionContext(user_id=user_id, room_id=room_id)
+        start = time.monotonic()
+        deadline = self.config["disruption.deadline"] or None
+        send_deadline = deadline
+        outcome = "sent"
+        if self.send_queue.is_pending(room_id):
+            # The disruption that's already waiting is enough
+            self._record_disruption("coalesced", start)
+            return
         try:
-            image = await self.source.fetch_with_context(ctx)
+            image = await asyncio.wait_for(self._fetch_hedged(ctx), timeout=deadline)
+        except asyncio.TimeoutError:
+            image = self._recycle(room_id)
+            if image is None:
+                self.log.warning(f"Dropping disruption in {room_id}: "
+                                 f"fetch didn't finish in {deadline} seconds")
+                self._record_disruption("stale", start)
+                return
+            self.log.debug(f"Fetch didn't finish in {deadline} seconds, "
+                           f"recycling {image.url} in {room_id}")
+            outcome = "recycled"
+            # The fetch used up the deadline, so sending the recycled image gets one of its own
+            send_deadline = time.monotonic() - start + deadline
+        except SourceUnavailable as e:
+            image = self._recycle(room_id)
+            if image is None:
+                self._record_disruption("cancelled", start)
+                return
+            self.log.debug(f"{e}, recycling {image.url} in {room_id}")
+            outcome = "recycled"
         except CancelDisruption:
+            self._record_disruption("cancelled", start)
             return
         except Exception:
-            self.log.exception("Failed to fetch image for disruption")
-            return
+            image = self._recycle(room_id)
+            if image is None:
+                self.log.exception("Failed to fetch image for disruption")
+                self._record_disruption("errored", start)
+                return
+            self.log.warning(f"Failed to fetch image for disruption, recycling {image.url}",
+                             exc_info=True)
+            outcome = "recycled"
         content = MediaMessageEventContent(body=image.title, url=image.url, info=image.info,
                                            msgtype=MessageType.IMAGE,
                                            external_url=image.external_url)
+
+        def on_done(result: str) -> None:
+            if result == "sent":
+                if self.history:
+                    self.history.record(room_id, image)
+                result = outcome
+            self._record_disruption(result, start)
+
+        # Sending happens in the background, so the monologue lock isn't held while the
+        # homeserver is slow or rate limiting us
+        self.send_queue.put(QueuedSend(room_id, content, on_done, created=start,
+                                       max_age=send_deadline))
+
+    async def _send_disruption(self, room_id: RoomID, content: MediaMessageEventContent
+                               ) -> None:
         await self.client.send_message_event(room_id, EventType.ROOM_MESSAGE, content)
 
+    def _record_disruption(self, outcome: str, start: float) -> None:
+        self.metrics.disruptions.inc(outcome=outcome)
+        self.metrics.disruption_latency.observe(time.monotonic() - start, outcome=outcome)
+
+    @web.get("/metrics")
+    async def metrics_endpoint(self, _: Request) -> Response:
+        self.metrics.cache_depth.clear()
+        self.metrics.readiness.clear()
+        self.metrics.breaker_state.clear()
+        sources = list(self.source.walk())
+        if self.fallback_source:
+            sources += self.fallback_source.walk()
+        for source in sources:
+            depth = source.cache_depth
+            if depth is not None:
+                self.metrics.cache_depth.set(depth, source=source.path)
+            for state in Readiness:
+                self.metrics.readiness.set(int(source.readiness == state), source=source.path,
+                                           state=state.value)
+            breaker = self.tasks.breakers.get(source)
+            if breaker:
+                for state in BreakerState:
+                    self.metrics.breaker_state.set(int(breaker.state == state),
+                                                   source=source.path, state=state.value)
+        self.metrics.worker_pending.set(self.workers.pending)
+        self.metrics.background_tasks.set(self.tasks.running)
+        self.metrics.send_queue_depth.set(len(self.send_queue))
+        if self.media_index:
+            self.metrics.dedup_lookups.set_total(self.media_index.hits, result="hit")
+            self.metrics.dedup_lookups.set_total(self.media_index.misses, result="miss")
+        return Response(text=self.metrics.render(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
+
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
@@ -0,0 +1,236 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+import json
+import time
+
+from mautrix.types import ContentURI, ImageInfo, RoomID
+from mautrix.util.async_db import Connection, Database, UpgradeTable
+
+from .source.abstract import Image
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Add persistent image cache")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE cached_image (
+            source       TEXT   NOT NULL,
+            config_hash  TEXT   NOT NULL,
+            mxc          TEXT   NOT NULL,
+            title        TEXT   NOT NULL,
+            info         TEXT   NOT NULL,
+            external_url TEXT,
+            added_at     BIGINT NOT NULL,
+            PRIMARY KEY (source, mxc)
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add media hash index")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE media_hash (
+            sha256    TEXT   PRIMARY KEY,
+            mxc       TEXT   NOT NULL,
+            info      TEXT   NOT NULL,
+            last_used BIGINT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add persistent rate limits")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE ratelimit (
+            key TEXT   PRIMARY KEY,
+            tat BIGINT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add directory source index")
+async def upgrade_v4(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE directory_file (
+            source   TEXT   NOT NULL,
+            path     TEXT   NOT NULL,
+            mtime_ns BIGINT NOT NULL,
+            size     BIGINT NOT NULL,
+            sha256   TEXT   NOT NULL,
+            mxc      TEXT   NOT NULL,
+            title    TEXT   NOT NULL,
+            info     TEXT   NOT NULL,
+            PRIMARY KEY (source, path)
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add sent image history")
+async def upgrade_v5(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE sent_image (
+            mxc          TEXT   PRIMARY KEY,
+            title        TEXT   NOT NULL,
+            info         TEXT   NOT NULL,
+            external_url TEXT,
+            last_sent    BIGINT NOT NULL
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE sent_image_room (
+            room_id TEXT   NOT NULL,
+            mxc     TEXT   NOT NULL,
+            sent_at BIGINT NOT NULL,
+            PRIMARY KEY (room_id, mxc)
+        )"""
+    )
+
+
+class DBManager:
+    db: Database
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+
+    @staticmethod
+    def _image_from_row(row) -> Image:
+        return Image(title=row["title"], url=ContentURI(row["mxc"]),
+                     info=ImageInfo.deserialize(json.loads(row["info"])),
+                     external_url=row["external_url"])
+
+    async def get_cached_images(self, source: str, config_hash: str) -> list[Image]:
+        """Get the cached images of a source, oldest first.
+
+        Images stored by a previous version of the source's config are dropped.
+        """
+        await self.db.execute("DELETE FROM cached_image WHERE source=$1 AND config_hash<>$2",
+                              source, config_hash)
+        rows = await self.db.fetch("SELECT mxc, title, info, external_url FROM cached_image "
+                                   "WHERE source=$1 ORDER BY added_at", source)
+        return [self._image_from_row(row) for row in rows]
+
+    async def add_cached_image(self, source: str, config_hash: str, image: Image) -> None:
+        q = ("INSERT INTO cached_image (source, config_hash, mxc, title, info, external_url, "
+             "                          added_at) "
+             "VALUES ($1, $2, $3, $4, $5, $6, $7) "
+             "ON CONFLICT (source, mxc) DO NOTHING")
+        await self.db.execute(q, source, config_hash, image.url, image.title or "",
+                              json.dumps(image.info.serialize()), image.external_url,
+                              int(time.time() * 1000))
+
+    async def remove_cached_image(self, source: str, mxc: ContentURI) -> None:
+        await self.db.execute("DELETE FROM cached_image WHERE source=$1 AND mxc=$2", source, mxc)
+
+    async def get_media_hashes(self, limit: int) -> list[tuple[str, ContentURI, ImageInfo]]:
+        """Get the most recently used media hashes, least recently used first."""
+        rows = await self.db.fetch("SELECT sha256, mxc, info FROM media_hash "
+                                   "ORDER BY last_used DESC LIMIT $1", limit)
+        return [(row["sha256"], ContentURI(row["mxc"]),
+                 ImageInfo.deserialize(json.loads(row["info"]))) for row in reversed(rows)]
+
+    async def put_media_hash(self, sha256: str, mxc: ContentURI, info: ImageInfo) -> None:
+        q = ("INSERT INTO media_hash (sha256, mxc, info, last_used) VALUES ($1, $2, $3, $4) "
+             "ON CONFLICT (sha256) DO UPDATE "
+             "  SET mxc=excluded.mxc, info=excluded.info, last_used=excluded.last_used")
+        await self.db.execute(q, sha256, mxc, json.dumps(info.serialize()),
+                              int(time.time() * 1000))
+
+    async def touch_media_hash(self, sha256: str) -> None:
+        await self.db.execute("UPDATE media_hash SET last_used=$2 WHERE sha256=$1",
+                              sha256, int(time.time() * 1000))
+
+    async def remove_media_hash(self, sha256: str) -> None:
+        await self.db.execute("DELETE FROM media_hash WHERE sha256=$1", sha256)
+
+    async def get_ratelimit(self, key: str) -> float:
+        tat = await self.db.fetchval("SELECT tat FROM ratelimit WHERE key=$1", key)
+        return tat / 1000 if tat else 0
+
+    async def put_ratelimits(self, items: dict[str, float]) -> None:
+        q = ("INSERT INTO ratelimit (key, tat) VALUES ($1, $2) "
+             "ON CONFLICT (key) DO UPDATE SET tat=excluded.tat")
+        await self.db.executemany(q, [(key, int(tat * 1000)) for key, tat in items.items()])
+
+    async def delete_expired_ratelimits(self, now: float) -> None:
+        await self.db.execute("DELETE FROM ratelimit WHERE tat<$1", int(now * 1000))
+
+    async def get_directory_files(self, source: str
+                                  ) -> list[tuple[str, int, int, str, Image]]:
+        """Get the indexed files of a directory source.
+
+        Returns:
+            A list of (path, mtime_ns, size, sha256, image) tuples.
+        """
+        rows = await self.db.fetch("SELECT path, mtime_ns, size, sha256, mxc, title, info "
+                                   "FROM directory_file WHERE source=$1", source)
+        return [(row["path"], row["mtime_ns"], row["size"], row["sha256"],
+                 Image(title=row["title"], url=ContentURI(row["mxc"]),
+                       info=ImageInfo.deserialize(json.loads(row["info"])), external_url=None))
+                for row in rows]
+
+    async def put_directory_file(self, source: str, path: str, mtime_ns: int, size: int,
+                                 sha256: str, image: Image) -> None:
+        q = ("INSERT INTO directory_file (source, path, mtime_ns, size, sha256, mxc, title, info) "
+             "VALUES ($1, $2, $3, $4, $5, $6, $7, $8) "
+             "ON CONFLICT (source, path) DO UPDATE "
+             "  SET mtime_ns=excluded.mtime_ns, size=excluded.size, sha256=excluded.sha256, "
+             "      mxc=excluded.mxc, title=excluded.title, info=excluded.info")
+        await self.db.execute(q, source, path, mtime_ns, size, sha256, image.url, image.title,
+                              json.dumps(image.info.serialize()))
+
+    async def remove_directory_files(self, source: str, paths: list[str]) -> None:
+        await self.db.executemany("DELETE FROM directory_file WHERE source=$1 AND path=$2",
+                                  [(source, path) for path in paths])
+
+    async def get_sent_images(self, limit: int) -> list[tuple[Image, float]]:
+        """Get the most recently sent images, least recently sent first.
+
+        Returns:
+            A list of (image, last_sent) tuples.
+        """
+        rows = await self.db.fetch("SELECT mxc, title, info, external_url, last_sent "
+                                   "FROM sent_image ORDER BY last_sent DESC LIMIT $1", limit)
+        return [(self._image_from_row(row), row["last_sent"] / 1000) for row in reversed(rows)]
+
+    async def put_sent_image(self, image: Image, sent_at: float) -> None:
+        q = ("INSERT INTO sent_image (mxc, title, info, external_url, last_sent) "
+             "VALUES ($1, $2, $3, $4, $5) "
+             "ON CONFLICT (mxc) DO UPDATE SET last_sent=excluded.last_sent")
+        await self.db.execute(q, image.url, image.title or "",
+                              json.dumps(image.info.serialize()), image.external_url,
+                              int(sent_at * 1000))
+
+    async def remove_sent_image(self, mxc: ContentURI) -> None:
+        await self.db.execute("DELETE FROM sent_image WHERE mxc=$1", mxc)
+        await self.db.execute("DELETE FROM sent_image_room WHERE mxc=$1", mxc)
+
+    async def get_room_sends(self, since: float) -> list[tuple[RoomID, ContentURI, float]]:
+        rows = await self.db.fetch("SELECT room_id, mxc, sent_at FROM sent_image_room "
+                                   "WHERE sent_at>=$1", int(since * 1000))
+        return [(RoomID(row["room_id"]), ContentURI(row["mxc"]), row["sent_at"] / 1000)
+                for row in rows]
+
+    async def put_room_send(self, room_id: RoomID, mxc: ContentURI, sent_at: float) -> None:
+        q = ("INSERT INTO sent_image_room (room_id, mxc, sent_at) VALUES ($1, $2, $3) "
+             "ON CONFLICT (room_id, mxc) DO UPDATE SET sent_at=excluded.sent_at")
+        await self.db.execute(q, room_id, mxc, int(sent_at * 1000))
+
+    async def delete_room_sends_before(self, before: float) -> None:
+        await self.db.execute("DELETE FROM sent_image_room WHERE sent_at<$1",
+                              int(before * 1000))
@@ -0,0 +1,84 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, NamedTuple
+from collections import OrderedDict
+
+from mautrix.types import ContentURI, ImageInfo
+from mautrix.util import background_task
+
+if TYPE_CHECKING:
+    from .db import DBManager
+
+
+class IndexedMedia(NamedTuple):
+    url: ContentURI
+    info: ImageInfo
+
+    def copy_info(self) -> ImageInfo:
+        return ImageInfo.deserialize(self.info.serialize())
+
+
+class MediaIndex:
+    """An LRU index from sha256 hashes of uploaded media to their content URIs."""
+
+    entries: OrderedDict[str, IndexedMedia]
+    max_size: int
+    db: DBManager | None
+    hits: int
+    misses: int
+    saved_bytes: int
+
+    def __init__(self, max_size: int = 1000, db: DBManager | None = None) -> None:
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.db = db
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+
+    async def load(self) -> None:
+        if not self.db:
+            return
+        for sha256, url, info in await self.db.get_media_hashes(self.max_size):
+            self.entries[sha256] = IndexedMedia(url=url, info=info)
+
+    def get(self, sha256: str) -> IndexedMedia | None:
+        try:
+            media = self.entries[sha256]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(sha256)
+        self.hits += 1
+        self.saved_bytes += media.info.size or 0
+        if self.db:
+            background_task.create(self.db.touch_media_hash(sha256))
+        return media
+
+    def put(self, sha256: str, url: ContentURI, info: ImageInfo) -> None:
+        # Only the properties of the file itself are indexed, not thumbnails or blurhashes
+        info = ImageInfo(mimetype=info.mimetype, size=info.size, width=info.width,
+                         height=info.height)
+        self.entries[sha256] = IndexedMedia(url=url, info=info)
+        self.entries.move_to_end(sha256)
+        if self.db:
+            background_task.create(self.db.put_media_hash(sha256, url, info))
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            if self.db:
+                background_task.create(self.db.remove_media_hash(evicted))
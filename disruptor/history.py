@@ -0,0 +1,116 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, NamedTuple
+from collections import OrderedDict
+import random
+import time
+
+from mautrix.types import ContentURI, RoomID
+from mautrix.util import background_task
+
+from .source.abstract import Image
+
+if TYPE_CHECKING:
+    from .db import DBManager
+
+
+class SentImage(NamedTuple):
+    image: Image
+    last_sent: float
+
+
+class ImageHistory:
+    """A bounded history of sent images that can be sent again when sources have nothing new.
+
+    Images are only reused in a room if they haven't been sent there within the minimum reuse
+    interval.
+    """
+
+    images: OrderedDict[ContentURI, SentImage]
+    room_sends: dict[RoomID, dict[ContentURI, float]]
+    max_size: int
+    min_reuse_interval: float
+    prune_interval: float
+    last_pruned: float
+    db: DBManager | None
+
+    def __init__(self, max_size: int = 500, min_reuse_interval: float = 86400,
+                 db: DBManager | None = None) -> None:
+        self.images = OrderedDict()
+        self.room_sends = {}
+        self.max_size = max_size
+        self.min_reuse_interval = min_reuse_interval
+        # Expired sends in rooms that don't get new disruptions are pruned at this interval
+        self.prune_interval = min(min_reuse_interval, 3600)
+        self.last_pruned = time.time()
+        self.db = db
+
+    async def load(self) -> None:
+        if not self.db:
+            return
+        for image, last_sent in await self.db.get_sent_images(self.max_size):
+            self.images[image.url] = SentImage(image, last_sent)
+        since = time.time() - self.min_reuse_interval
+        await self.db.delete_room_sends_before(since)
+        for room_id, mxc, sent_at in await self.db.get_room_sends(since):
+            self.room_sends.setdefault(room_id, {})[mxc] = sent_at
+
+    def record(self, room_id: RoomID, image: Image) -> None:
+        now = time.time()
+        self.images[image.url] = SentImage(image, now)
+        self.images.move_to_end(image.url)
+        sends = self.room_sends.setdefault(room_id, {})
+        sends[image.url] = now
+        if self.db:
+            background_task.create(self.db.put_sent_image(image, now))
+            background_task.create(self.db.put_room_send(room_id, image.url, now))
+        while len(self.images) > self.max_size:
+            evicted, _ = self.images.popitem(last=False)
+            if self.db:
+                background_task.create(self.db.remove_sent_image(evicted))
+        if now - self.last_pruned >= self.prune_interval:
+            self.prune(now)
+        else:
+            self._prune_room(room_id, now)
+
+    def prune(self, now: float | None = None) -> None:
+        """Forget sends that are older than the minimum reuse interval in every room."""
+        now = time.time() if now is None else now
+        for room_id in list(self.room_sends):
+            self._prune_room(room_id, now)
+        self.last_pruned = now
+        if self.db:
+            background_task.create(self.db.delete_room_sends_before(now - self.min_reuse_interval))
+
+    def _prune_room(self, room_id: RoomID, now: float) -> None:
+        sends = self.room_sends.get(room_id)
+        if not sends:
+            return
+        for mxc, sent_at in list(sends.items()):
+            if sent_at + self.min_reuse_interval < now or mxc not in self.images:
+                del sends[mxc]
+        if not sends:
+            del self.room_sends[room_id]
+
+    def pick(self, room_id: RoomID) -> Image | None:
+        """Pick a random image that can be reused in the room."""
+        now = time.time()
+        self._prune_room(room_id, now)
+        recent = self.room_sends.get(room_id, {})
+        candidates = [entry.image for mxc, entry in self.images.items() if mxc not in recent]
+        return random.choice(candidates) if candidates else None
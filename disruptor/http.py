@@ -0,0 +1,123 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, AsyncContextManager, AsyncIterator
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import random
+
+from aiohttp import (ClientConnectionError, ClientResponse, ClientSession, ClientTimeout,
+                     TCPConnector)
+from yarl import URL
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class HTTPClient:
+    """An HTTP client with timeouts and retries for one source.
+
+    If the source config has an ``http`` section, the source gets its own connection pool, so
+    a slow upstream can only use up its own connections. Otherwise requests go through the
+    session that maubot gives the plugin, but still with timeouts and retries.
+    """
+
+    session: ClientSession
+    own_session: bool
+    timeout: ClientTimeout
+    retries: int
+    retry_backoff: float
+    max_retry_delay: float
+    log: logging.Logger
+
+    def __init__(self, default_session: ClientSession, config: dict[str, Any] | None,
+                 log: logging.Logger) -> None:
+        config = config or {}
+        self.log = log
+        self.timeout = ClientTimeout(total=config.get("total_timeout") or None,
+                                     connect=config.get("connect_timeout", 10),
+                                     sock_read=config.get("read_timeout", 30))
+        self.retries = config.get("retries", 2)
+        self.retry_backoff = config.get("retry_backoff", 1)
+        self.max_retry_delay = config.get("max_retry_delay", 30)
+        if config:
+            keepalive = config.get("keepalive_timeout", 30)
+            connector = TCPConnector(limit=config.get("limit", 10),
+                                     limit_per_host=config.get("limit_per_host", 4),
+                                     ttl_dns_cache=config.get("dns_ttl", 300),
+                                     keepalive_timeout=keepalive or None,
+                                     force_close=not keepalive)
+            self.session = ClientSession(connector=connector, timeout=self.timeout,
+                                         headers=default_session.headers)
+            self.own_session = True
+        else:
+            self.session = default_session
+            self.own_session = False
+
+    async def close(self) -> None:
+        if self.own_session:
+            await self.session.close()
+
+    def _retry_delay(self, attempt: int, resp: ClientResponse | None = None) -> float:
+        if resp is not None and "Retry-After" in resp.headers:
+            try:
+                return float(resp.headers["Retry-After"])
+            except ValueError:
+                pass
+        return self.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    async def _request(self, method: str, url: URL | str, **kwargs: Any) -> ClientResponse:
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            try:
+                resp = await self.session.request(method, url, **kwargs)
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                self.log.debug(f"{method} {url} failed ({type(e).__name__}: {e}), "
+                               f"retrying in {delay:.1f} seconds")
+            else:
+                if resp.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return resp
+                delay = self._retry_delay(attempt, resp)
+                if delay > self.max_retry_delay:
+                    # Not worth waiting for, let the caller handle the error response
+                    return resp
+                resp.release()
+                self.log.debug(f"{method} {url} returned HTTP {resp.status}, "
+                               f"retrying in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @asynccontextmanager
+    async def request(self, method: str, url: URL | str, **kwargs: Any
+                      ) -> AsyncIterator[ClientResponse]:
+        """Make a request, retrying on connection errors and temporary failures.
+
+        Only sending the request and receiving the headers is retried. The response is
+        released when the context exits, whether or not the body was read.
+        """
+        resp = await self._request(method, url, **kwargs)
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+    def get(self, url: URL | str, **kwargs: Any) -> AsyncContextManager[ClientResponse]:
+        return self.request("GET", url, **kwargs)
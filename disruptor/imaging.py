@@ -0,0 +1,246 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Synchronous image processing helpers.
+
+Everything here works on plain bytes and only returns plain values, so the functions can be
+run in a thread or process pool.
+"""
+from __future__ import annotations
+
+from typing import NamedTuple
+from io import BytesIO
+import struct
+import math
+
+try:
+    from PIL import Image as Pillow, ImageOps
+except ImportError:
+    Pillow = None
+    ImageOps = None
+
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+# Blurhashes are very blurry, so there's no point in looking at more pixels than this
+BLURHASH_SAMPLE_SIZE = 32
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_SOS = 0xDA
+JPEG_APP1 = 0xE1
+JPEG_APP2 = 0xE2
+JPEG_APP13 = 0xED
+JPEG_COM = 0xFE
+EXIF_HEADER = b"Exif\0\0"
+EXIF_ORIENTATION = 0x0112
+EXIF_TYPE_SHORT = 3
+# Profiles up to this size (e.g. sRGB, Display P3, Adobe RGB) are kept, since dropping them
+# changes how colors are shown. Larger ones are usually camera or printer specific.
+MAX_KEPT_ICC_SIZE = 4 * 1024
+
+
+TRANSCODE_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+class Thumbnail(NamedTuple):
+    data: bytes
+    mimetype: str
+    width: int
+    height: int
+    blurhash: str
+
+
+def _base83(value: int, length: int) -> str:
+    return "".join(BASE83[(value // 83 ** (length - i)) % 83] for i in range(1, length + 1))
+
+
+def _srgb_to_linear(value: int) -> float:
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(value: float) -> int:
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value: float, exp: float) -> float:
+    return math.copysign(abs(value) ** exp, value)
+
+
+def encode_blurhash(img: Pillow.Image, x_components: int = 4, y_components: int = 3) -> str:
+    img = img.convert("RGB")
+    img.thumbnail((BLURHASH_SAMPLE_SIZE, BLURHASH_SAMPLE_SIZE))
+    width, height = img.size
+    linear = [tuple(_srgb_to_linear(c) for c in pixel) for pixel in img.getdata()]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)]
+             for i in range(x_components)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)]
+             for j in range(y_components)]
+
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            norm = (1 if i == 0 and j == 0 else 2) / (width * height)
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                basis_y = cos_y[j][y]
+                for x in range(width):
+                    basis = cos_x[i][x] * basis_y
+                    pr, pg, pb = linear[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            factors.append((r * norm, g * norm, b * norm))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = max(0, min(82, int(actual_max * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += _base83(0, 1)
+    result += _base83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8)
+                      + _linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (max(0, min(18, int(_sign_pow(c / max_value, 0.5) * 9 + 9.5)))
+                   for c in factor)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def image_size(data: bytes) -> tuple[int, int]:
+    """Get the dimensions of an image from its header (which may be a truncated file)."""
+    return Pillow.open(BytesIO(data)).size
+
+
+def make_thumbnail(data: bytes, max_size: int, quality: int = 80) -> Thumbnail:
+    """Create a thumbnail and a blurhash from the bytes of a full image."""
+    img = Pillow.open(BytesIO(data))
+    img.draft("RGB", (max_size, max_size))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((max_size, max_size))
+    out = BytesIO()
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        img.save(out, format="PNG", optimize=True)
+        mimetype = "image/png"
+    else:
+        img = img.convert("RGB")
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        mimetype = "image/jpeg"
+    return Thumbnail(data=out.getvalue(), mimetype=mimetype, width=img.width,
+                     height=img.height, blurhash=encode_blurhash(img))
+
+
+class Transcoded(NamedTuple):
+    data: bytes
+    mimetype: str
+    width: int
+    height: int
+
+
+def transcode(data: bytes, mimetype: str, max_width: int, max_height: int,
+              format: str = "jpeg", quality: int = 85) -> Transcoded | None:
+    """Downscale an image to fit in the given dimensions and re-encode it.
+
+    Returns:
+        The new image, or ``None`` if the original should be used as-is, i.e. if it already
+        fits and is in the target format, is animated, or would get bigger.
+    """
+    target_mimetype = TRANSCODE_FORMATS[format]
+    img = Pillow.open(BytesIO(data))
+    if getattr(img, "n_frames", 1) > 1:
+        return None
+    fits = img.width <= max_width and img.height <= max_height
+    if fits and mimetype == target_mimetype:
+        return None
+    img.draft("RGB", (max_width, max_height))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((max_width, max_height))
+    if format == "jpeg" or img.mode not in ("RGBA", "LA"):
+        img = img.convert("RGB")
+    out = BytesIO()
+    img.save(out, format=format.upper(), quality=quality, optimize=True)
+    if fits and out.tell() >= len(data):
+        return None
+    return Transcoded(data=out.getvalue(), mimetype=target_mimetype, width=img.width,
+                      height=img.height)
+
+
+def _exif_orientation(data: bytes) -> int:
+    if not Pillow:
+        return 0
+    try:
+        return Pillow.open(BytesIO(data)).getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        return 0
+
+
+def _orientation_segment(orientation: int) -> bytes:
+    # A big-endian TIFF header followed by a single IFD with only the orientation tag
+    tiff = struct.pack(">2sHIHHHIHHI", b"MM", 42, 8, 1, EXIF_ORIENTATION, EXIF_TYPE_SHORT, 1,
+                       orientation, 0, 0)
+    payload = EXIF_HEADER + tiff
+    return struct.pack(">BBH", 0xFF, JPEG_APP1, len(payload) + 2) + payload
+
+
+def strip_jpeg_metadata(data: bytes) -> bytes:
+    """Remove EXIF, XMP, Photoshop and comment segments and large ICC profiles from a JPEG.
+
+    Segments are dropped without touching the compressed image data, so this is lossless.
+    If the EXIF data rotates the image, it's replaced with a minimal EXIF segment that only
+    has the orientation, as dropping it would change how the image is shown. Anything that
+    doesn't look like a well-formed JPEG is returned unchanged.
+    """
+    if not data.startswith(JPEG_SOI):
+        return data
+    orientation = _exif_orientation(data)
+    exif = _orientation_segment(orientation) if 1 < orientation <= 8 else None
+    segments = []
+    pos = len(JPEG_SOI)
+    while True:
+        if pos + 4 > len(data) or data[pos] != 0xFF:
+            return data
+        marker = data[pos + 1]
+        if marker == JPEG_SOS:
+            break
+        end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+        if end > len(data) or end < pos + 4:
+            return data
+        segments.append((marker, data[pos:end]))
+        pos = end
+    # Large profiles are split into several segments, which must be dropped together
+    icc_size = sum(len(segment) for marker, segment in segments
+                   if marker == JPEG_APP2 and segment[4:16] == b"ICC_PROFILE\0")
+    out = bytearray(JPEG_SOI)
+    for marker, segment in segments:
+        if marker in (JPEG_APP13, JPEG_COM):
+            continue
+        elif marker == JPEG_APP1:
+            if exif and segment[4:10] == EXIF_HEADER:
+                out += exif
+                exif = None
+            continue
+        elif (marker == JPEG_APP2 and segment[4:16] == b"ICC_PROFILE\0"
+              and icc_size > MAX_KEPT_ICC_SIZE):
+            continue
+        out += segment
+    out += data[pos:]
+    return bytes(out)
@@ -0,0 +1,231 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import ClassVar, Iterator, Sequence
+from abc import ABC, abstractmethod
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"'
+                          for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    type_name: ClassVar[str]
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    @abstractmethod
+    def _samples(self) -> Iterator[tuple[str, Sequence[str], Sequence[str], float]]:
+        pass
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, names, values, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} "
+                         f"{_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_name = "counter"
+    values: dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()) -> None:
+        super().__init__(name, help, label_names)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels: str) -> None:
+        """Set the value of a counter that is counted elsewhere."""
+        self.values[self._key(labels)] = value
+
+    def _samples(self) -> Iterator[tuple[str, Sequence[str], Sequence[str], float]]:
+        for key, value in self.values.items():
+            yield "", self.label_names, key, value
+
+
+class Gauge(Metric):
+    """A gauge whose values are replaced on every scrape."""
+
+    type_name = "gauge"
+    values: dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()) -> None:
+        super().__init__(name, help, label_names)
+        self.values = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self._key(labels)] = value
+
+    def clear(self) -> None:
+        self.values = {}
+
+    def _samples(self) -> Iterator[tuple[str, Sequence[str], Sequence[str], float]]:
+        for key, value in self.values.items():
+            yield "", self.label_names, key, value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+    buckets: tuple[float, ...]
+    counts: dict[LabelValues, list[int]]
+    sums: dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, label_names)
+        self.buckets = (*sorted(buckets), float("inf"))
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        try:
+            counts = self.counts[key]
+        except KeyError:
+            counts = self.counts[key] = [0] * len(self.buckets)
+            self.sums[key] = 0
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self.sums[key] += value
+
+    def _samples(self) -> Iterator[tuple[str, Sequence[str], Sequence[str], float]]:
+        bucket_names = (*self.label_names, "le")
+        for key, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", bucket_names, (*key, _format_value(bound)), cumulative
+            yield "_sum", self.label_names, key, self.sums[key]
+            yield "_count", self.label_names, key, cumulative
+
+
+class Metrics:
+    """The metrics of one plugin instance, rendered in the Prometheus text format."""
+
+    fetch_latency: Histogram
+    fetch_total: Counter
+    download_latency: Histogram
+    upload_latency: Histogram
+    transferred_bytes: Counter
+    cache_depth: Gauge
+    readiness: Gauge
+    disruptions: Counter
+    disruption_latency: Histogram
+    hedged_fetches: Counter
+    dedup_lookups: Counter
+    loop_lag: Histogram
+    worker_task_latency: Histogram
+    worker_pending: Gauge
+    background_tasks: Gauge
+    breaker_state: Gauge
+    send_queue_depth: Gauge
+
+    def __init__(self) -> None:
+        self.fetch_latency = Histogram("disruptor_source_fetch_seconds",
+                                       "Time taken by source fetches", ("source", "method"))
+        self.fetch_total = Counter("disruptor_source_fetches_total",
+                                   "Number of source fetches by outcome",
+                                   ("source", "method", "outcome"))
+        self.download_latency = Histogram("disruptor_reupload_download_seconds",
+                                          "Time taken to download media for reuploading",
+                                          ("source",))
+        self.upload_latency = Histogram("disruptor_reupload_upload_seconds",
+                                        "Time taken to upload media to the homeserver "
+                                        "(includes the download for streamed uploads)",
+                                        ("source",))
+        self.transferred_bytes = Counter("disruptor_reupload_bytes_total",
+                                         "Bytes downloaded from upstreams and uploaded to the "
+                                         "homeserver", ("source", "direction"))
+        self.cache_depth = Gauge("disruptor_source_cache_depth",
+                                 "Number of images ready in a source's cache", ("source",))
+        self.readiness = Gauge("disruptor_source_readiness",
+                               "Readiness state of each source", ("source", "state"))
+        self.disruptions = Counter("disruptor_disruptions_total",
+                                   "Number of disruptions by outcome", ("outcome",))
+        self.disruption_latency = Histogram("disruptor_disruption_seconds",
+                                            "Time from deciding to disrupt until the disruption "
+                                            "was sent or given up", ("outcome",))
+        self.hedged_fetches = Counter("disruptor_hedged_fetches_total",
+                                      "Fetches that were hedged with the fallback source, by "
+                                      "which request won", ("winner",))
+        self.dedup_lookups = Counter("disruptor_media_dedup_lookups_total",
+                                     "Media hash index lookups by result", ("result",))
+        self.loop_lag = Histogram("disruptor_event_loop_lag_seconds",
+                                  "How late the event loop ran a periodic timer",
+                                  buckets=LAG_BUCKETS)
+        self.worker_task_latency = Histogram("disruptor_worker_task_seconds",
+                                             "Time taken by worker pool tasks, including time "
+                                             "spent waiting for a free worker", ("function",))
+        self.worker_pending = Gauge("disruptor_worker_pending_tasks",
+                                    "Number of tasks running or queued in the worker pool")
+        self.background_tasks = Gauge("disruptor_background_tasks",
+                                      "Number of background tasks started by sources that "
+                                      "haven't finished yet")
+        self.breaker_state = Gauge("disruptor_source_breaker_state",
+                                   "Circuit breaker state of each source's background work",
+                                   ("source", "state"))
+        self.send_queue_depth = Gauge("disruptor_send_queue_depth",
+                                      "Number of rooms with a disruption waiting to be sent")
+
+    @property
+    def all(self) -> list[Metric]:
+        return [self.fetch_latency, self.fetch_total, self.download_latency,
+                self.upload_latency, self.transferred_bytes, self.cache_depth, self.readiness,
+                self.disruptions, self.disruption_latency, self.hedged_fetches,
+                self.dedup_lookups, self.loop_lag, self.worker_task_latency,
+                self.worker_pending, self.background_tasks, self.breaker_state,
+                self.send_queue_depth]
+
+    def observe_fetch(self, source: str, method: str, outcome: str, duration: float) -> None:
+        self.fetch_latency.observe(duration, source=source, method=method)
+        self.fetch_total.inc(source=source, method=method, outcome=outcome)
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.all) + "\n"
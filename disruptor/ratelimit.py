@@ -0,0 +1,193 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, NamedTuple
+from time import time
+import asyncio
+import logging
+
+from mautrix.util import background_task
+
+if TYPE_CHECKING:
+    from .db import DBManager
+
+
+class Limit(NamedTuple):
+    name: str
+    rate: float
+    per: float
+
+    @property
+    def emission_interval(self) -> float:
+        return self.per / self.rate
+
+    @property
+    def burst_tolerance(self) -> float:
+        return self.per - self.emission_interval
+
+
+class MemoryBackend:
+    """Stores the theoretical arrival time (TAT) of each key in memory.
+
+    A key whose TAT is in the past is equivalent to a key that has never been seen, so those are
+    dropped periodically.
+    """
+
+    tats: dict[str, float]
+    sweep_interval: float
+    _next_sweep: float
+
+    def __init__(self, sweep_interval: float = 60) -> None:
+        self.tats = {}
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def _sweep(self, now: float) -> None:
+        if self._next_sweep > now:
+            return
+        self._next_sweep = now + self.sweep_interval
+        self.tats = {key: tat for key, tat in self.tats.items() if tat > now}
+
+    async def get(self, keys: list[str]) -> list[float]:
+        self._sweep(time())
+        return [self.tats.get(key, 0) for key in keys]
+
+    async def set(self, items: dict[str, float]) -> None:
+        self.tats.update(items)
+
+
+class DatabaseBackend(MemoryBackend):
+    """Keeps TATs in memory like :class:`MemoryBackend`, but also stores them in the database.
+
+    Keys are loaded from the database the first time they're used, and changes are written back
+    in batches every ``flush_interval`` seconds.
+    """
+
+    db: DBManager
+    log: logging.Logger
+    flush_interval: float
+    dirty: dict[str, float]
+    _flush_task: asyncio.Task | None
+
+    def __init__(self, db: DBManager, log: logging.Logger, flush_interval: float = 10,
+                 sweep_interval: float = 60) -> None:
+        super().__init__(sweep_interval)
+        self.db = db
+        self.log = log
+        self.flush_interval = flush_interval
+        self.dirty = {}
+        self._flush_task = None
+
+    async def start(self) -> None:
+        self._flush_task = background_task.create(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def _sweep(self, now: float) -> None:
+        if self._next_sweep > now:
+            return
+        self._next_sweep = now + self.sweep_interval
+        self.tats = {key: tat for key, tat in self.tats.items()
+                     if tat > now or key in self.dirty}
+
+    async def get(self, keys: list[str]) -> list[float]:
+        self._sweep(time())
+        tats = []
+        for key in keys:
+            try:
+                tat = self.tats[key]
+            except KeyError:
+                tat = self.tats[key] = await self.db.get_ratelimit(key)
+            tats.append(tat)
+        return tats
+
+    async def set(self, items: dict[str, float]) -> None:
+        await super().set(items)
+        self.dirty.update(items)
+
+    async def flush(self) -> None:
+        if not self.dirty:
+            return
+        items, self.dirty = self.dirty, {}
+        try:
+            await self.db.put_ratelimits(items)
+            await self.db.delete_expired_ratelimits(time())
+        except Exception:
+            # Put the failed items back unless they were overwritten in the meantime
+            self.dirty = {**items, **self.dirty}
+            raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                self.log.exception("Failed to flush rate limits to database")
+
+
+class RateLimiter:
+    """A GCRA rate limiter that can check several limits at once.
+
+    A request is only counted if every limit allows it, so a request that is denied by one limit
+    doesn't use up the allowance of the others.
+    """
+
+    backend: MemoryBackend
+    lock: asyncio.Lock
+
+    def __init__(self, backend: MemoryBackend) -> None:
+        self.backend = backend
+        self.lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        await self.backend.start()
+
+    async def stop(self) -> None:
+        await self.backend.stop()
+
+    async def check(self, *requests: tuple[Limit, str]) -> Limit | None:
+        """Check and count a request against all the given limits.
+
+        Args:
+            *requests: Tuples of the limit and the key (e.g. user or room ID) to check.
+
+        Returns:
+            The first limit that denied the request, or ``None`` if the request is allowed.
+        """
+        keys = [f"{limit.name}:{key}" for limit, key in requests]
+        async with self.lock:
+            tats = await self.backend.get(keys)
+            now = time()
+            updates = {}
+            for (limit, _), key, tat in zip(requests, keys, tats):
+                tat = max(tat, now)
+                if tat - now > limit.burst_tolerance:
+                    return limit
+                updates[key] = tat + limit.emission_interval
+            await self.backend.set(updates)
+        return None
@@ -0,0 +1,235 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Awaitable, Callable
+from collections import OrderedDict
+import asyncio
+import json
+import logging
+import random
+import time
+
+from mautrix.errors import MLimitExceeded
+from mautrix.types import MediaMessageEventContent, RoomID
+from mautrix.util import background_task
+
+Sender = Callable[[RoomID, MediaMessageEventContent], Awaitable[object]]
+
+
+class QueuedSend:
+    """A disruption waiting to be sent.
+
+    ``on_done`` is called with the result: ``sent``, ``stale`` if the entry got too old before
+    it was sent, ``coalesced`` if it was replaced by another entry for the same room,
+    ``errored`` or ``dropped`` if the queue was stopped. ``max_age`` limits the age of this
+    entry further than the queue's own limit.
+    """
+
+    __slots__ = ("room_id", "content", "created", "on_done", "max_age")
+
+    room_id: RoomID
+    content: MediaMessageEventContent
+    created: float
+    on_done: Callable[[str], None]
+    max_age: float | None
+
+    def __init__(self, room_id: RoomID, content: MediaMessageEventContent,
+                 on_done: Callable[[str], None], created: float | None = None,
+                 max_age: float | None = None) -> None:
+        self.room_id = room_id
+        self.content = content
+        self.on_done = on_done
+        self.created = time.monotonic() if created is None else created
+        self.max_age = max_age
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+
+def _retry_after(e: Exception) -> float | None:
+    """Find how long the homeserver asked us to wait before sending again.
+
+    mautrix only keeps the errcode and message of standard errors like ``M_LIMIT_EXCEEDED``,
+    so the delay is only known for rate limit responses that it didn't recognize, which keep
+    the raw response body.
+
+    Returns:
+        ``None`` if the error isn't a rate limit, 0 if the delay isn't known, or the delay in
+        seconds.
+    """
+    if not isinstance(e, MLimitExceeded) and getattr(e, "http_status", None) != 429:
+        return None
+    try:
+        body = json.loads(getattr(e, "text", None) or "")
+    except ValueError:
+        return 0
+    retry_after_ms = body.get("retry_after_ms") if isinstance(body, dict) else None
+    if isinstance(retry_after_ms, (int, float)) and retry_after_ms > 0:
+        return retry_after_ms / 1000
+    return 0
+
+
+class SendQueue:
+    """Sends disruptions in the background, so event handlers don't wait for the homeserver.
+
+    Each room has at most one entry waiting, and further disruptions for the room are coalesced
+    into it. Sends are limited globally and per room. When the homeserver rate limits us, all
+    sends pause for an exponential backoff (or the time it asks for, if the error still has it)
+    and the entry goes back to the front of the queue. Entries older than ``max_age`` (or their
+    own limit) are dropped, as the monologue they were meant for is probably over, and sends
+    that are still running when the entry gets too old are cancelled.
+    """
+
+    send: Sender
+    log: logging.Logger
+    concurrency: int
+    per_room: int
+    max_age: float
+    retry_backoff: float
+    max_retry_backoff: float
+
+    pending: OrderedDict[RoomID, QueuedSend]
+    room_sends: dict[RoomID, int]
+    inflight: set[asyncio.Task]
+    paused_until: float
+    rate_limits: int
+    wakeup: asyncio.Event
+    task: asyncio.Task | None
+
+    def __init__(self, send: Sender, log: logging.Logger, concurrency: int = 4,
+                 per_room: int = 1, max_age: float = 60, retry_backoff: float = 1,
+                 max_retry_backoff: float = 60) -> None:
+        self.send = send
+        self.log = log
+        self.concurrency = max(1, concurrency)
+        self.per_room = max(1, per_room)
+        self.max_age = max_age
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.pending = OrderedDict()
+        self.room_sends = {}
+        self.inflight = set()
+        self.paused_until = 0
+        self.rate_limits = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self) -> None:
+        self.task = background_task.create(self._run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for task in self.inflight:
+            task.cancel()
+        if self.inflight:
+            await asyncio.gather(*self.inflight, return_exceptions=True)
+        pending, self.pending = self.pending, OrderedDict()
+        for entry in pending.values():
+            entry.on_done("dropped")
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    @property
+    def idle(self) -> bool:
+        return not self.pending and not self.inflight
+
+    def is_pending(self, room_id: RoomID) -> bool:
+        return room_id in self.pending
+
+    def put(self, entry: QueuedSend) -> None:
+        existing = self.pending.get(entry.room_id)
+        if existing:
+            # Keep the older entry's place in the queue, but send the newer image
+            entry.created = existing.created
+            self.pending[entry.room_id] = entry
+            existing.on_done("coalesced")
+        else:
+            self.pending[entry.room_id] = entry
+        self.wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            self.wakeup.clear()
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            for room_id in list(self.pending):
+                if len(self.inflight) >= self.concurrency:
+                    break
+                if self.room_sends.get(room_id, 0) >= self.per_room:
+                    continue
+                entry = self.pending.pop(room_id)
+                if self._time_left(entry) <= 0:
+                    self.log.debug(f"Dropping disruption in {room_id}: "
+                                   f"queued for {entry.age:.1f} seconds")
+                    entry.on_done("stale")
+                    continue
+                self.room_sends[room_id] = self.room_sends.get(room_id, 0) + 1
+                task = asyncio.create_task(self._send(entry))
+                self.inflight.add(task)
+            await self.wakeup.wait()
+
+    def _time_left(self, entry: QueuedSend) -> float:
+        max_age = self.max_age
+        if entry.max_age is not None:
+            max_age = min(max_age, entry.max_age)
+        return max_age - entry.age
+
+    async def _send(self, entry: QueuedSend) -> None:
+        try:
+            await asyncio.wait_for(self.send(entry.room_id, entry.content),
+                                   timeout=self._time_left(entry))
+        except asyncio.TimeoutError:
+            self.log.debug(f"Dropping disruption in {entry.room_id}: "
+                           f"sending didn't finish in {entry.age:.1f} seconds")
+            entry.on_done("stale")
+        except asyncio.CancelledError:
+            entry.on_done("dropped")
+            raise
+        except Exception as e:
+            delay = _retry_after(e)
+            if delay is None:
+                self.log.exception(f"Failed to send disruption to {entry.room_id}")
+                entry.on_done("errored")
+                return
+            if not delay:
+                delay = self.retry_backoff * 2 ** self.rate_limits * random.uniform(0.5, 1.5)
+            delay = min(delay, self.max_retry_backoff)
+            self.rate_limits += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.log.warning(f"Rate limited while sending to {entry.room_id}, "
+                             f"pausing sends for {delay:.1f} seconds")
+            if entry.room_id in self.pending:
+                # A newer disruption for the room is already waiting
+                entry.on_done("coalesced")
+            else:
+                self.pending[entry.room_id] = entry
+                self.pending.move_to_end(entry.room_id, last=False)
+        else:
+            self.rate_limits = 0
+            entry.on_done("sent")
+        finally:
+            self.inflight.discard(asyncio.current_task())
+            count = self.room_sends.pop(entry.room_id, 1) - 1
+            if count > 0:
+                self.room_sends[entry.room_id] = count
+            self.wakeup.set()
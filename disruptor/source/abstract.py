@@ -13,10 +13,18 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import NamedTuple, Tuple, Type, Optional, Dict, Any, ClassVar, TYPE_CHECKING
+from typing import (NamedTuple, Tuple, Type, Optional, Dict, List, Deque, Iterable, Iterator,
+                    AsyncIterator, Awaitable, Callable, Any, ClassVar, TYPE_CHECKING)
+from collections import deque
 from abc import ABC, abstractmethod
-from io import BytesIO
+from enum import Enum
 import mimetypes
+import os.path
+import functools
+import asyncio
+import hashlib
+import time
+import json
 import cgi
 
 from aiohttp import ClientResponse
@@ -26,6 +34,10 @@ import magic
 from mautrix.types import ImageInfo, ContentURI, UserID, RoomID
 from mautrix.util.logging import TraceLogger
 
+from ..http import HTTPClient
+from ..imaging import image_size, make_thumbnail, strip_jpeg_metadata, transcode
+from .shared import DownloadBuffer, DownloadedMedia
+
 try:
     from PIL import Image as Pillow
 except ImportError:
@@ -46,26 +58,195 @@ class CancelDisruption(Exception):
     pass
 
 
+class SourceUnavailable(CancelDisruption):
+    """Raised when a source has no image available right now, as opposed to deliberately
+    cancelling the disruption like the noop source."""
+
+    source: Optional[str]
+
+    def __init__(self, source: Optional[str] = None) -> None:
+        super().__init__(f"{source} has no images available" if source else "")
+        self.source = source
+
+
+class MediaTooLarge(Exception):
+    def __init__(self, url: URL, size: int, max_bytes: int) -> None:
+        super().__init__(f"{url} is larger than {max_bytes} bytes (got at least {size})")
+        self.url = url
+        self.size = size
+        self.max_bytes = max_bytes
+
+
+SNIFF_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+# Config keys that child sources get from their parent unless they set their own
+INHERITED_KEYS = ("transcode", "http")
+
+
+def _instrumented(func: Callable[..., Awaitable[Image]]) -> Callable[..., Awaitable[Image]]:
+    method = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(self: 'AbstractSource', *args, **kwargs) -> Image:
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            image = await func(self, *args, **kwargs)
+            outcome = "ok"
+            return image
+        except CancelDisruption:
+            outcome = "cancelled"
+            raise
+        finally:
+            self.bot.metrics.observe_fetch(self.path, method, outcome,
+                                           time.perf_counter() - start)
+
+    return wrapper
+
+
+def _prepare_once(func: Callable[['AbstractSource'], Awaitable[None]]
+                  ) -> Callable[['AbstractSource'], Awaitable[None]]:
+    @functools.wraps(func)
+    async def wrapper(self: 'AbstractSource') -> None:
+        # Sources reused by a config reload are already prepared and must keep their state
+        if self.prepared:
+            return
+        await func(self)
+        self.prepared = True
+
+    return wrapper
+
+
 class DisruptionContext(NamedTuple):
     room_id: RoomID
     user_id: UserID
 
 
+class Readiness(Enum):
+    WARMING = "warming"
+    READY = "ready"
+    DEGRADED = "degraded"
+
+    @classmethod
+    def combine(cls, states: Iterable['Readiness']) -> 'Readiness':
+        states = set(states)
+        if cls.READY in states or not states:
+            return cls.READY
+        elif cls.WARMING in states:
+            return cls.WARMING
+        return cls.DEGRADED
+
+
 class AbstractSource(ABC):
     type_name: ClassVar[str] = None
     all: ClassVar[Dict[str, Type['AbstractSource']]] = {}
     bot: 'DisruptorBot'
     log: TraceLogger
     config: Dict[str, Any]
+    path: str
+    prepared: bool
+    generation: int
+    _http: Optional[HTTPClient]
+    _cache_writes: Deque[Callable[[], Awaitable[None]]]
+    _cache_writer: Optional[asyncio.Task]
+    _warmed: asyncio.Event
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        # Wrap fetch methods of all sources to measure how long they take and how they end
+        for name in ("fetch", "fetch_with_context"):
+            if name in cls.__dict__:
+                setattr(cls, name, _instrumented(cls.__dict__[name]))
+        if "prepare" in cls.__dict__:
+            cls.prepare = _prepare_once(cls.__dict__["prepare"])
 
     def __init__(self, bot: 'DisruptorBot', config: Dict[str, Any]) -> None:
         self.bot = bot
         self.log = bot.log.getChild("source").getChild(self.__class__.__name__.lower())
         self.config = config
+        self.path = self.__class__.__name__.lower()
+        self.prepared = False
+        # The config reload that built this source, see DisruptorBot.on_external_config_update
+        self.generation = bot.source_generation
+        self._http = None
+        self._cache_writes = deque()
+        self._cache_writer = None
+        self._warmed = asyncio.Event()
+        self._warmed.set()
+
+    @property
+    def config_hash(self) -> str:
+        data = json.dumps(self.config, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
 
     async def prepare(self) -> None:
         pass
 
+    async def stop(self) -> None:
+        await self.bot.tasks.cancel(self)
+        for child in self.children:
+            # Children from a newer generation were moved to a new tree by a config reload
+            if child.generation == self.generation:
+                await child.stop()
+        if self._http:
+            await self._http.close()
+            self._http = None
+
+    @property
+    def http(self) -> HTTPClient:
+        if self._http is None:
+            self._http = HTTPClient(self.bot.http, self.config.get("http"),
+                                    self.log.getChild("http"))
+        return self._http
+
+    @property
+    def readiness(self) -> Readiness:
+        return Readiness.READY
+
+    @property
+    def warming(self) -> bool:
+        """Whether the source is still doing the first fetches after being prepared."""
+        return not self._warmed.is_set()
+
+    @warming.setter
+    def warming(self, value: bool) -> None:
+        if value:
+            self._warmed.clear()
+        else:
+            self._warmed.set()
+
+    async def wait_until_warm(self) -> None:
+        """Wait until the source's readiness isn't ``WARMING`` anymore.
+
+        The readiness is checked again whenever a source in the tree finishes warming up, and
+        the wait ends early if no source in the tree is warming up anymore.
+        """
+        while self.readiness == Readiness.WARMING:
+            waits = [asyncio.create_task(node._warmed.wait())
+                     for node in self.walk() if node.warming]
+            if not waits:
+                return
+            try:
+                await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for wait in waits:
+                    wait.cancel()
+
+    @property
+    def cache_depth(self) -> Optional[int]:
+        """The number of entries in the source's buffer, if it has one."""
+        return None
+
+    @property
+    def children(self) -> List['AbstractSource']:
+        return []
+
+    def walk(self) -> Iterator['AbstractSource']:
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    @_instrumented
     async def fetch_with_context(self, ctx: DisruptionContext) -> Image:
         return await self.fetch()
 
@@ -79,6 +260,61 @@ class AbstractSource(ABC):
         type_cls = cls.all[config["type"].lower()]
         return type_cls(bot, config.get("config", {}))
 
+    def _create_child(self, config: Dict[str, Any], prefix: str = "") -> 'AbstractSource':
+        config = {**config, "config": dict(config.get("config") or {})}
+        for key in INHERITED_KEYS:
+            if key in self.config:
+                config["config"].setdefault(key, self.config[key])
+        source = AbstractSource.create(self.bot, config)
+        name = f"{prefix}{type(source).__name__.lower()}"
+        path = f"{self.path}/{name}"
+        reusable = self.bot.reusable_sources.get((path, source.config_hash))
+        if reusable:
+            self.log.debug(f"Reusing {path} from previous config")
+            return reusable
+        source.log = self.log.getChild(name)
+        source.path = path
+        return source
+
+    @property
+    def _persist_cache(self) -> bool:
+        return self.config.get("persist_cache", True)
+
+    async def _load_cached_images(self) -> List[Image]:
+        if not self._persist_cache:
+            return []
+        try:
+            return await self.bot.db.get_cached_images(self.path, self.config_hash)
+        except Exception:
+            self.log.exception("Failed to load persisted cache")
+            return []
+
+    def _store_cached_image(self, image: Image) -> None:
+        if self._persist_cache:
+            self._write_cache(functools.partial(self.bot.db.add_cached_image, self.path,
+                                                self.config_hash, image))
+
+    def _forget_cached_image(self, image: Image) -> None:
+        if self._persist_cache:
+            self._write_cache(functools.partial(self.bot.db.remove_cached_image, self.path,
+                                                image.url))
+
+    def _write_cache(self, write: Callable[[], Awaitable[None]]) -> None:
+        # Writes go through a single task so that e.g. removing an image can't overtake
+        # storing it. The task belongs to this source, so it's cancelled when it's stopped.
+        self._cache_writes.append(write)
+        if self._cache_writer is None or self._cache_writer.done():
+            self._cache_writer = self.bot.tasks.spawn(self, self._run_cache_writes(),
+                                                      limited=False)
+
+    async def _run_cache_writes(self) -> None:
+        while self._cache_writes:
+            write = self._cache_writes.popleft()
+            try:
+                await write()
+            except Exception:
+                self.log.exception("Failed to update persisted cache")
+
     @staticmethod
     def _get_filename(url: URL, resp: ClientResponse, mimetype: str) -> str:
         filename = None
@@ -93,36 +329,261 @@ class AbstractSource(ABC):
             filename += mimetypes.guess_extension(mimetype) or ""
         return filename
 
+    @property
+    def _max_bytes(self) -> Optional[int]:
+        return self.config.get("max_bytes")
+
+    def _check_size(self, url: URL, size: int) -> None:
+        if self._max_bytes and size > self._max_bytes:
+            raise MediaTooLarge(url, size, self._max_bytes)
+
+    @property
+    def _local_thumbnails(self) -> bool:
+        return bool(Pillow and self.config.get("local_thumbnails", False))
+
+    @property
+    def _strip_metadata(self) -> bool:
+        return self.config.get("strip_metadata", False)
+
+    @property
+    def _transcode(self) -> Optional[Dict[str, Any]]:
+        cfg = self.config.get("transcode")
+        if not cfg or not Pillow:
+            return None
+        return {
+            "max_width": cfg.get("max_width", 1920),
+            "max_height": cfg.get("max_height", 1920),
+            "format": cfg.get("format", "jpeg"),
+            "quality": cfg.get("quality", 85),
+        }
+
+    async def _process(self, url: URL, data: bytes, info: ImageInfo) -> bytes:
+        """Apply the configured transcoding or metadata stripping to a downloaded image."""
+        transcode_cfg = self._transcode
+        if transcode_cfg:
+            try:
+                result = await self.bot.workers.run(transcode, data, info.mimetype,
+                                                    **transcode_cfg)
+            except Exception as e:
+                self.log.debug(f"Couldn't transcode {url}: {e}")
+            else:
+                if result:
+                    self.log.debug(f"Transcoded {url} from {info.width}x{info.height} "
+                                   f"{info.mimetype} ({len(data)} bytes) to {result.width}x"
+                                   f"{result.height} {result.mimetype} ({len(result.data)} bytes)")
+                    info.mimetype = result.mimetype
+                    info.width, info.height = result.width, result.height
+                    info.size = len(result.data)
+                    # Re-encoding drops the metadata anyway
+                    return result.data
+        if self._strip_metadata and info.mimetype == "image/jpeg":
+            data = await self.bot.workers.run(strip_jpeg_metadata, data)
+            info.size = len(data)
+        return data
+
+    @staticmethod
+    def _fix_extension(title: str, mimetype: str) -> str:
+        base, ext = os.path.splitext(title)
+        guessed, _ = mimetypes.guess_type(title)
+        if guessed and guessed.startswith("image/") and guessed != mimetype:
+            return base + (mimetypes.guess_extension(mimetype) or ext)
+        return title
+
+    async def _upload_local_thumbnail(self, url: URL, data: bytes, info: ImageInfo
+                                      ) -> Optional[str]:
+        """Generate a thumbnail from already downloaded image data and upload it.
+
+        Returns:
+            The blurhash of the image, or ``None`` if the thumbnail couldn't be generated.
+        """
+        try:
+            thumbnail = await self.bot.workers.run(make_thumbnail, data,
+                                                   self.config.get("thumbnail_size", 320))
+        except Exception as e:
+            self.log.debug(f"Couldn't generate thumbnail for {url}: {e}")
+            return None
+        thumbnail_info = ImageInfo(mimetype=thumbnail.mimetype, size=len(thumbnail.data),
+                                   width=thumbnail.width, height=thumbnail.height)
+        sha256 = hashlib.sha256(thumbnail.data).hexdigest()
+        index = self.bot.media_index
+        existing = index.get(sha256) if index else None
+        if existing:
+            info.thumbnail_url = existing.url
+        else:
+            info.thumbnail_url = await self.bot.client.upload_media(thumbnail.data,
+                                                                    thumbnail.mimetype)
+            self.bot.metrics.transferred_bytes.inc(thumbnail_info.size, source=self.path,
+                                                   direction="upload")
+            if index:
+                index.put(sha256, info.thumbnail_url, thumbnail_info)
+        info.thumbnail_info = thumbnail_info
+        return thumbnail.blurhash
+
+    @staticmethod
+    async def _read_head(resp: ClientResponse) -> bytes:
+        head = b""
+        while len(head) < SNIFF_SIZE:
+            chunk = await resp.content.read(SNIFF_SIZE - len(head))
+            if not chunk:
+                break
+            head += chunk
+        return head
+
+    async def _read_body(self, url: URL, resp: ClientResponse, head: bytes, hasher: Any
+                         ) -> AsyncIterator[bytes]:
+        hasher.update(head)
+        yield head
+        received = len(head)
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            received += len(chunk)
+            self._check_size(url, received)
+            hasher.update(chunk)
+            yield chunk
+
+    def _media_hash(self, sha256: str) -> str:
+        if self._transcode:
+            # The same input gives different output with different settings
+            settings = json.dumps(self._transcode, sort_keys=True)
+            return hashlib.sha256(f"{sha256}:{settings}".encode("utf-8")).hexdigest()
+        return sha256
+
+    async def _upload_buffered(self, url: URL, data: bytes, info: ImageInfo, sha256: str
+                               ) -> Tuple[ContentURI, ImageInfo, bytes]:
+        """Upload a fully downloaded file, or reuse an earlier upload of the same bytes.
+
+        Returns:
+            The content URI, the info of the uploaded file and the uploaded data.
+        """
+        metrics = self.bot.metrics
+        index = self.bot.media_index
+        media_hash = self._media_hash(sha256)
+        existing = index.get(media_hash) if index else None
+        if existing:
+            self.log.debug(f"Reusing {existing.url} for {url} (same content hash, "
+                           f"{index.hits} hits / {index.misses} misses, "
+                           f"{index.saved_bytes} bytes saved)")
+            return existing.url, existing.copy_info(), data
+        data = await self._process(url, data, info)
+        upload_start = time.perf_counter()
+        mxc = await self.bot.client.upload_media(data, info.mimetype)
+        metrics.upload_latency.observe(time.perf_counter() - upload_start, source=self.path)
+        metrics.transferred_bytes.inc(info.size, source=self.path, direction="upload")
+        if index:
+            index.put(media_hash, mxc, info)
+        return mxc, info, data
+
     async def _reupload(self, url: URL, title: Optional[str] = None, blurhash: Optional[str] = None,
                         dimensions: Optional[Tuple[int, int]] = None,
                         external_url: Optional[str] = None,
                         thumbnail_url: Optional[URL] = None,
                         thumbnail_dimensions: Optional[Tuple[int, int]] = None,
-                        headers: Optional[Dict[str, str]] = None) -> Image:
+                        headers: Optional[Dict[str, str]] = None,
+                        download_buffer: Optional[DownloadBuffer] = None) -> Image:
         self.log.debug(f"Reuploading {title} from {url}")
         info = ImageInfo()
+        headers = dict(headers or {})
         if "user_agent" in self.config:
             headers["User-Agent"] = self.config["user_agent"]
-        async with self.bot.http.get(url, headers=headers) as resp:
-            data = await resp.read()
-            info.size = len(data)
-            info.mimetype = resp.headers["Content-Type"]
-            if not info.mimetype:
-                info.mimetype = magic.from_buffer(data, mime=True)
-            if not title:
-                title = self._get_filename(url, resp, info.mimetype)
-        if dimensions:
-            info.width, info.height = dimensions
-        elif Pillow:
-            img = Pillow.open(BytesIO(data))
-            info.width, info.height = img.size
-        mxc = await self.bot.client.upload_media(data, info.mimetype)
-        if thumbnail_url:
-            thumbnail = await self._reupload(thumbnail_url, title=title, headers=headers,
-                                             dimensions=thumbnail_dimensions)
-            info.thumbnail_url = thumbnail.url
-            info.thumbnail_info = thumbnail.info
+        thumbnail_task = None
+        local_thumbnail = self._local_thumbnails
+        if thumbnail_url and not local_thumbnail:
+            # The thumbnail doesn't depend on the main image, so transfer both at the same time
+            thumbnail_task = asyncio.create_task(self._reupload(
+                thumbnail_url, title=title, headers=headers, dimensions=thumbnail_dimensions,
+                download_buffer=download_buffer))
+        try:
+            downloaded = download_buffer.get(url) if download_buffer else None
+            if downloaded:
+                title = title or downloaded.title
+                info = ImageInfo(mimetype=downloaded.mimetype, size=len(downloaded.data),
+                                 width=downloaded.width, height=downloaded.height)
+                mxc, info, data = await self._upload_buffered(
+                    url, downloaded.data, info, hashlib.sha256(downloaded.data).hexdigest())
+            else:
+                mxc, info, title, data = await self._download_and_upload(
+                    url, info, title, dimensions, headers, download_buffer)
+            if local_thumbnail and data is not None:
+                local_blurhash = await self._upload_local_thumbnail(url, data, info)
+                blurhash = blurhash or local_blurhash
+            if thumbnail_task:
+                thumbnail = await thumbnail_task
+                info.thumbnail_url = thumbnail.url
+                info.thumbnail_info = thumbnail.info
+        except BaseException:
+            if thumbnail_task:
+                thumbnail_task.cancel()
+            raise
+        title = self._fix_extension(title, info.mimetype)
         if blurhash:
             info["blurhash"] = blurhash
             info["xyz.amorgan.blurhash"] = blurhash
         return Image(url=mxc, info=info, title=title, external_url=external_url)
+
+    async def _download_and_upload(self, url: URL, info: ImageInfo, title: Optional[str],
+                                   dimensions: Optional[Tuple[int, int]],
+                                   headers: Dict[str, str],
+                                   download_buffer: Optional[DownloadBuffer]
+                                   ) -> Tuple[ContentURI, ImageInfo, str, Optional[bytes]]:
+        """Download a file and upload it to the homeserver.
+
+        Returns:
+            The content URI, the info of the uploaded file, the title and the uploaded data
+            (``None`` if the upload was streamed).
+        """
+        metrics = self.bot.metrics
+        download_start = time.perf_counter()
+        async with self.http.get(url, headers=headers) as resp:
+            resp.raise_for_status()
+            if resp.content_length is not None:
+                self._check_size(url, resp.content_length)
+            # Only the first few kilobytes are needed to find the type and dimensions
+            head = await self._read_head(resp)
+            info.mimetype = resp.content_type
+            if not info.mimetype or info.mimetype == "application/octet-stream":
+                info.mimetype = await self.bot.workers.run(magic.from_buffer, head, mime=True)
+            if dimensions:
+                info.width, info.height = dimensions
+            elif Pillow:
+                try:
+                    info.width, info.height = await self.bot.workers.run(image_size, head)
+                except Exception:
+                    self.log.debug(f"Couldn't find dimensions of {url} in first "
+                                   f"{len(head)} bytes")
+            if not title:
+                title = self._get_filename(url, resp, info.mimetype)
+            hasher = hashlib.sha256()
+            body = self._read_body(url, resp, head, hasher)
+            # Local processing and sharing downloads need the whole file,
+            # so they can't be combined with streaming
+            stream = (self.config.get("stream_uploads", False) and not self._local_thumbnails
+                      and not self._strip_metadata and not self._transcode
+                      and not download_buffer)
+            if stream and resp.content_length is not None:
+                # Streamed uploads can't be deduplicated before uploading, but they're still
+                # indexed so that buffered reuploads of the same bytes can reuse them.
+                info.size = resp.content_length
+                metrics.download_latency.observe(time.perf_counter() - download_start,
+                                                 source=self.path)
+                upload_start = time.perf_counter()
+                mxc = await self.bot.client.upload_media(body, info.mimetype, size=info.size)
+                metrics.upload_latency.observe(time.perf_counter() - upload_start,
+                                               source=self.path)
+                metrics.transferred_bytes.inc(info.size, source=self.path, direction="download")
+                metrics.transferred_bytes.inc(info.size, source=self.path, direction="upload")
+                if self.bot.media_index:
+                    self.bot.media_index.put(hasher.hexdigest(), mxc, info)
+                return mxc, info, title, None
+            # Grow one buffer instead of keeping every chunk around until the end
+            data = bytearray()
+            async for chunk in body:
+                data += chunk
+            info.size = len(data)
+            metrics.download_latency.observe(time.perf_counter() - download_start,
+                                             source=self.path)
+            metrics.transferred_bytes.inc(info.size, source=self.path, direction="download")
+            if download_buffer:
+                download_buffer.put(url, DownloadedMedia(data=data, mimetype=info.mimetype,
+                                                         width=info.width, height=info.height,
+                                                         title=title))
+            mxc, info, data = await self._upload_buffered(url, data, info, hasher.hexdigest())
+            return mxc, info, title, data
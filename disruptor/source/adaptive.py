@@ -0,0 +1,104 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+import math
+import random
+import time
+
+from .budget import DemandEstimator
+
+
+class RefillController:
+    """Decides how many images a cache should hold and how fast to refill it.
+
+    Demand is tracked with a :class:`DemandEstimator` and refill latency as a moving
+    average of successful child fetches. While an image is being refilled, the number of
+    fetches arriving is roughly Poisson distributed with mean ``rate * latency``, so the target
+    size is the smallest size for which running out before the refill lands is less likely
+    than ``empty_probability``.
+    """
+
+    min_size: int
+    max_size: int
+    empty_probability: float
+    max_concurrency: int
+    retry_backoff: float
+    max_retry_backoff: float
+
+    demand: DemandEstimator
+    latency: float
+    failures: int
+    retry_at: float
+
+    def __init__(self, min_size: int = 2, max_size: int = 20, empty_probability: float = 0.01,
+                 max_concurrency: int = 4, rate_window: float = 300, initial_latency: float = 1,
+                 retry_backoff: float = 1, max_retry_backoff: float = 300) -> None:
+        self.min_size = max(0, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.empty_probability = empty_probability
+        self.max_concurrency = max(1, max_concurrency)
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.demand = DemandEstimator(rate_window)
+        self.latency = initial_latency
+        self.failures = 0
+        self.retry_at = 0
+
+    @property
+    def rate(self) -> float:
+        """The estimated number of fetches per second."""
+        return self.demand.current
+
+    def record_demand(self) -> None:
+        self.demand.record()
+
+    def record_success(self, duration: float) -> None:
+        self.latency += 0.2 * (duration - self.latency)
+        self.failures = 0
+        self.retry_at = 0
+
+    def record_failure(self) -> None:
+        delay = min(self.retry_backoff * 2 ** self.failures, self.max_retry_backoff)
+        self.failures += 1
+        self.retry_at = time.monotonic() + delay * random.uniform(0.5, 1)
+
+    @property
+    def retry_delay(self) -> float:
+        """Seconds to wait before refilling again after failed fetches."""
+        return max(0.0, self.retry_at - time.monotonic())
+
+    @property
+    def target_size(self) -> int:
+        expected = self.rate * self.latency
+        # P(N >= size) for N ~ Poisson(expected), accumulated one size at a time
+        term = math.exp(-expected)
+        below = 0.0
+        for size in range(self.max_size):
+            if size >= self.min_size and 1 - below < self.empty_probability:
+                return size
+            below += term
+            term *= expected / (size + 1)
+        return self.max_size
+
+    @property
+    def concurrency(self) -> int:
+        # Enough parallel refills to keep up with demand, with headroom for bursts
+        wanted = math.ceil(2 * self.rate * self.latency)
+        if self.failures:
+            # Don't hammer a failing child with parallel requests
+            wanted = 1
+        return min(self.max_concurrency, max(1, wanted))
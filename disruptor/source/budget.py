@@ -0,0 +1,114 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import ClassVar, Mapping
+import asyncio
+import math
+import time
+
+
+class RateLimitBudget:
+    """Spreads the requests of one API key evenly over its rate limit window.
+
+    Budgets are shared by every source in the process that uses the same key, so several
+    sources with the same key don't use up each other's quota.
+    """
+
+    _budgets: ClassVar[dict[str, RateLimitBudget]] = {}
+
+    window: float
+    reserve: int
+    limit: int | None
+    remaining: int | None
+    window_end: float
+    next_slot: float
+    lock: asyncio.Lock
+
+    def __init__(self, window: float = 3600, reserve: int = 5) -> None:
+        self.window = window
+        self.reserve = reserve
+        self.limit = None
+        self.remaining = None
+        self.window_end = time.monotonic() + window
+        self.next_slot = 0
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    def get(cls, key: str, window: float = 3600, reserve: int = 5) -> RateLimitBudget:
+        try:
+            return cls._budgets[key]
+        except KeyError:
+            budget = cls._budgets[key] = cls(window, reserve)
+            return budget
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        try:
+            limit = int(headers["x-ratelimit-limit"])
+            remaining = int(headers["x-ratelimit-remaining"])
+        except (KeyError, ValueError):
+            return
+        now = time.monotonic()
+        if self.remaining is None or remaining > self.remaining or now > self.window_end:
+            # The quota was reset, so a new window started around the previous request
+            self.window_end = now + self.window
+        self.limit = limit
+        self.remaining = remaining
+
+    @property
+    def interval(self) -> float:
+        """The number of seconds to wait between requests to last until the end of the window."""
+        now = time.monotonic()
+        if self.remaining is None or now > self.window_end:
+            return 0
+        usable = self.remaining - self.reserve
+        if usable <= 0:
+            return self.window_end - now
+        return (self.window_end - now) / usable
+
+    async def acquire(self) -> None:
+        """Wait until the next request slot is available and claim it."""
+        async with self.lock:
+            delay = self.next_slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_slot = time.monotonic() + self.interval
+
+
+class DemandEstimator:
+    """Estimates the rate of fetches per second with an exponentially decaying average."""
+
+    time_constant: float
+    rate: float
+    updated_at: float
+
+    def __init__(self, time_constant: float = 600) -> None:
+        self.time_constant = time_constant
+        self.rate = 0
+        self.updated_at = time.monotonic()
+
+    def _decay(self, now: float) -> None:
+        self.rate *= math.exp(-(now - self.updated_at) / self.time_constant)
+        self.updated_at = now
+
+    def record(self, count: int = 1) -> None:
+        self._decay(time.monotonic())
+        self.rate += count / self.time_constant
+
+    @property
+    def current(self) -> float:
+        self._decay(time.monotonic())
+        return self.rate
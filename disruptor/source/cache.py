@@ -13,58 +13,131 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Deque
+from typing import Deque, List, Optional, Set
 from collections import deque
 import asyncio
+import time
 
-from mautrix.util import background_task
-
-from .abstract import AbstractSource, CancelDisruption, Image
+from .abstract import AbstractSource, CancelDisruption, SourceUnavailable, Image, Readiness
+from .adaptive import RefillController
 
 
 class Cache(AbstractSource):
     source: AbstractSource
     cache: Deque[Image]
-    fetch_errors: int
+    warming: bool
+    controller: RefillController
+    refills: Set[asyncio.Task]
+    wakeup: asyncio.Event
 
     async def prepare(self) -> None:
-        self.source = AbstractSource.create(self.bot, self.config)
-        self.source.log = self.log.getChild(self.source.__class__.__name__.lower())
+        self.source = self._create_child(self.config)
         await self.source.prepare()
-        self.cache = deque(maxlen=self.config.get("size", 5))
+        self.controller = RefillController(
+            min_size=self.config.get("min_size", 2),
+            max_size=self.config.get("max_size", self.config.get("size", 5)),
+            empty_probability=self.config.get("empty_probability", 0.01),
+            max_concurrency=self.config.get("refill_concurrency", 4),
+            rate_window=self.config.get("rate_window", 300),
+            retry_backoff=self.config.get("retry_backoff", 1),
+            max_retry_backoff=self.config.get("max_retry_backoff", 300))
+        self.cache = deque(maxlen=self.controller.max_size)
+        for image in await self._load_cached_images():
+            self._push(image)
+        self.refills = set()
+        self.wakeup = asyncio.Event()
+        self.warming = True
+        self.bot.tasks.spawn(self, self._run_refiller(), limited=False)
+
+    @property
+    def readiness(self) -> Readiness:
+        if len(self.cache) > 0:
+            return Readiness.READY
+        elif self.warming:
+            return Readiness.WARMING
+        return Readiness.DEGRADED
+
+    @property
+    def cache_depth(self) -> int:
+        return len(self.cache)
+
+    @property
+    def children(self) -> List[AbstractSource]:
+        return [self.source]
+
+    async def _run_refiller(self) -> None:
+        await self.source.wait_until_warm()
+        target = self.controller.target_size
+        self.log.debug(f"Loaded {len(self.cache)} persisted images, "
+                       f"fetching {max(0, target - len(self.cache))} images to fill cache")
         initial_fetch_sleep = self.config.get("initial_fetch_sleep", 0)
-        self.fetch_errors = 0
-        self.log.debug(f"Fetching {self.cache.maxlen} images to fill cache")
-        for i in range(self.cache.maxlen):
-            await self.fetch_to_cache()
-            if initial_fetch_sleep:
-                await asyncio.sleep(initial_fetch_sleep)
+        start = asyncio.get_running_loop().time()
+        started = 0
+        while True:
+            self.wakeup.clear()
+            retry_delay = self.controller.retry_delay
+            if retry_delay == 0:
+                target = self.controller.target_size
+                concurrency = self.controller.concurrency
+                missing = target - len(self.cache) - len(self.refills)
+                while missing > 0 and len(self.refills) < concurrency:
+                    not_before = start + started * initial_fetch_sleep if self.warming else 0
+                    task = self.bot.tasks.spawn(self, self._refill(not_before), limited=False)
+                    self.refills.add(task)
+                    started += 1
+                    missing -= 1
+            if self.warming and not self.refills:
+                self.warming = False
+                self.log.debug(f"Cache warmed up with {len(self.cache)} images")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=retry_delay or None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refill(self, not_before: float = 0) -> None:
+        try:
+            delay = not_before - asyncio.get_running_loop().time()
+            if delay > 0:
+                # Stagger warm-up fetches without holding a slot of the global task limit
+                await asyncio.sleep(delay)
+            async with self.bot.tasks.slot():
+                start = time.monotonic()
+                image = await self._fetch_from_source()
+            if image is None:
+                self.controller.record_failure()
+                self.log.debug(f"Retrying refill in {self.controller.retry_delay:.1f} seconds "
+                               f"({self.controller.failures} consecutive failures)")
+                return
+            self.controller.record_success(time.monotonic() - start)
+            self._push(image)
+            self._store_cached_image(image)
+            self.log.debug(f"Got image for cache, size is now {len(self.cache)}, "
+                           f"target is {self.controller.target_size}")
+        finally:
+            self.refills.discard(asyncio.current_task())
+            self.wakeup.set()
 
-    async def fetch_to_cache(self) -> None:
+    async def _fetch_from_source(self) -> Optional[Image]:
         try:
-            image = await self.source.fetch()
+            return await self.source.fetch()
         except CancelDisruption:
             self.log.warning("Child cancelled fetch to fill cache")
-            self.fetch_errors += 1
         except Exception:
             self.log.exception("Child threw error trying to fetch image to fill cache")
-            self.fetch_errors += 1
-        else:
-            self.cache.appendleft(image)
-            self.log.debug(f"Got image for cache, size is now {len(self.cache)}")
-            if self.fetch_errors > 0:
-                self.log.debug("Fetching additional image after successful fetch "
-                               "to cover earlier error")
-                self.fetch_errors -= 1
-                background_task.create(self.fetch_to_cache())
+        return None
+
+    def _push(self, image: Image) -> None:
+        if len(self.cache) == self.cache.maxlen:
+            self._forget_cached_image(self.cache[-1])
+        self.cache.appendleft(image)
 
     async def fetch(self) -> Image:
+        self.controller.record_demand()
+        self.wakeup.set()
         try:
             image = self.cache.pop()
         except IndexError:
             self.log.error("Cache is empty, canceling disruption")
-            # TODO try refetching at some point
-            raise CancelDisruption()
-        self.log.debug("Fetching image to refill cache")
-        background_task.create(self.fetch_to_cache())
+            raise SourceUnavailable(self.path)
+        self._forget_cached_image(image)
         return image
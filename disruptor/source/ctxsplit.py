@@ -13,51 +13,149 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, List, Tuple, ClassVar
+from typing import (Optional, List, Tuple, Dict, Set, Pattern, FrozenSet, Iterable, Callable,
+                    ClassVar)
+from functools import lru_cache
+import fnmatch
+import re
 
 from attr import dataclass
 from mautrix.types import RoomID, UserID
 
-from .abstract import AbstractSource, Image, DisruptionContext, CancelDisruption
+from .abstract import AbstractSource, Image, DisruptionContext, CancelDisruption, Readiness
+
+
+def _server_name(mxid: str) -> str:
+    return mxid.split(":", 1)[1] if ":" in mxid else ""
+
+
+def _compile_patterns(globs: Optional[List[str]], regexes: Optional[List[str]]
+                      ) -> Optional[Pattern]:
+    parts = [fnmatch.translate(glob) for glob in globs or []]
+    parts += [f"(?:{regex})\\Z" for regex in regexes or []]
+    return re.compile("|".join(parts)) if parts else None
 
 
 @dataclass
 class PartialDisruptionContext:
     room_id: Optional[RoomID] = None
     room_ids: Optional[List[RoomID]] = None
+    room_globs: Optional[List[str]] = None
+    room_regexes: Optional[List[str]] = None
+    room_servers: Optional[List[str]] = None
     user_id: Optional[UserID] = None
-    user_ids: Optional[List[RoomID]] = None
+    user_ids: Optional[List[UserID]] = None
+    user_globs: Optional[List[str]] = None
+    user_regexes: Optional[List[str]] = None
+    user_servers: Optional[List[str]] = None
+
+    @property
+    def exact_rooms(self) -> Optional[Set[RoomID]]:
+        return self._exact(self.room_id, self.room_ids)
+
+    @property
+    def exact_users(self) -> Optional[Set[UserID]]:
+        return self._exact(self.user_id, self.user_ids)
+
+    @staticmethod
+    def _exact(single: Optional[str], multiple: Optional[List[str]]) -> Optional[Set[str]]:
+        if single is None:
+            return set(multiple) if multiple is not None else None
+        # When both are set, the ID has to be the single one and be in the list
+        return {single} if multiple is None or single in multiple else set()
+
+
+class _DimensionIndex:
+    """Maps a room or user ID to the set of rules whose condition on that ID it satisfies.
+
+    A rule can list exact IDs, server names, globs and regexes, and it matches if any of them
+    match. Rules that don't constrain the dimension at all match every ID.
+    """
 
-    def matches(self, ctx: DisruptionContext) -> bool:
-        if self.room_id is not None and ctx.room_id != self.room_id:
-            return False
-        elif self.room_ids is not None and ctx.room_id not in self.room_ids:
-            return False
-        if self.user_id is not None and ctx.user_id != self.user_id:
-            return False
-        elif self.user_ids is not None and ctx.user_id not in self.user_ids:
-            return False
-        return True
+    unconstrained: Set[int]
+    exact: Dict[str, Set[int]]
+    servers: Dict[str, Set[int]]
+    patterns: List[Tuple[int, Pattern]]
+    lookup: Callable[[str], FrozenSet[int]]
+
+    def __init__(self) -> None:
+        self.unconstrained = set()
+        self.exact = {}
+        self.servers = {}
+        self.patterns = []
+        self.lookup = lru_cache(maxsize=4096)(self._lookup)
+
+    def add(self, rule: int, exact: Optional[Set[str]], servers: Optional[List[str]],
+            pattern: Optional[Pattern]) -> None:
+        if exact is None and servers is None and pattern is None:
+            self.unconstrained.add(rule)
+            return
+        for item in exact or ():
+            self.exact.setdefault(item, set()).add(rule)
+        for server in servers or ():
+            self.servers.setdefault(server, set()).add(rule)
+        if pattern is not None:
+            self.patterns.append((rule, pattern))
+
+    def _lookup(self, mxid: str) -> FrozenSet[int]:
+        rules = set(self.unconstrained)
+        rules.update(self.exact.get(mxid, ()))
+        rules.update(self.servers.get(_server_name(mxid), ()))
+        rules.update(rule for rule, pattern in self.patterns if pattern.match(mxid))
+        return frozenset(rules)
 
 
 class ContextSplit(AbstractSource):
+    """Routes disruptions to the first source whose context matches the room and user.
+
+    The per-source contexts are compiled into hash indexes when the source is prepared, so
+    routing doesn't get slower as the number of listed rooms and users grows.
+    """
+
     type_name: ClassVar[str] = "context_split"
     sources: List[Tuple[PartialDisruptionContext, AbstractSource]]
+    room_index: _DimensionIndex
+    user_index: _DimensionIndex
 
     async def prepare(self) -> None:
         self.sources = []
+        self.room_index = _DimensionIndex()
+        self.user_index = _DimensionIndex()
         for index, source_cfg in enumerate(self.config["sources"]):
-            source = AbstractSource.create(self.bot, source_cfg)
-            source_name = f"{index}_{type(source).__name__.lower()}"
-            source.log = self.log.getChild(source_name)
-            await source.prepare()
-            ctx = PartialDisruptionContext(**source_cfg["context"])
+            ctx = PartialDisruptionContext(**source_cfg.get("context", {}))
+            self.room_index.add(index, ctx.exact_rooms, ctx.room_servers,
+                                _compile_patterns(ctx.room_globs, ctx.room_regexes))
+            self.user_index.add(index, ctx.exact_users, ctx.user_servers,
+                                _compile_patterns(ctx.user_globs, ctx.user_regexes))
+            source = self._create_child(source_cfg, prefix=f"{index}_")
+            # Added before preparing so that it's stopped too if preparing the tree fails
             self.sources.append((ctx, source))
+            await source.prepare()
+
+    @property
+    def readiness(self) -> Readiness:
+        return Readiness.combine(source.readiness for _, source in self.sources)
+
+    @property
+    def children(self) -> List[AbstractSource]:
+        return [source for _, source in self.sources]
+
+    def matching_sources(self, ctx: DisruptionContext) -> Iterable[AbstractSource]:
+        """Get the sources whose context matches, in configuration order."""
+        matches = self.room_index.lookup(ctx.room_id) & self.user_index.lookup(ctx.user_id)
+        return (self.sources[index][1] for index in sorted(matches))
 
     async def fetch_with_context(self, ctx: DisruptionContext) -> Image:
-        for src_ctx, src in self.sources:
-            if src_ctx.matches(ctx):
-                return await src.fetch()
+        first_match = None
+        for src in self.matching_sources(ctx):
+            # Only sources that are still warming up are skipped, anything else keeps
+            # first-match-wins so that e.g. a degraded dedicated source isn't bypassed for good
+            if src.readiness != Readiness.WARMING:
+                return await src.fetch_with_context(ctx)
+            elif first_match is None:
+                first_match = src
+        if first_match is not None:
+            return await first_match.fetch_with_context(ctx)
         self.log.debug("Failed to disrupt: no sources matched context")
         raise CancelDisruption()
 
@@ -0,0 +1,200 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import ClassVar, NamedTuple
+import asyncio
+import hashlib
+import os
+import random
+
+from yarl import URL
+import magic
+
+from mautrix.types import ImageInfo
+
+from ..imaging import image_size
+from .abstract import AbstractSource, Image, SourceUnavailable, Readiness, Pillow, SNIFF_SIZE
+from .pipeline import RefillPipeline
+
+DEFAULT_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+
+
+class IndexedFile(NamedTuple):
+    path: str
+    mtime_ns: int
+    size: int
+    sha256: str
+    image: Image
+
+
+def scan_directory(root: str, recursive: bool, extensions: tuple[str, ...]
+                   ) -> dict[str, tuple[int, int]]:
+    """Find the image files in a directory.
+
+    Returns:
+        A dict from absolute file paths to their modification time (in ns) and size.
+    """
+    files = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        if not recursive:
+            dir_names.clear()
+        dir_names[:] = [name for name in dir_names if not name.startswith(".")]
+        for name in file_names:
+            if name.startswith(".") or not name.lower().endswith(extensions):
+                continue
+            path = os.path.join(dir_path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+class Directory(AbstractSource):
+    """Serves images from a local directory.
+
+    Every file is uploaded once and the resulting content URIs are stored in the database,
+    so fetches only pick a random entry from memory. The directory is rescanned periodically,
+    and only new or changed files are uploaded again.
+    """
+
+    type_name: ClassVar[str] = "directory"
+    root: str
+    recursive: bool
+    extensions: tuple[str, ...]
+    rescan_interval: float
+    files: dict[str, IndexedFile]
+    choices: list[Image]
+    pipeline: RefillPipeline
+    scan_lock: asyncio.Lock
+    warming: bool
+
+    async def prepare(self) -> None:
+        self.root = os.path.abspath(os.path.expanduser(self.config["path"]))
+        self.recursive = self.config.get("recursive", True)
+        self.extensions = tuple(ext.lower() for ext in
+                                self.config.get("extensions", DEFAULT_EXTENSIONS))
+        self.rescan_interval = self.config.get("rescan_interval", 600)
+        self.pipeline = RefillPipeline(self.config.get("upload_concurrency", 4))
+        self.scan_lock = asyncio.Lock()
+        try:
+            indexed = await self.bot.db.get_directory_files(self.path)
+        except Exception:
+            self.log.exception("Failed to load directory index")
+            indexed = []
+        self.files = {row[0]: IndexedFile(*row) for row in indexed}
+        self._update_choices()
+        self.log.debug(f"Loaded {len(self.files)} indexed files")
+        self.warming = True
+        self.bot.tasks.spawn(self, self._run_scanner(), limited=False)
+
+    @property
+    def readiness(self) -> Readiness:
+        if len(self.choices) > 0:
+            return Readiness.READY
+        elif self.warming:
+            return Readiness.WARMING
+        return Readiness.DEGRADED
+
+    @property
+    def cache_depth(self) -> int:
+        return len(self.choices)
+
+    def _update_choices(self) -> None:
+        self.choices = [file.image for file in self.files.values()]
+
+    async def _run_scanner(self) -> None:
+        while True:
+            try:
+                await self.scan()
+            except Exception:
+                self.log.exception(f"Failed to scan {self.root}")
+            finally:
+                self.warming = False
+            if not self.rescan_interval:
+                return
+            await asyncio.sleep(self.rescan_interval)
+
+    async def scan(self) -> None:
+        async with self.scan_lock:
+            found = await self.bot.workers.run(scan_directory, self.root, self.recursive,
+                                               self.extensions)
+            removed = [path for path in self.files if path not in found]
+            changed = [path for path, (mtime_ns, size) in found.items()
+                       if path not in self.files
+                       or self.files[path].mtime_ns != mtime_ns
+                       or self.files[path].size != size]
+            if removed:
+                for path in removed:
+                    del self.files[path]
+                self._update_choices()
+                await self.bot.db.remove_directory_files(self.path, removed)
+            if not changed:
+                self.log.debug(f"Scanned {self.root}: {len(found)} files, "
+                               f"{len(removed)} removed, nothing new")
+                return
+            self.log.info(f"Scanned {self.root}: {len(found)} files, {len(removed)} removed, "
+                          f"uploading {len(changed)} new or changed files")
+            jobs = (self._upload_file(path, *found[path]) for path in changed)
+            uploaded = 0
+            async for file in self.pipeline.run(jobs):
+                if isinstance(file, Exception):
+                    self.log.warning(f"Failed to upload file from {self.root}: {file}")
+                    continue
+                self.files[file.path] = file
+                await self.bot.db.put_directory_file(self.path, *file)
+                uploaded += 1
+            self._update_choices()
+            self.log.info(f"Uploaded {uploaded} files, now have {len(self.choices)} images")
+
+    async def _upload_file(self, path: str, mtime_ns: int, size: int) -> IndexedFile:
+        url = URL.build(scheme="file", path=path)
+        self._check_size(url, size)
+        data = await self.bot.workers.run(read_file, path)
+        sha256 = hashlib.sha256(data).hexdigest()
+        previous = self.files.get(path)
+        if previous and previous.sha256 == sha256:
+            # Only the mtime changed (e.g. the file was touched or copied again)
+            return previous._replace(mtime_ns=mtime_ns, size=size)
+        mimetype = await self.bot.workers.run(magic.from_buffer, data[:SNIFF_SIZE], mime=True)
+        info = ImageInfo(mimetype=mimetype, size=len(data))
+        if Pillow:
+            try:
+                info.width, info.height = await self.bot.workers.run(image_size, data)
+            except Exception:
+                self.log.debug(f"Couldn't find dimensions of {path}")
+        mxc, info, data = await self._upload_buffered(url, data, info, sha256)
+        if self._local_thumbnails:
+            blurhash = await self._upload_local_thumbnail(url, data, info)
+            if blurhash:
+                info["blurhash"] = blurhash
+                info["xyz.amorgan.blurhash"] = blurhash
+        title = self._fix_extension(os.path.basename(path), info.mimetype)
+        return IndexedFile(path=path, mtime_ns=mtime_ns, size=size, sha256=sha256,
+                           image=Image(title=title, url=mxc, info=info, external_url=None))
+
+    async def fetch(self) -> Image:
+        try:
+            return random.choice(self.choices)
+        except IndexError:
+            raise SourceUnavailable(self.path)
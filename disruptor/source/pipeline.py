@@ -0,0 +1,52 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import AsyncIterator, Awaitable, Iterable, TypeVar
+import asyncio
+
+T = TypeVar("T")
+
+
+class RefillPipeline:
+    """Runs refill jobs with bounded concurrency, yielding results in submission order.
+
+    Failed jobs yield their exception instead of a result, so one broken image doesn't stop the
+    rest of the refill.
+    """
+
+    concurrency: int
+
+    def __init__(self, concurrency: int = 4) -> None:
+        self.concurrency = max(1, concurrency)
+
+    async def run(self, jobs: Iterable[Awaitable[T]]) -> AsyncIterator[T | Exception]:
+        sema = asyncio.Semaphore(self.concurrency)
+
+        async def run_job(job: Awaitable[T]) -> T:
+            async with sema:
+                return await job
+
+        tasks = [asyncio.create_task(run_job(job)) for job in jobs]
+        try:
+            for task in tasks:
+                try:
+                    yield await task
+                except Exception as e:
+                    yield e
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -16,30 +16,161 @@
 from __future__ import annotations
 
 import random
+import time
 
-from .abstract import AbstractSource, Image, DisruptionContext
+from .abstract import (AbstractSource, Image, DisruptionContext, Readiness, CancelDisruption,
+                       SourceUnavailable)
+
+
+class AliasTable:
+    """Vose's alias method for sampling from a fixed discrete distribution in O(1)."""
+
+    indices: list[int]
+    prob: list[float]
+    alias: list[int]
+
+    def __init__(self, indices: list[int], weights: list[float]) -> None:
+        n = len(indices)
+        total = sum(weights)
+        scaled = [weight * n / total for weight in weights] if total > 0 else [1.0] * n
+        self.indices = indices
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        for i in small + large:
+            self.prob[i] = 1
+
+    def sample(self) -> int:
+        i = random.randrange(len(self.indices))
+        return self.indices[i if random.random() < self.prob[i] else self.alias[i]]
+
+
+class ChildHealth:
+    """Exponentially weighted error rate and latency of a child source.
+
+    Both values also decay towards zero with the given half-life, so a child that was avoided
+    after failing is tried again eventually instead of being shut out for good.
+    """
+
+    __slots__ = ("_error_rate", "_latency", "updated", "half_life")
+
+    _error_rate: float
+    _latency: float
+    updated: float
+    half_life: float
+
+    def __init__(self, half_life: float = 60) -> None:
+        self._error_rate = 0
+        self._latency = 0
+        self.updated = time.monotonic()
+        self.half_life = half_life
+
+    def _decay(self) -> float:
+        if self.half_life <= 0:
+            return 1
+        return 0.5 ** ((time.monotonic() - self.updated) / self.half_life)
+
+    @property
+    def error_rate(self) -> float:
+        return self._error_rate * self._decay()
+
+    @property
+    def latency(self) -> float:
+        return self._latency * self._decay()
+
+    def record(self, ok: bool, latency: float, alpha: float) -> None:
+        error_rate, current_latency = self.error_rate, self.latency
+        self._error_rate = error_rate + alpha * ((0 if ok else 1) - error_rate)
+        self._latency = current_latency + alpha * (latency - current_latency)
+        self.updated = time.monotonic()
 
 
 class Random(AbstractSource):
     sources: list[AbstractSource]
     weights: list[float]
+    health: list[ChildHealth]
+    samplers: dict[tuple[int, ...], AliasTable]
+    max_error_rate: float
+    max_latency: float
+    health_alpha: float
 
     async def prepare(self) -> None:
         self.sources = []
         int_weights: list[int] = []
         for index, source_cfg in enumerate(self.config["sources"]):
-            source = AbstractSource.create(self.bot, source_cfg)
-            source_name = f"{index}_{type(source).__name__.lower()}"
-            source.log = self.log.getChild(source_name)
-            await source.prepare()
+            source = self._create_child(source_cfg, prefix=f"{index}_")
+            # Added before preparing so that it's stopped too if preparing the tree fails
             self.sources.append(source)
+            await source.prepare()
             int_weights.append(source_cfg["weight"])
         weight_sum = sum(int_weights)
         self.weights = [weight / weight_sum for weight in int_weights]
+        self.health = [ChildHealth(self.config.get("health_half_life", 60))
+                       for _ in self.sources]
+        self.max_error_rate = self.config.get("max_error_rate", 0.5)
+        self.max_latency = self.config.get("max_latency", 10)
+        self.health_alpha = self.config.get("health_alpha", 0.2)
+        all_indices = tuple(range(len(self.sources)))
+        self.samplers = {all_indices: AliasTable(list(all_indices), self.weights)}
+
+    @property
+    def readiness(self) -> Readiness:
+        return Readiness.combine(source.readiness for source in self.sources)
+
+    @property
+    def children(self) -> list[AbstractSource]:
+        return self.sources
+
+    def _can_answer(self, index: int) -> bool:
+        source, health = self.sources[index], self.health[index]
+        return (source.readiness == Readiness.READY
+                and source.cache_depth != 0
+                and health.error_rate <= self.max_error_rate
+                and health.latency <= self.max_latency)
+
+    def _sampler(self, indices: tuple[int, ...]) -> AliasTable:
+        try:
+            return self.samplers[indices]
+        except KeyError:
+            sampler = self.samplers[indices] = AliasTable(list(indices),
+                                                          [self.weights[i] for i in indices])
+            return sampler
 
     async def fetch_with_context(self, ctx: DisruptionContext | None = None) -> Image:
-        source = random.choices(self.sources, self.weights, k=1)[0]
-        return await source.fetch_with_context(ctx)
+        remaining = set(range(len(self.sources)))
+        while remaining:
+            candidates = tuple(i for i in sorted(remaining) if self._can_answer(i))
+            # If nothing looks healthy, still try the others rather than giving up
+            index = self._sampler(candidates or tuple(sorted(remaining))).sample()
+            remaining.discard(index)
+            source, health = self.sources[index], self.health[index]
+            start = time.monotonic()
+            try:
+                image = await source.fetch_with_context(ctx)
+            except SourceUnavailable:
+                health.record(False, time.monotonic() - start, self.health_alpha)
+                self.log.debug(f"{source.path} is unavailable, failing over to another source")
+                continue
+            except CancelDisruption:
+                # Deliberate cancellations (e.g. a noop source) are part of the configured weights
+                health.record(True, time.monotonic() - start, self.health_alpha)
+                raise
+            except Exception:
+                health.record(False, time.monotonic() - start, self.health_alpha)
+                self.log.exception(f"{source.path} failed to fetch, "
+                                   "failing over to another source")
+                continue
+            health.record(True, time.monotonic() - start, self.health_alpha)
+            return image
+        # Every child failed, which the bot can cover by recycling an earlier image
+        raise SourceUnavailable(self.path)
 
     async def fetch(self) -> Image:
         return await self.fetch_with_context(None)
@@ -13,73 +13,223 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Set, List
+from typing import Deque, Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
 import asyncio
 
 from yarl import URL
 import aiohttp
 
-from mautrix.util import background_task
+from .abstract import AbstractSource, Image, SourceUnavailable, Readiness
 
-from .abstract import AbstractSource, Image, CancelDisruption
+LISTING_URL = URL("https://www.reddit.com/r/")
 
 
 class Reddit(AbstractSource):
     reload_lock: asyncio.Lock
-    subreddit: str
-    handled_ids: Set[str]
-    cache: List[dict]
+    prefetch_lock: asyncio.Lock
+    subreddits: List[str]
+    seen_ids: 'OrderedDict[str, None]'
+    dedup_size: int
+    cache: Deque[dict]
+    ready: Deque[Image]
+    min_cache_size: int
+    prefetch_size: int
+    max_pages: int
+    cursors: Dict[str, Optional[str]]
+    validators: Dict[URL, Tuple[Optional[str], Optional[str]]]
+    warming: bool
 
     async def prepare(self) -> None:
         self.reload_lock = asyncio.Lock()
-        self.handled_ids = set()
-        self.subreddit = self.config["subreddit"]
+        self.prefetch_lock = asyncio.Lock()
+        self.seen_ids = OrderedDict()
+        self.dedup_size = self.config.get("dedup_size", 10000)
+        self.cache = deque()
+        self.ready = deque()
+        self.min_cache_size = self.config.get("min_cache_size", 5)
+        self.prefetch_size = self.config.get("prefetch", 3)
+        self.max_pages = self.config.get("max_pages", 3)
+        self.subreddits = self.config.get("subreddits") or [self.config["subreddit"]]
+        self.cursors = {subreddit: None for subreddit in self.subreddits}
+        self.validators = {}
+        for image in await self._load_cached_images():
+            self.ready.appendleft(image)
+        self.warming = True
+        self.bot.tasks.spawn(self, self._warm_up(), limited=False)
 
-    async def fetch_posts(self, subreddit: str) -> list:
-        resp = await self.bot.http.get(f"https://www.reddit.com/r/{subreddit}/.json?raw_json=1",
-                                       headers={"User-Agent": self.config["user_agent"]})
+    @property
+    def readiness(self) -> Readiness:
+        if len(self.ready) > 0 or len(self.cache) > 0:
+            return Readiness.READY
+        elif self.warming or self.reload_lock.locked():
+            return Readiness.WARMING
+        return Readiness.DEGRADED
+
+    @property
+    def cache_depth(self) -> int:
+        return len(self.ready)
+
+    async def _warm_up(self) -> None:
         try:
-            data = await resp.json()
-        except aiohttp.ContentTypeError:
-            self.log.error(
-                "Got non-JSON response data with status %s while trying to find pictures",
-                resp.status)
-            return []
-        return data["data"]["children"]
+            # Prefetching reloads posts first, failures are logged by the task coordinator
+            prefetch = self._start_prefetch()
+            if prefetch:
+                await asyncio.wait([prefetch])
+        finally:
+            self.warming = False
 
-    async def load_disruption_content(self) -> None:
-        self.log.debug(f"Caching data from {self.subreddit}...")
+    def _start_prefetch(self) -> Optional[asyncio.Task]:
+        return self.bot.tasks.run(self, "prefetch", self.prefetch)
+
+    def _mark_seen(self, post_id: str) -> bool:
+        if post_id in self.seen_ids:
+            self.seen_ids.move_to_end(post_id)
+            return False
+        self.seen_ids[post_id] = None
+        if len(self.seen_ids) > self.dedup_size:
+            self.seen_ids.popitem(last=False)
+        return True
+
+    async def fetch_posts(self, subreddit: str, after: Optional[str] = None
+                          ) -> Tuple[Optional[List[dict]], Optional[str]]:
+        """Fetch one page of a subreddit listing.
+
+        Returns:
+            The posts on the page (``None`` if the page hasn't changed since the last request)
+            and the cursor for the next page.
+        """
+        query = {"raw_json": "1", "limit": "100"}
+        if after:
+            query["after"] = after
+        url = (LISTING_URL / subreddit / ".json").with_query(query)
+        headers = {"User-Agent": self.config["user_agent"]}
+        etag, last_modified = self.validators.get(url, (None, None))
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        async with self.http.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return None, None
+            try:
+                data = await resp.json()
+            except aiohttp.ContentTypeError:
+                self.log.error(
+                    "Got non-JSON response data with status %s while trying to find pictures",
+                    resp.status)
+                return [], None
+            if resp.status == 200 and not after:
+                # Only front pages are requested repeatedly, so only store validators for them
+                self.validators[url] = (resp.headers.get("ETag"),
+                                        resp.headers.get("Last-Modified"))
+        return data["data"]["children"], data["data"].get("after")
+
+    def _add_posts(self, listing: List[dict]) -> int:
         n = 0
-        listing = await self.fetch_posts(self.subreddit)
         for post in listing:
             data = post["data"]
             if (data.get("post_hint", "") == "image"
                     and not data.get("over_18", False)
-                    and data["id"] not in self.handled_ids):
-                self.handled_ids.add(data["id"])
-                self.cache.append({
+                    and self._mark_seen(data["id"])):
+                content = {
                     "url": URL(data["url"]),
-                    "thumbnail_url": URL(data["thumbnail"]),
-                    "thumbnail_dimensions": (data["thumbnail_width"], data["thumbnail_height"]),
                     "external_url": "https://www.reddit.com" + data["permalink"],
                     "title": data["title"],
-                })
+                }
+                if data.get("thumbnail", "").startswith("http"):
+                    content["thumbnail_url"] = URL(data["thumbnail"])
+                    if data.get("thumbnail_width") and data.get("thumbnail_height"):
+                        content["thumbnail_dimensions"] = (data["thumbnail_width"],
+                                                           data["thumbnail_height"])
+                self.cache.append(content)
                 n += 1
-        self.log.info(f"{n} posts cached from {self.subreddit}")
+        return n
+
+    async def _load_subreddit(self, subreddit: str) -> int:
+        n = 0
+        after = None
+        for page in range(self.max_pages):
+            listing, next_after = await self.fetch_posts(subreddit, after)
+            if listing is not None:
+                n += self._add_posts(listing)
+            if page == 0 and self.cursors[subreddit]:
+                # Continue from where the previous load stopped instead of re-reading page 2
+                next_after = self.cursors[subreddit]
+            self.cursors[subreddit] = next_after
+            if n >= self.min_cache_size or not next_after:
+                break
+            after = next_after
+        self.log.debug(f"{n} posts cached from {subreddit}")
+        return n
+
+    async def load_disruption_content(self) -> None:
+        self.log.debug(f"Caching data from {', '.join(self.subreddits)}...")
+        results = await asyncio.gather(*(self._load_subreddit(subreddit)
+                                         for subreddit in self.subreddits),
+                                       return_exceptions=True)
+        n = 0
+        errors = []
+        for subreddit, result in zip(self.subreddits, results):
+            if isinstance(result, Exception):
+                self.log.warning(f"Failed to load posts from {subreddit}: {result}")
+                errors.append(result)
+            else:
+                n += result
+        if len(errors) == len(self.subreddits):
+            raise errors[0]
+        self.log.info(f"{n} posts cached from {len(self.subreddits)} subreddits")
 
     async def reload_disruption_content(self) -> None:
         async with self.reload_lock:
-            if len(self.cache) < 5:
+            if len(self.cache) < self.min_cache_size:
                 await self.load_disruption_content()
 
+    async def prefetch(self) -> None:
+        """Reupload posts ahead of demand so that fetches don't have to wait for them."""
+        async with self.prefetch_lock:
+            error = None
+            uploaded = 0
+            while len(self.ready) < self.prefetch_size:
+                if len(self.cache) < self.min_cache_size:
+                    await self.reload_disruption_content()
+                if len(self.cache) == 0:
+                    break
+                try:
+                    image = await self._reupload(**self.cache.popleft())
+                except Exception as e:
+                    self.log.exception("Failed to reupload post")
+                    error = e
+                    continue
+                self.ready.appendleft(image)
+                self._store_cached_image(image)
+                uploaded += 1
+            if error and not uploaded:
+                # Let the circuit breaker know that nothing could be reuploaded
+                raise error
+
     async def fetch(self) -> Image:
+        try:
+            image = self.ready.pop()
+        except IndexError:
+            pass
+        else:
+            self._forget_cached_image(image)
+            self._start_prefetch()
+            return image
         if len(self.cache) == 0:
+            reload = self.bot.tasks.run(self, "reload", self.reload_disruption_content)
+            if reload is None:
+                self.log.error("Failed to disrupt: cache is empty and reloading is paused "
+                               "after repeated failures")
+                raise SourceUnavailable(self.path)
             self.log.warning("Cache is empty, awaiting reload")
-            await self.reload_disruption_content()
+            # Waiting doesn't cancel the shared reload if this disruption gives up
+            async with self.bot.tasks.released():
+                await asyncio.wait([reload])
         if len(self.cache) == 0:
             self.log.error("Failed to disrupt: cache is still empty after reload")
-            raise CancelDisruption()
-        disruption_content = self.cache.pop()
-        if len(self.cache) < 5:
-            background_task.create(self.reload_disruption_content())
-        return await self._reupload(**disruption_content["image"])
+            raise SourceUnavailable(self.path)
+        disruption_content = self.cache.popleft()
+        self._start_prefetch()
+        return await self._reupload(**disruption_content)
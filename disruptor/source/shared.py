@@ -0,0 +1,165 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, ClassVar, NamedTuple
+from collections import OrderedDict, deque
+import asyncio
+import hashlib
+import json
+
+from yarl import URL
+
+if TYPE_CHECKING:
+    from .abstract import Image
+
+Fetcher = Callable[[int], Awaitable[list[dict[str, Any]]]]
+
+
+def pool_key(type_name: str, config: dict[str, Any]) -> str:
+    """Hash the parts of a source config that decide which images it gets from upstream."""
+    data = json.dumps({"type": type_name, "config": config}, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+class DownloadedMedia(NamedTuple):
+    data: bytes
+    mimetype: str
+    width: int | None
+    height: int | None
+    title: str
+
+
+class DownloadBuffer:
+    """An LRU buffer of downloaded files, limited by their total size."""
+
+    entries: OrderedDict[URL, DownloadedMedia]
+    max_bytes: int
+    size: int
+
+    def __init__(self, max_bytes: int) -> None:
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.size = 0
+
+    def get(self, url: URL) -> DownloadedMedia | None:
+        try:
+            self.entries.move_to_end(url)
+            return self.entries[url]
+        except KeyError:
+            return None
+
+    def put(self, url: URL, media: DownloadedMedia) -> None:
+        if len(media.data) > self.max_bytes or url in self.entries:
+            return
+        self.entries[url] = media
+        self.size += len(media.data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.data)
+
+
+class PoolEntry:
+    __slots__ = ("seq", "data", "uploads", "lock")
+
+    seq: int
+    data: dict[str, Any]
+    # Reuploaded copies by homeserver and processing settings
+    uploads: dict[str, Image]
+    lock: asyncio.Lock
+
+    def __init__(self, seq: int, data: dict[str, Any]) -> None:
+        self.seq = seq
+        self.data = data
+        self.uploads = {}
+        self.lock = asyncio.Lock()
+
+
+class SharedPool:
+    """Upstream results shared by identically configured sources in the whole process.
+
+    Maubot runs every plugin instance in the same process, so instances with the same source
+    config can use one upstream fetcher instead of each spending its own share of the rate
+    limit. Every subscriber sees every entry once, in order. An entry is fetched from upstream
+    only when the subscriber asking for it has already seen everything in the pool.
+    """
+
+    _pools: ClassVar[dict[str, SharedPool]] = {}
+
+    key: str
+    entries: deque[PoolEntry]
+    next_seq: int
+    cursors: dict[object, int]
+    fetchers: dict[object, Fetcher]
+    downloads: DownloadBuffer
+    fetch_lock: asyncio.Lock
+
+    def __init__(self, key: str, size: int, max_bytes: int) -> None:
+        self.key = key
+        self.entries = deque(maxlen=size)
+        self.next_seq = 0
+        self.cursors = {}
+        self.fetchers = {}
+        self.downloads = DownloadBuffer(max_bytes)
+        self.fetch_lock = asyncio.Lock()
+
+    @classmethod
+    def subscribe(cls, key: str, subscriber: object, fetcher: Fetcher, size: int = 60,
+                  max_bytes: int = 64 * 1024 * 1024) -> SharedPool:
+        try:
+            pool = cls._pools[key]
+        except KeyError:
+            pool = cls._pools[key] = cls(key, size, max_bytes)
+        # New subscribers start with what's currently in the pool
+        pool.cursors[subscriber] = pool.entries[0].seq - 1 if pool.entries else pool.next_seq - 1
+        pool.fetchers[subscriber] = fetcher
+        return pool
+
+    def unsubscribe(self, subscriber: object) -> None:
+        self.cursors.pop(subscriber, None)
+        self.fetchers.pop(subscriber, None)
+        if not self.cursors and self._pools.get(self.key) is self:
+            del self._pools[self.key]
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self.cursors)
+
+    def _unseen(self, subscriber: object) -> list[PoolEntry]:
+        cursor = self.cursors[subscriber]
+        return [entry for entry in self.entries if entry.seq > cursor]
+
+    def _advance(self, subscriber: object, count: int) -> list[PoolEntry]:
+        entries = self._unseen(subscriber)[:count]
+        if entries:
+            self.cursors[subscriber] = entries[-1].seq
+        return entries
+
+    async def take(self, subscriber: object, count: int) -> list[PoolEntry]:
+        """Get up to ``count`` entries that the subscriber hasn't seen yet."""
+        if len(self._unseen(subscriber)) >= count:
+            return self._advance(subscriber, count)
+        # Only one upstream fetch at a time, so concurrent takers don't each spend the budget
+        async with self.fetch_lock:
+            # Another subscriber may have filled the pool while we were waiting
+            missing = count - len(self._unseen(subscriber))
+            if missing > 0:
+                # Any subscriber's fetcher works, they all have the same config
+                fetcher = self.fetchers.get(subscriber) or next(iter(self.fetchers.values()))
+                for data in await fetcher(missing):
+                    self.entries.append(PoolEntry(self.next_seq, data))
+                    self.next_seq += 1
+        return self._advance(subscriber, count)
@@ -15,14 +15,18 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
-import time
+from typing import Any
 from collections import deque
 import asyncio
+import json
+import math
 
 from yarl import URL
-from mautrix.util import background_task
 
-from .abstract import AbstractSource, Image, CancelDisruption
+from .abstract import AbstractSource, Image, SourceUnavailable, Readiness
+from .pipeline import RefillPipeline
+from .budget import RateLimitBudget, DemandEstimator
+from .shared import SharedPool, PoolEntry, pool_key
 
 
 class Unsplash(AbstractSource):
@@ -30,12 +34,18 @@ class Unsplash(AbstractSource):
     cache: deque[Image]
     min_cache_size: int
     fetch_count: int
-    api_url: URL
+    query_params: dict[str, str]
     cache_lock: asyncio.Lock
     size_name: str
     thumb_size_name: str
-    next_refill_allowed: float
     access_key: str
+    warming: bool
+    pipeline: RefillPipeline
+    budget: RateLimitBudget
+    demand: DemandEstimator
+    refill_latency: float
+    wakeup: asyncio.Event
+    pool: SharedPool | None
 
     async def prepare(self) -> None:
         self.access_key = self.config["access_key"]
@@ -44,65 +54,188 @@ class Unsplash(AbstractSource):
         self.size_name = self.config.get("size_name", "regular")
         self.thumb_size_name = self.config.get("thumb_size_name", "thumb")
         self.cache = deque(maxlen=self.min_cache_size+self.fetch_count)
-        self.next_refill_allowed = 0
+        self.pipeline = RefillPipeline(self.config.get("refill_concurrency", 8))
+        self.budget = RateLimitBudget.get(self.access_key,
+                                          reserve=self.config.get("ratelimit_reserve", 5))
+        self.demand = DemandEstimator(self.config.get("demand_time_constant", 600))
+        self.refill_latency = 0
         search_query = self.config.get("query")
         orientation = self.config.get("orientation")
-        query_params = {"count": str(self.fetch_count)}
+        self.query_params = {}
         if search_query:
-            query_params["query"] = search_query
+            self.query_params["query"] = search_query
         if orientation:
-            query_params["orientation"] = orientation
+            self.query_params["orientation"] = orientation
         self.cache_lock = asyncio.Lock()
-        self.api_url = URL("https://api.unsplash.com/photos/random").with_query(query_params)
-        await self._refill_cache()
+        self.wakeup = asyncio.Event()
+        self.pool = None
+        if self.config.get("shared_pool", False):
+            key = pool_key(self.type_name, {
+                "access_key": self.access_key,
+                "query": self.query_params,
+                "size_name": self.size_name,
+                "thumb_size_name": self.thumb_size_name,
+            })
+            self.pool = SharedPool.subscribe(
+                key, self, self._fetch_image_infos,
+                size=self.config.get("shared_pool_size", self.fetch_count * 2),
+                max_bytes=self.config.get("shared_download_bytes", 64 * 1024 * 1024))
+            self.log.debug(f"Using shared pool {key} "
+                           f"({self.pool.subscriber_count} subscribers)")
+        for image in await self._load_cached_images():
+            self._push(image)
+        self.log.debug(f"Loaded {len(self.cache)} persisted images")
+        self.warming = True
+        self.bot.tasks.spawn(self, self._run_scheduler(), limited=False)
 
-    async def _refill_cache(self) -> None:
-        try:
-            async with self.cache_lock:
-                if len(self.cache) > self.min_cache_size:
-                    return
-                await self._try_refill_cache()
-        except Exception:
-            self.log.exception("Failed to refill cache")
-
-    async def _try_refill_cache(self) -> None:
-        if self.next_refill_allowed > time.monotonic():
-            self.log.debug("Not refilling cache, low on ratelimit")
-            return
+    async def stop(self) -> None:
+        if self.pool:
+            self.pool.unsubscribe(self)
+            self.pool = None
+        await super().stop()
+
+    @property
+    def readiness(self) -> Readiness:
+        if len(self.cache) > 0:
+            return Readiness.READY
+        elif self.warming:
+            return Readiness.WARMING
+        return Readiness.DEGRADED
+
+    @property
+    def cache_depth(self) -> int:
+        return len(self.cache)
+
+    @property
+    def _target_size(self) -> int:
+        # Enough images to cover the expected demand until the next refill can be done
+        wait = max(self.budget.interval, self.refill_latency)
+        target = self.min_cache_size + math.ceil(self.demand.current * wait)
+        return min(target, self.cache.maxlen)
+
+    async def _run_scheduler(self) -> None:
+        breaker = self.bot.tasks.breaker(self)
+        while True:
+            self.wakeup.clear()
+            target = self._target_size
+            if len(self.cache) >= target:
+                self.warming = False
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=60)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Request what's missing plus what's expected to be used before the next refill
+            expected = math.ceil(self.demand.current * self.budget.interval)
+            count = max(1, min(target - len(self.cache) + expected, self.fetch_count))
+            refill = self.bot.tasks.run(self, "refill", lambda: self._refill_cache(count))
+            if refill is None:
+                self.warming = False
+                self.log.debug(f"Circuit breaker is open, waiting {breaker.retry_delay:.0f} "
+                               "seconds before retrying refill")
+                await asyncio.sleep(breaker.retry_delay)
+                continue
+            await asyncio.wait([refill])
+            self.warming = False
+            if refill.exception() is not None and not breaker.is_open:
+                # Don't retry immediately while the breaker is still counting failures
+                await asyncio.sleep(breaker.backoff)
+
+    async def _refill_cache(self, count: int) -> None:
+        async with self.cache_lock:
+            start = asyncio.get_running_loop().time()
+            await self._try_refill_cache(count)
+            self.refill_latency = asyncio.get_running_loop().time() - start
+
+    @property
+    def _headers(self) -> dict[str, str]:
         headers = {}
         if "user_agent" in self.config:
             headers["User-Agent"] = self.config["user_agent"]
         headers["Authorization"] = f"Client-ID {self.access_key}"
-        self.log.info(f"Refilling cache (current size: {len(self.cache)})")
-        async with self.bot.http.get(self.api_url, headers=headers) as resp:
+        return headers
+
+    @property
+    def _upload_key(self) -> str:
+        # Uploads can be shared by instances on the same homeserver that process images the
+        # same way
+        return json.dumps([str(self.bot.client.api.base_url), self._transcode,
+                           self._local_thumbnails, self.config.get("thumbnail_size"),
+                           self._strip_metadata])
+
+    async def _fetch_image_infos(self, count: int) -> list[dict[str, Any]]:
+        # The budget may only allow the next request near the end of the rate limit window
+        async with self.bot.tasks.released():
+            await self.budget.acquire()
+        api_url = URL("https://api.unsplash.com/photos/random").with_query({
+            **self.query_params,
+            "count": str(count),
+        })
+        async with self.http.get(api_url, headers=self._headers) as resp:
+            self.budget.update(resp.headers)
             data = await resp.json()
             if resp.status >= 400:
                 self.log.error(f"Failed to refill cache: HTTP {resp.status}: {data}")
                 resp.raise_for_status()
-            if int(resp.headers["x-ratelimit-remaining"]) < 10:
-                self.log.debug("Low on ratelimit, marking next refill as only allowed in an hour")
-                self.next_refill_allowed = time.monotonic() + 60 * 60
-            for image_info in data:
-                download_url = URL(image_info["urls"][self.size_name])
-                dimensions = (image_info["width"], image_info["height"]) if self.size_name in ("raw", "full") else None
-                external_url = image_info["links"]["html"]
-                image = await self._reupload(
-                    download_url,
-                    title=image_info["id"] + ".jpg",
-                    blurhash=image_info.get("blur_hash", None),
-                    dimensions=dimensions,
-                    external_url=external_url,
-                    thumbnail_url=image_info["urls"][self.thumb_size_name],
-                    headers=headers,
-                )
-                self.cache.appendleft(image)
+        self.log.debug(f"Rate limit: {self.budget.remaining}/{self.budget.limit} remaining, "
+                       f"next request in {self.budget.interval:.0f} seconds")
+        return data
+
+    async def _try_refill_cache(self, count: int) -> None:
+        self.log.info(f"Refilling cache with {count} images (current size: {len(self.cache)})")
+        headers = self._headers
+        if self.pool:
+            entries = await self.pool.take(self, count)
+            jobs = (self._reupload_entry(entry, headers) for entry in entries)
+        else:
+            image_infos = await self._fetch_image_infos(count)
+            jobs = (self._reupload_image_info(image_info, headers) for image_info in image_infos)
+        async for image in self.pipeline.run(jobs):
+            if isinstance(image, Exception):
+                self.log.warning(f"Failed to reupload image for cache: {image}")
+                continue
+            self._push(image)
+            self._store_cached_image(image)
         self.log.info(f"Cache refilled, now have {len(self.cache)} images")
 
+    async def _reupload_entry(self, entry: PoolEntry, headers: dict[str, str]) -> Image:
+        # Other instances on the same homeserver may have uploaded the image already
+        async with entry.lock:
+            try:
+                return entry.uploads[self._upload_key]
+            except KeyError:
+                pass
+            image = await self._reupload_image_info(entry.data, headers)
+            entry.uploads[self._upload_key] = image
+            return image
+
+    async def _reupload_image_info(self, image_info: dict, headers: dict[str, str]) -> Image:
+        download_url = URL(image_info["urls"][self.size_name])
+        dimensions = (image_info["width"], image_info["height"]) if self.size_name in ("raw", "full") else None
+        return await self._reupload(
+            download_url,
+            title=image_info["id"] + ".jpg",
+            blurhash=image_info.get("blur_hash", None),
+            dimensions=dimensions,
+            external_url=image_info["links"]["html"],
+            thumbnail_url=URL(image_info["urls"][self.thumb_size_name]),
+            headers=headers,
+            download_buffer=self.pool.downloads if self.pool else None,
+        )
+
+    def _push(self, image: Image) -> None:
+        if len(self.cache) == self.cache.maxlen:
+            self._forget_cached_image(self.cache[-1])
+        self.cache.appendleft(image)
+
     async def fetch(self) -> Image:
-        if len(self.cache) < self.min_cache_size:
-            background_task.create(self._refill_cache())
+        self.demand.record()
+        if len(self.cache) <= self._target_size:
+            self.wakeup.set()
         try:
-            return self.cache.pop()
+            image = self.cache.pop()
         except IndexError:
             self.log.error("Cache is empty, canceling disruption")
-            raise CancelDisruption()
+            raise SourceUnavailable(self.path)
+        self._forget_cached_image(image)
+        return image
@@ -0,0 +1,141 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Callable, Generic, Iterator, TypeVar
+from collections import OrderedDict
+from time import time
+import asyncio
+
+from mautrix.types import UserID
+
+
+class StateRecord:
+    __slots__ = ("last_active",)
+
+    last_active: float
+
+    def __init__(self) -> None:
+        self.last_active = 0
+
+    def can_evict(self) -> bool:
+        return True
+
+
+K = TypeVar("K")
+V = TypeVar("V", bound=StateRecord)
+
+
+class IdleEvictingDict(Generic[K, V]):
+    """A dict that creates missing entries and forgets entries that haven't been used recently.
+
+    The TTL must be chosen so that an entry that has been idle for that long is equivalent to a
+    freshly created one. Entries are kept in access order, so eviction only has to look at the
+    oldest entries and is O(1) amortized per access.
+    """
+
+    _entries: OrderedDict[K, V]
+    factory: Callable[[], V]
+    ttl: float
+
+    def __init__(self, factory: Callable[[], V], ttl: float) -> None:
+        self._entries = OrderedDict()
+        self.factory = factory
+        self.ttl = ttl
+
+    def __getitem__(self, key: K) -> V:
+        now = time()
+        self.evict_idle(now)
+        try:
+            value = self._entries[key]
+        except KeyError:
+            value = self._entries[key] = self.factory()
+        else:
+            self._entries.move_to_end(key)
+        value.last_active = now
+        return value
+
+    def get(self, key: K) -> V | None:
+        return self._entries.get(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self._entries)
+
+    def evict_idle(self, now: float | None = None) -> int:
+        now = now or time()
+        evicted = 0
+        while self._entries:
+            key, value = next(iter(self._entries.items()))
+            if value.last_active + self.ttl > now:
+                break
+            elif not value.can_evict():
+                value.last_active = now
+                self._entries.move_to_end(key)
+                break
+            del self._entries[key]
+            evicted += 1
+        return evicted
+
+
+class MonologueInfo(StateRecord):
+    __slots__ = ("user_id", "streak", "last_message", "prev_disrupt", "lock")
+
+    user_id: UserID | None
+    streak: int
+    last_message: float
+    prev_disrupt: float
+    lock: asyncio.Lock
+
+    def __init__(self, user_id: UserID | None = None, streak: int = 0, last_message: float = 0,
+                 prev_disrupt: float = 0) -> None:
+        super().__init__()
+        self.user_id = user_id
+        self.streak = streak
+        self.last_message = last_message
+        self.prev_disrupt = prev_disrupt
+        self.lock = asyncio.Lock()
+
+    def can_evict(self) -> bool:
+        return not self.lock.locked()
+
+    def message(self, user_id: UserID) -> None:
+        if self.user_id == user_id:
+            self.streak += 1
+        else:
+            self.user_id = user_id
+            self.streak = 1
+        self.last_message = time()
+
+    def reset(self) -> None:
+        self.user_id = None
+        self.streak = 0
+
+    def is_outdated(self, max_delay: int) -> bool:
+        return self.last_message != 0 and self.last_message + max_delay < time()
+
+    def should_disrupt(self, min_count: int, disrupt_cooldown: int) -> bool:
+        return self.streak >= min_count and self.prev_disrupt + disrupt_cooldown < time()
+
+    def __repr__(self) -> str:
+        return str(self)
+
+    def __str__(self) -> str:
+        return (f"MonologueInfo(user_id={self.user_id}, streak={self.streak}, "
+                f"last_message={self.last_message}, prev_disrupt={self.prev_disrupt})")
+
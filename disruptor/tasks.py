@@ -0,0 +1,280 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, AsyncIterator, Awaitable, Callable, Coroutine, TypeVar
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from enum import Enum
+import asyncio
+import logging
+import random
+import time
+
+T = TypeVar("T")
+
+
+class _Slot:
+    __slots__ = ("held",)
+
+    held: bool
+
+    def __init__(self) -> None:
+        self.held = True
+
+
+# The slot held by the current task. Tasks inherit it from the task that started them, so work
+# started from inside a limited task doesn't wait for a second slot.
+_current_slot: ContextVar[_Slot | None] = ContextVar("disruptor_task_slot", default=None)
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Stops background work for a source after repeated failures.
+
+    After ``threshold`` consecutive failures the breaker opens and refuses work for an
+    exponentially growing backoff. Once the backoff has passed, a single probe is let through
+    (half-open): if it succeeds the breaker closes, otherwise it opens again for longer.
+    """
+
+    threshold: int
+    backoff: float
+    max_backoff: float
+    state: BreakerState
+    failures: int
+    open_count: int
+    open_until: float
+
+    def __init__(self, threshold: int = 3, backoff: float = 5, max_backoff: float = 900
+                 ) -> None:
+        self.threshold = max(1, threshold)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.open_count = 0
+        self.open_until = 0
+
+    @property
+    def retry_delay(self) -> float:
+        """Seconds until the breaker lets a probe through, 0 if work is allowed now."""
+        if self.state != BreakerState.OPEN:
+            return 0.0
+        return max(0.0, self.open_until - time.monotonic())
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == BreakerState.OPEN and self.retry_delay > 0
+
+    def allow(self) -> bool:
+        """Check whether work may start, moving to half-open if the backoff has passed."""
+        if self.state == BreakerState.CLOSED:
+            return True
+        elif self.state == BreakerState.OPEN and self.retry_delay == 0:
+            self.state = BreakerState.HALF_OPEN
+            return True
+        # Open, or half-open with the probe still running
+        return False
+
+    def record_success(self) -> None:
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.open_count = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == BreakerState.HALF_OPEN or self.failures >= self.threshold:
+            delay = min(self.backoff * 2 ** self.open_count, self.max_backoff)
+            self.open_until = time.monotonic() + delay * random.uniform(0.75, 1.25)
+            self.open_count += 1
+            self.state = BreakerState.OPEN
+
+
+class TaskCoordinator:
+    """Owns the background tasks of the source tree.
+
+    Tasks are tracked per source node, so that stopping a node (on plugin stop or when a config
+    reload drops it) cancels everything it started. Short-lived work like refills shares a
+    global limit on how much can run at once, and work started through :meth:`run` is
+    single-flight per source and name and guarded by the source's circuit breaker.
+    """
+
+    log: logging.Logger
+    slots: asyncio.Semaphore
+    threshold: int
+    backoff: float
+    max_backoff: float
+    tasks: dict[object, set[asyncio.Task]]
+    inflight: dict[tuple[object, str], asyncio.Task]
+    breakers: dict[object, CircuitBreaker]
+
+    def __init__(self, log: logging.Logger, max_tasks: int = 16, threshold: int = 3,
+                 backoff: float = 5, max_backoff: float = 900) -> None:
+        self.log = log
+        self.slots = asyncio.Semaphore(max(1, max_tasks))
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tasks = {}
+        self.inflight = {}
+        self.breakers = {}
+
+    @property
+    def running(self) -> int:
+        return sum(len(tasks) for tasks in self.tasks.values())
+
+    def breaker(self, owner: object) -> CircuitBreaker:
+        try:
+            return self.breakers[owner]
+        except KeyError:
+            breaker = self.breakers[owner] = CircuitBreaker(self.threshold, self.backoff,
+                                                            self.max_backoff)
+            return breaker
+
+    def spawn(self, owner: object, coro: Coroutine[Any, Any, T], limited: bool = True
+              ) -> asyncio.Task[T]:
+        """Start a task owned by the given source.
+
+        Limited tasks wait for a free slot in the global limit before running, unless they're
+        started from a task that already holds one. Long-running loops should pass
+        ``limited=False`` so that they don't hold a slot forever, and tasks that sleep before
+        doing their work should take a slot with :meth:`slot` after sleeping.
+        """
+        if limited:
+            task = asyncio.create_task(self._limited(coro))
+            # Close the coroutine if the task was cancelled before it got a slot, which may be
+            # before the task even started running
+            task.add_done_callback(lambda _: coro.close())
+        else:
+            task = asyncio.create_task(coro)
+        tasks = self.tasks.setdefault(owner, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    async def _limited(self, coro: Coroutine[Any, Any, T]) -> T:
+        async with self.slot():
+            return await coro
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold a slot of the global limit, unless the current task already has one.
+
+        Tasks started while holding a slot share it instead of taking another one, as waiting
+        for a second slot while holding one deadlocks once every slot is taken.
+        """
+        current = _current_slot.get()
+        if current and current.held:
+            yield
+            return
+        await self.slots.acquire()
+        slot = _Slot()
+        token = _current_slot.set(slot)
+        try:
+            yield
+        finally:
+            _current_slot.reset(token)
+            if slot.held:
+                slot.held = False
+                self.slots.release()
+
+    @asynccontextmanager
+    async def released(self) -> AsyncIterator[None]:
+        """Give up the current task's slot while waiting.
+
+        Meant for waits that can take long, like a rate limit budget or another task, which
+        would otherwise keep the slot from work that's ready to run.
+        """
+        slot = _current_slot.get()
+        if not slot or not slot.held:
+            yield
+            return
+        slot.held = False
+        self.slots.release()
+        # Tasks started while waiting need their own slots
+        token = _current_slot.set(None)
+        try:
+            yield
+        finally:
+            _current_slot.reset(token)
+            await self.slots.acquire()
+            slot.held = True
+
+    def run(self, owner: object, name: str, func: Callable[[], Awaitable[T]]
+            ) -> asyncio.Task[T] | None:
+        """Run work for a source unless the same work is already running.
+
+        If a task with the same owner and name is running, that task is returned instead of
+        starting a new one. Failures are recorded in the owner's circuit breaker.
+
+        Returns:
+            The task, or ``None`` if the owner's circuit breaker is open.
+        """
+        key = (owner, name)
+        try:
+            return self.inflight[key]
+        except KeyError:
+            pass
+        breaker = self.breaker(owner)
+        if not breaker.allow():
+            return None
+        task = self.spawn(owner, self._guarded(breaker, key, func))
+        # The failure was already logged, callers that don't await the task don't need to see it
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.inflight[key] = task
+        return task
+
+    async def _guarded(self, breaker: CircuitBreaker, key: tuple[object, str],
+                       func: Callable[[], Awaitable[T]]) -> T:
+        owner, name = key
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            if breaker.state == BreakerState.HALF_OPEN:
+                # The probe didn't finish, let the next attempt probe again
+                breaker.state = BreakerState.OPEN
+            raise
+        except Exception as e:
+            breaker.record_failure()
+            message = f"Background {name} for {getattr(owner, 'path', owner)} failed: {e}"
+            if breaker.state == BreakerState.OPEN:
+                message += f", pausing for {breaker.retry_delay:.1f} seconds"
+            self.log.warning(message, exc_info=True)
+            raise
+        else:
+            breaker.record_success()
+            return result
+        finally:
+            if self.inflight.get(key) is asyncio.current_task():
+                del self.inflight[key]
+
+    async def cancel(self, owner: object) -> None:
+        """Cancel and wait for every task started by the given source."""
+        tasks = self.tasks.pop(owner, set())
+        self.breakers.pop(owner, None)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def stop(self) -> None:
+        for owner in list(self.tasks):
+            await self.cancel(owner)
@@ -0,0 +1,111 @@
+# disruptor - A maubot plugin that disrupts monologues with cat pictures.
+# Copyright (C) 2026 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, Callable, TypeVar
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import functools
+import logging
+import time
+
+from mautrix.util import background_task
+
+from .metrics import Metrics
+
+T = TypeVar("T")
+
+
+class WorkerPool:
+    """Runs CPU-bound functions outside the event loop.
+
+    At most ``max_workers`` functions run at once and at most ``queue_size`` more wait for a
+    worker. Callers beyond that wait in :meth:`run` until there's room, so a burst of refills
+    can't queue up an unbounded amount of image data. With the process pool, functions and
+    their arguments must be picklable, i.e. module-level functions and plain values.
+    """
+
+    executor: Executor
+    slots: asyncio.Semaphore
+    max_workers: int
+    queue_size: int
+    pending: int
+    metrics: Metrics
+
+    def __init__(self, metrics: Metrics, kind: str = "thread", max_workers: int = 2,
+                 queue_size: int = 16) -> None:
+        if kind == "process":
+            self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        elif kind == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix="disruptor-worker")
+        else:
+            raise ValueError(f"Unknown worker pool type {kind!r}")
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.slots = asyncio.Semaphore(max_workers + queue_size)
+        self.pending = 0
+        self.metrics = metrics
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        name = getattr(func, "__name__", "unknown")
+        async with self.slots:
+            self.pending += 1
+            start = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, functools.partial(func, *args, **kwargs))
+            finally:
+                self.pending -= 1
+                self.metrics.worker_task_latency.observe(time.perf_counter() - start,
+                                                         function=name)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop runs a callback that should run every ``interval``."""
+
+    interval: float
+    metrics: Metrics
+    log: logging.Logger
+    task: asyncio.Task | None
+
+    def __init__(self, metrics: Metrics, log: logging.Logger, interval: float = 0.5) -> None:
+        self.metrics = metrics
+        self.log = log
+        self.interval = interval
+        self.task = None
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self.task = background_task.create(self._run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.metrics.loop_lag.observe(lag)
+            if lag > 1:
+                self.log.warning(f"Event loop was blocked for {lag:.2f} seconds")
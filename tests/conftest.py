@@ -0,0 +1,26 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+import time
+
+import pytest
+
+from .stubs import make_bot
+
+
+@pytest.fixture
+def bot() -> SimpleNamespace:
+    return make_bot()
+
+
+@pytest.fixture
+def clock(request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch) -> list[float]:
+    """A clock that only moves when the test changes ``clock[0]``.
+
+    Replaces ``time.monotonic``, unless the test module sets ``clock_function`` to the module
+    and name of another clock, e.g. for modules that use ``from time import time``.
+    """
+    module, name = getattr(request.module, "clock_function", (time, "monotonic"))
+    now = [1_000_000.0]
+    monkeypatch.setattr(module, name, lambda: now[0])
+    return now
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+from typing import Any
+import asyncio
+import logging
+
+from mautrix.types import ContentURI, ImageInfo
+
+from disruptor.metrics import Metrics
+from disruptor.source import AbstractSource, CancelDisruption, SourceUnavailable, Readiness
+from disruptor.source.abstract import Image
+from disruptor.tasks import TaskCoordinator
+
+
+class FakeClient:
+    """Records uploads instead of sending them to a homeserver."""
+
+    def __init__(self) -> None:
+        self.uploads: list[tuple[bytes, str]] = []
+
+    async def upload_media(self, data: Any, mime_type: str | None = None,
+                           size: int | None = None, **_: Any) -> ContentURI:
+        if not isinstance(data, (bytes, bytearray)):
+            data = b"".join([chunk async for chunk in data])
+        self.uploads.append((bytes(data), mime_type))
+        return ContentURI(f"mxc://example.com/{len(self.uploads)}")
+
+
+class FakeDB:
+    """Keeps the rows of the plugin database that the tests use in plain dicts.
+
+    Writes wait for ``latency`` seconds before storing anything new and fail while ``fail`` is
+    set.
+    """
+
+    def __init__(self, ratelimits: dict[str, float] | None = None, latency: float = 0) -> None:
+        self.images: dict[tuple[str, str], list[Image]] = {}
+        self.files: dict[tuple[str, str], tuple] = {}
+        self.ratelimits = dict(ratelimits or {})
+        self.latency = latency
+        self.fail = False
+
+    async def _write(self) -> None:
+        await asyncio.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError("database is down")
+
+    async def get_cached_images(self, source: str, config_hash: str) -> list[Image]:
+        return list(self.images.get((source, config_hash), []))
+
+    async def add_cached_image(self, source: str, config_hash: str, image: Image) -> None:
+        await self._write()
+        self.images.setdefault((source, config_hash), []).append(image)
+
+    async def remove_cached_image(self, source: str, mxc: ContentURI) -> None:
+        for key, images in self.images.items():
+            if key[0] == source:
+                self.images[key] = [image for image in images if image.url != mxc]
+
+    async def get_directory_files(self, source: str) -> list[tuple]:
+        return [(path, *row) for (src, path), row in self.files.items() if src == source]
+
+    async def put_directory_file(self, source: str, path: str, *row: Any) -> None:
+        await self._write()
+        self.files[(source, path)] = row
+
+    async def remove_directory_files(self, source: str, paths: list[str]) -> None:
+        for path in paths:
+            self.files.pop((source, path), None)
+
+    async def get_ratelimit(self, key: str) -> float:
+        return self.ratelimits.get(key, 0)
+
+    async def put_ratelimits(self, items: dict[str, float]) -> None:
+        await self._write()
+        self.ratelimits.update(items)
+
+    async def delete_expired_ratelimits(self, now: float) -> None:
+        self.ratelimits = {key: tat for key, tat in self.ratelimits.items() if tat > now}
+
+
+def make_image(name: str = "cat") -> Image:
+    return Image(title=f"{name}.jpg", url=ContentURI(f"mxc://example.com/{name}"),
+                 info=ImageInfo(mimetype="image/jpeg", size=1024), external_url=None)
+
+
+class StubSource(AbstractSource):
+    """A source whose behavior is set in its config.
+
+    ``mode`` is ``ok`` (return an image named after the source), ``unavailable``, ``error`` or
+    ``cancel``. Fetches are counted in ``fetches``. A source whose ``readiness`` is ``warming``
+    stays that way until ``warming`` is cleared.
+    """
+
+    type_name = "test_stub"
+    fetches: int
+
+    def __init__(self, bot: Any, config: dict[str, Any]) -> None:
+        super().__init__(bot, config)
+        self.fetches = 0
+        self.warming = self.config.get("readiness") == "warming"
+
+    @property
+    def readiness(self) -> Readiness:
+        if self.warming:
+            return Readiness.WARMING
+        readiness = Readiness(self.config.get("readiness", "ready"))
+        return Readiness.READY if readiness == Readiness.WARMING else readiness
+
+    async def fetch(self) -> Image:
+        self.fetches += 1
+        if self.config.get("latency"):
+            await asyncio.sleep(self.config["latency"])
+        mode = self.config.get("mode", "ok")
+        if mode == "unavailable":
+            raise SourceUnavailable(self.path)
+        elif mode == "error":
+            raise RuntimeError("stub failure")
+        elif mode == "cancel":
+            raise CancelDisruption()
+        return make_image(self.config.get("name", "cat"))
+
+
+AbstractSource.all[StubSource.type_name] = StubSource
+
+
+def make_bot() -> SimpleNamespace:
+    # Only the parts of DisruptorBot that sources use without a homeserver or database
+    log = logging.getLogger("test.disruptor")
+    return SimpleNamespace(log=log, metrics=Metrics(), reusable_sources={}, source_generation=0,
+                           db=None, tasks=TaskCoordinator(log.getChild("tasks")))
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from disruptor.source import Readiness, SourceUnavailable
+from disruptor.source.adaptive import RefillController
+from disruptor.source.cache import Cache
+
+
+def test_idle_controller_keeps_min_size(clock: list[float]) -> None:
+    controller = RefillController(min_size=2, max_size=20)
+    assert controller.rate == 0
+    assert controller.target_size == 2
+    assert controller.concurrency == 1
+
+
+def test_target_size_grows_with_demand_and_latency(clock: list[float]) -> None:
+    controller = RefillController(min_size=2, max_size=20, rate_window=10, initial_latency=1)
+    for _ in range(50):
+        controller.record_demand()
+    assert controller.rate == pytest.approx(5)
+    busy = controller.target_size
+    assert 2 < busy < 20
+    controller.latency = 2
+    assert controller.target_size > busy
+    controller.latency = 100
+    assert controller.target_size == 20
+    assert controller.concurrency == 4
+
+
+def test_demand_decays(clock: list[float]) -> None:
+    controller = RefillController(rate_window=10)
+    for _ in range(50):
+        controller.record_demand()
+    clock[0] += 100
+    assert controller.rate < 0.01
+    assert controller.target_size == controller.min_size
+
+
+def test_failures_back_off_and_serialize(clock: list[float]) -> None:
+    controller = RefillController(rate_window=10, retry_backoff=1, max_retry_backoff=4)
+    for _ in range(50):
+        controller.record_demand()
+    assert controller.concurrency > 1
+    delays = []
+    for _ in range(5):
+        controller.record_failure()
+        delays.append(controller.retry_delay)
+        assert controller.concurrency == 1
+    assert 0.5 <= delays[0] <= 1
+    assert all(2 <= delay <= 4 for delay in delays[2:])
+    controller.record_success(1)
+    assert controller.retry_delay == 0
+    assert controller.concurrency > 1
+
+
+def _cache(bot, child: dict, **config) -> Cache:
+    return Cache(bot, {"type": "test_stub", "config": child, "persist_cache": False, **config})
+
+
+async def _wait_for(condition, timeout: float = 1) -> None:
+    async def poll() -> None:
+        while not condition():
+            await asyncio.sleep(0.005)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_cache_warms_up_to_min_size(bot) -> None:
+    async def run() -> None:
+        cache = _cache(bot, {"latency": 0.01}, min_size=3)
+        await cache.prepare()
+        assert cache.readiness == Readiness.WARMING
+        await _wait_for(lambda: not cache.warming)
+        assert cache.readiness == Readiness.READY
+        assert len(cache.cache) == 3
+        assert cache.source.fetches == 3
+        await cache.stop()
+
+    asyncio.run(run())
+
+
+def test_cache_grows_with_demand(bot) -> None:
+    async def run() -> int:
+        cache = _cache(bot, {"latency": 0.05}, min_size=1, max_size=10, rate_window=1)
+        await cache.prepare()
+        await _wait_for(lambda: not cache.warming)
+        for _ in range(10):
+            await _wait_for(lambda: len(cache.cache) > 0)
+            await cache.fetch()
+        target = cache.controller.target_size
+        # Demand decays quickly with this window, so compare with the current target
+        await _wait_for(lambda: len(cache.cache) >= cache.controller.target_size)
+        await cache.stop()
+        return target
+
+    assert asyncio.run(run()) > 1
+
+
+def test_cache_backs_off_failing_child(bot) -> None:
+    async def run() -> int:
+        cache = _cache(bot, {"mode": "error"}, min_size=2, retry_backoff=10)
+        await cache.prepare()
+        await _wait_for(lambda: not cache.warming)
+        assert cache.readiness == Readiness.DEGRADED
+        await asyncio.sleep(0.05)
+        with pytest.raises(SourceUnavailable):
+            await cache.fetch()
+        await asyncio.sleep(0.05)
+        await cache.stop()
+        return cache.source.fetches
+
+    # Only one failing request, then the refiller waits for the backoff
+    assert asyncio.run(run()) == 1
+
+
+def test_cache_warm_up_stagger_doesnt_hold_slots(bot) -> None:
+    async def run() -> None:
+        bot.tasks.slots = asyncio.Semaphore(1)
+        cache = _cache(bot, {}, min_size=3, initial_fetch_sleep=10)
+        await cache.prepare()
+        await _wait_for(lambda: len(cache.cache) == 1)
+        # The staggered refills are sleeping, so other work still gets the only slot
+        await asyncio.wait_for(bot.tasks.spawn(object(), asyncio.sleep(0)), 0.5)
+        await cache.stop()
+
+    asyncio.run(run())
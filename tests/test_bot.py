@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+
+from mautrix.types import RoomID, UserID
+
+from disruptor.bot import DisruptorBot
+from disruptor.sendqueue import QueuedSend
+from disruptor.source import DisruptionContext, SourceUnavailable
+from disruptor.source.abstract import Image
+
+from .stubs import StubSource, make_image
+
+
+class FakePlugin:
+    # Only what the tested methods use, SimpleNamespace can't own tasks because it isn't hashable
+    def __init__(self, bot: SimpleNamespace, deadline: float = 60, hedge_after: float = 0,
+                 source: StubSource | None = None, fallback: StubSource | None = None) -> None:
+        self.log = bot.log
+        self.tasks = bot.tasks
+        self.metrics = bot.metrics
+        self.config = {"disruption.deadline": deadline, "disruption.hedge_after": hedge_after}
+        self.source = source
+        self.fallback_source = fallback
+        self.db = None
+        self.reusable_sources = {}
+        self.source_generation = 0
+        self.history = None
+        self.send_queue = None
+
+    _fetch_hedged = DisruptorBot._fetch_hedged
+    _recycle = DisruptorBot._recycle
+    _record_disruption = DisruptorBot._record_disruption
+
+
+def _retire(plugin: FakePlugin, old: StubSource) -> asyncio.Task:
+    coro = DisruptorBot._retire_source(plugin, old, None)
+    return plugin.tasks.spawn(plugin, coro, limited=False)
+
+
+def test_retired_source_is_stopped_after_deadline(bot, monkeypatch: pytest.MonkeyPatch) -> None:
+    plugin = FakePlugin(bot, deadline=0.01)
+    old = StubSource(bot, {})
+    stopped = []
+    monkeypatch.setattr(old, "stop", lambda: asyncio.sleep(0, stopped.append(old)))
+
+    async def run() -> None:
+        await _retire(plugin, old)
+
+    asyncio.run(run())
+    assert stopped == [old]
+    assert plugin.tasks.running == 0
+
+
+def test_cancelling_retire_tasks_stops_old_tree_immediately(bot, monkeypatch: pytest.MonkeyPatch
+                                                           ) -> None:
+    plugin = FakePlugin(bot, deadline=60)
+    old = StubSource(bot, {})
+    stopped = []
+    monkeypatch.setattr(old, "stop", lambda: asyncio.sleep(0, stopped.append(old)))
+
+    async def run() -> None:
+        task = _retire(plugin, old)
+        await asyncio.sleep(0.01)
+        assert plugin.tasks.running == 1
+        await asyncio.wait_for(plugin.tasks.cancel(plugin), 1)
+        assert task.cancelled()
+
+    asyncio.run(run())
+    assert stopped == [old]
+
+
+def _fetch_hedged(plugin: FakePlugin) -> str:
+    ctx = DisruptionContext(room_id=RoomID("!room:example.com"),
+                            user_id=UserID("@user:example.com"))
+    return asyncio.run(DisruptorBot._fetch_hedged(plugin, ctx)).title
+
+
+def _hedged(bot, primary: dict, fallback: dict | None, hedge_after: float = 0.02
+            ) -> FakePlugin:
+    return FakePlugin(bot, hedge_after=hedge_after,
+                      source=StubSource(bot, {"name": "primary", **primary}),
+                      fallback=StubSource(bot, {"name": "fallback", **fallback})
+                      if fallback is not None else None)
+
+
+def test_fast_primary_isnt_hedged(bot) -> None:
+    plugin = _hedged(bot, {"latency": 0.001}, {})
+    assert _fetch_hedged(plugin) == "primary.jpg"
+    assert plugin.fallback_source.fetches == 0
+
+
+def test_slow_primary_is_hedged_with_fallback(bot) -> None:
+    plugin = _hedged(bot, {"latency": 1}, {"latency": 0.01})
+    assert _fetch_hedged(plugin) == "fallback.jpg"
+    assert 'disruptor_hedged_fetches_total{winner="fallback"} 1' in bot.metrics.render()
+
+
+def test_failed_hedge_waits_for_primary(bot) -> None:
+    plugin = _hedged(bot, {"latency": 0.05}, {"mode": "error"})
+    assert _fetch_hedged(plugin) == "primary.jpg"
+    assert 'disruptor_hedged_fetches_total{winner="primary"} 1' in bot.metrics.render()
+
+
+def test_primary_error_is_raised_if_both_fail(bot) -> None:
+    plugin = _hedged(bot, {"latency": 0.05, "mode": "unavailable"}, {"mode": "error"})
+    with pytest.raises(SourceUnavailable):
+        _fetch_hedged(plugin)
+    assert 'disruptor_hedged_fetches_total{winner="none"} 1' in bot.metrics.render()
+
+
+def test_no_hedging_without_fallback(bot) -> None:
+    plugin = _hedged(bot, {"latency": 0.05}, None)
+    assert _fetch_hedged(plugin) == "primary.jpg"
+
+
+def test_config_reload_keeps_unchanged_sources(bot, monkeypatch: pytest.MonkeyPatch) -> None:
+    plugin = FakePlugin(bot)
+    stopped = []
+    original_stop = StubSource.stop
+
+    async def stop(self: StubSource) -> None:
+        stopped.append(self)
+        await original_stop(self)
+
+    monkeypatch.setattr(StubSource, "stop", stop)
+
+    def config(second: str) -> dict:
+        return {"type": "random", "config": {"sources": [
+            {"type": "test_stub", "weight": 1, "config": {"name": "kept"}},
+            {"type": "test_stub", "weight": 1, "config": {"name": second}},
+        ]}}
+
+    async def run() -> None:
+        old = await DisruptorBot._build_source(plugin, config("old"))
+        plugin.source_generation += 1
+        new = await DisruptorBot._build_source(plugin, config("new"), old=old)
+        assert new is not old
+        assert new.sources[0] is old.sources[0]
+        assert new.sources[1] is not old.sources[1]
+        assert {node.generation for node in new.walk()} == {1}
+        assert plugin.reusable_sources == {}
+        await old.stop()
+        # The reused child belongs to the new tree now
+        assert stopped == [old.sources[1]]
+        # An unchanged tree is reused as a whole
+        plugin.source_generation += 1
+        assert await DisruptorBot._build_source(plugin, config("new"), old=new) is new
+
+    asyncio.run(run())
+
+
+def test_failed_reload_stops_new_sources(bot, monkeypatch: pytest.MonkeyPatch) -> None:
+    plugin = FakePlugin(bot)
+    stopped = []
+    original_stop = StubSource.stop
+
+    async def stop(self: StubSource) -> None:
+        stopped.append(self.config["name"])
+        await original_stop(self)
+
+    async def prepare(self: StubSource) -> None:
+        if self.config["name"] == "broken":
+            raise RuntimeError("prepare failed")
+
+    monkeypatch.setattr(StubSource, "stop", stop)
+    monkeypatch.setattr(StubSource, "prepare", prepare)
+
+    def config(*names: str) -> dict:
+        return {"type": "random", "config": {"sources": [
+            {"type": "test_stub", "weight": 1, "config": {"name": name}} for name in names
+        ]}}
+
+    async def run() -> None:
+        old = await DisruptorBot._build_source(plugin, config("kept"))
+        plugin.source_generation += 1
+        with pytest.raises(RuntimeError):
+            await DisruptorBot._build_source(plugin, config("kept", "new", "broken"), old=old)
+        assert plugin.reusable_sources == {}
+        # The old tree is still in use, so its nodes must keep running
+        assert sorted(stopped) == ["broken", "new"]
+
+    asyncio.run(run())
+
+
+class FakeHistory:
+    def __init__(self, image: Image | None) -> None:
+        self.image = image
+
+    def pick(self, room_id: RoomID) -> Image | None:
+        return self.image
+
+
+def _disrupt_slowly(bot, history: FakeHistory) -> tuple[list[QueuedSend], float]:
+    plugin = FakePlugin(bot, deadline=0.05, source=StubSource(bot, {"latency": 1}))
+    plugin.history = history
+    queued = []
+    plugin.send_queue = SimpleNamespace(is_pending=lambda room_id: False, put=queued.append)
+    asyncio.run(DisruptorBot.disrupt(plugin, UserID("@user:example.com"),
+                                     RoomID("!room:example.com")))
+    return queued, bot.metrics.disruptions.values.get(("stale",), 0)
+
+
+def test_slow_fetch_recycles_from_history(bot) -> None:
+    queued, stale = _disrupt_slowly(bot, FakeHistory(make_image("old")))
+    assert [entry.content.body for entry in queued] == ["old.jpg"]
+    # Sending the recycled image isn't limited by the deadline the fetch already used up
+    assert queued[0].max_age > queued[0].age
+    assert stale == 0
+
+
+def test_slow_fetch_without_history_is_stale(bot) -> None:
+    queued, stale = _disrupt_slowly(bot, FakeHistory(None))
+    assert queued == []
+    assert stale == 1
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+
+import pytest
+
+from disruptor.source.budget import DemandEstimator, RateLimitBudget
+
+
+def _headers(limit: int, remaining: int) -> dict[str, str]:
+    return {"x-ratelimit-limit": str(limit), "x-ratelimit-remaining": str(remaining)}
+
+
+def test_unknown_quota_has_no_interval(clock: list[float]) -> None:
+    budget = RateLimitBudget()
+    assert budget.interval == 0
+    budget.update({"x-ratelimit-limit": "50"})
+    assert budget.remaining is None
+
+
+def test_interval_spreads_remaining_quota(clock: list[float]) -> None:
+    budget = RateLimitBudget(window=3600, reserve=5)
+    budget.update(_headers(50, 45))
+    assert budget.interval == pytest.approx(90)
+    clock[0] += 1800
+    budget.update(_headers(50, 25))
+    assert budget.interval == pytest.approx(90)
+    budget.update(_headers(50, 5))
+    # Only the reserve is left, so wait until the window ends
+    assert budget.interval == pytest.approx(1800)
+
+
+def test_quota_reset_starts_new_window(clock: list[float]) -> None:
+    budget = RateLimitBudget(window=3600, reserve=0)
+    budget.update(_headers(50, 10))
+    clock[0] += 3000
+    budget.update(_headers(50, 49))
+    assert budget.window_end == clock[0] + 3600
+    assert budget.interval == pytest.approx(3600 / 49)
+
+
+def test_acquire_waits_for_next_slot(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def run() -> list[float]:
+        budget = RateLimitBudget(window=10, reserve=0)
+        budget.update(_headers(100, 100))
+        start = time.monotonic()
+        acquired = []
+        for _ in range(3):
+            await budget.acquire()
+            acquired.append(time.monotonic() - start)
+        return acquired
+
+    acquired = asyncio.run(run())
+    assert acquired[0] < 0.05
+    assert acquired[2] >= 0.19
+
+
+def test_budgets_are_shared_by_key(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(RateLimitBudget, "_budgets", {})
+    assert RateLimitBudget.get("key") is RateLimitBudget.get("key")
+    assert RateLimitBudget.get("key") is not RateLimitBudget.get("other")
+
+
+def test_demand_estimator_decays(clock: list[float]) -> None:
+    demand = DemandEstimator(time_constant=100)
+    demand.record(50)
+    assert demand.current == pytest.approx(0.5)
+    clock[0] += 100
+    assert demand.current == pytest.approx(0.5 / math.e)
+    # A steady rate converges to itself
+    for _ in range(2000):
+        clock[0] += 0.5
+        demand.record()
+    assert demand.current == pytest.approx(2, rel=0.01)
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+
+from disruptor.source import Readiness
+from disruptor.source.cache import Cache
+from disruptor.source.random import Random
+
+from .stubs import FakeDB, StubSource, make_image
+
+
+async def _settle() -> None:
+    # Let background database writes finish
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_cache_survives_restart(bot) -> None:
+    bot.db = FakeDB()
+    config = {"type": "test_stub", "config": {"name": "fresh", "readiness": "warming"},
+              "min_size": 2}
+
+    async def run() -> None:
+        persisted = [make_image("old1"), make_image("old2")]
+        first = Cache(bot, config)
+        bot.db.images[(first.path, first.config_hash)] = persisted
+        await first.prepare()
+        # Persisted images are served while the child is still warming up
+        assert first.readiness.value == "ready"
+        assert (await first.fetch()).title == "old1.jpg"
+        await _settle()
+        await first.stop()
+        assert bot.db.images[(first.path, first.config_hash)] == persisted[1:]
+
+        # A restarted instance gets what the previous one didn't serve
+        second = Cache(bot, config)
+        await second.prepare()
+        assert (await second.fetch()).title == "old2.jpg"
+        await second.stop()
+
+        # A different config doesn't get images fetched with the old one
+        changed = Cache(bot, {**config, "config": {"name": "other"}})
+        await changed.prepare()
+        assert len(changed.cache) == 0
+        await changed.stop()
+
+    asyncio.run(run())
+
+
+def test_refilled_images_are_persisted(bot) -> None:
+    bot.db = FakeDB()
+
+    async def run() -> list[str]:
+        cache = Cache(bot, {"type": "test_stub", "min_size": 2})
+        await cache.prepare()
+        while cache.warming:
+            await asyncio.sleep(0.005)
+        await _settle()
+        await cache.stop()
+        return [image.title for image in bot.db.images[(cache.path, cache.config_hash)]]
+
+    assert asyncio.run(run()) == ["cat.jpg", "cat.jpg"]
+
+
+def test_cache_writes_are_ordered(bot) -> None:
+    bot.db = FakeDB(latency=0.01)
+    source = StubSource(bot, {})
+    image = make_image()
+
+    async def run() -> None:
+        source._store_cached_image(image)
+        source._forget_cached_image(image)
+        await source._cache_writer
+        # Stopping the source cancels writes that haven't finished yet
+        source._store_cached_image(image)
+        await source.stop()
+        await asyncio.sleep(0.02)
+
+    asyncio.run(run())
+    assert bot.db.images == {(source.path, source.config_hash): []}
+
+
+def test_readiness_combines_children() -> None:
+    assert Readiness.combine([]) == Readiness.READY
+    assert Readiness.combine([Readiness.DEGRADED, Readiness.READY]) == Readiness.READY
+    assert Readiness.combine([Readiness.DEGRADED, Readiness.WARMING]) == Readiness.WARMING
+    assert Readiness.combine([Readiness.DEGRADED]) == Readiness.DEGRADED
+
+
+def test_cache_waits_for_warming_child(bot) -> None:
+    async def run() -> None:
+        cache = Cache(bot, {"type": "test_stub", "config": {"readiness": "warming"},
+                            "min_size": 1, "persist_cache": False})
+        # Startup doesn't wait for the cache to fill
+        await asyncio.wait_for(cache.prepare(), 0.1)
+        await asyncio.sleep(0.02)
+        assert cache.readiness == Readiness.WARMING
+        assert cache.source.fetches == 0
+        cache.source.warming = False
+        await asyncio.wait_for(_wait_warm(cache), 0.1)
+        assert cache.readiness == Readiness.READY
+        assert cache.source.fetches == 1
+        await cache.stop()
+
+    asyncio.run(run())
+
+
+async def _wait_warm(cache: Cache) -> None:
+    while cache.warming:
+        await asyncio.sleep(0.005)
+
+
+def test_wait_until_warm_follows_children(bot) -> None:
+    async def run() -> None:
+        tree = Random(bot, {"sources": [
+            {"type": "test_stub", "weight": 1, "config": {"readiness": "warming"}},
+            {"type": "test_stub", "weight": 1, "config": {"readiness": "warming"}},
+        ]})
+        await tree.prepare()
+        waiter = asyncio.create_task(tree.wait_until_warm())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        # One ready child is enough for the tree to be ready
+        tree.sources[1].warming = False
+        await asyncio.wait_for(waiter, 0.1)
+        assert tree.readiness == Readiness.READY
+
+    asyncio.run(run())
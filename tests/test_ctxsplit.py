@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import asyncio
+
+from mautrix.types import RoomID, UserID
+import pytest
+
+from disruptor.source import CancelDisruption, DisruptionContext
+from disruptor.source.ctxsplit import ContextSplit
+
+
+def _ctx(room_id: str, user_id: str = "@user:example.com") -> DisruptionContext:
+    return DisruptionContext(room_id=RoomID(room_id), user_id=UserID(user_id))
+
+
+def _split(bot, *rules: tuple[dict, dict]) -> ContextSplit:
+    config = {"sources": [{"type": "test_stub", "context": context, "config": child}
+                          for context, child in rules]}
+    source = ContextSplit(bot, config)
+    asyncio.run(source.prepare())
+    return source
+
+
+def _route(source: ContextSplit, ctx: DisruptionContext) -> str:
+    return asyncio.run(source.fetch_with_context(ctx)).title
+
+
+def test_matches_each_kind_of_condition(bot) -> None:
+    source = _split(bot,
+                    ({"room_id": "!exact:a.com"}, {"name": "exact"}),
+                    ({"room_servers": ["b.com"]}, {"name": "server"}),
+                    ({"room_globs": ["!glob*:c.com"]}, {"name": "glob"}),
+                    ({"user_regexes": [r"@bot\d+:.*"]}, {"name": "regex"}),
+                    ({}, {"name": "default"}))
+    assert _route(source, _ctx("!exact:a.com")) == "exact.jpg"
+    assert _route(source, _ctx("!other:b.com")) == "server.jpg"
+    assert _route(source, _ctx("!globbed:c.com")) == "glob.jpg"
+    assert _route(source, _ctx("!x:d.com", "@bot12:d.com")) == "regex.jpg"
+    assert _route(source, _ctx("!x:d.com", "@human:d.com")) == "default.jpg"
+
+
+def test_room_and_user_conditions_must_both_match(bot) -> None:
+    source = _split(bot,
+                    ({"room_servers": ["a.com"], "user_ids": ["@admin:a.com"]},
+                     {"name": "both"}),
+                    ({}, {"name": "default"}))
+    assert _route(source, _ctx("!r:a.com", "@admin:a.com")) == "both.jpg"
+    assert _route(source, _ctx("!r:a.com", "@user:a.com")) == "default.jpg"
+    assert _route(source, _ctx("!r:b.com", "@admin:a.com")) == "default.jpg"
+
+
+def test_single_id_and_id_list_must_both_match(bot) -> None:
+    source = _split(bot,
+                    ({"room_id": "!a:a.com", "room_ids": ["!a:a.com", "!b:a.com"]},
+                     {"name": "both"}),
+                    ({"user_id": "@a:a.com", "user_ids": ["@b:a.com"]}, {"name": "never"}),
+                    ({}, {"name": "default"}))
+    assert _route(source, _ctx("!a:a.com")) == "both.jpg"
+    assert _route(source, _ctx("!b:a.com")) == "default.jpg"
+    assert _route(source, _ctx("!c:a.com", "@a:a.com")) == "default.jpg"
+    assert _route(source, _ctx("!c:a.com", "@b:a.com")) == "default.jpg"
+
+
+def test_no_match_cancels(bot) -> None:
+    source = _split(bot, ({"room_id": "!only:a.com"}, {}))
+    with pytest.raises(CancelDisruption):
+        asyncio.run(source.fetch_with_context(_ctx("!other:a.com")))
+
+
+def test_skips_warming_match_only(bot) -> None:
+    source = _split(bot,
+                    ({"room_servers": ["a.com"]}, {"name": "dedicated", "readiness": "warming"}),
+                    ({}, {"name": "default"}))
+    assert _route(source, _ctx("!r:a.com")) == "default.jpg"
+    source.sources[0][1].config["readiness"] = "degraded"
+    source.sources[0][1].warming = False
+    assert _route(source, _ctx("!r:a.com")) == "dedicated.jpg"
+    source.sources[0][1].config["readiness"] = "ready"
+    assert _route(source, _ctx("!r:a.com")) == "dedicated.jpg"
+
+
+def test_uses_first_match_if_all_are_warming(bot) -> None:
+    source = _split(bot,
+                    ({"room_servers": ["a.com"]}, {"name": "first", "readiness": "warming"}),
+                    ({}, {"name": "second", "readiness": "warming"}))
+    assert _route(source, _ctx("!r:a.com")) == "first.jpg"
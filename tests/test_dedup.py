@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+from mautrix.types import ContentURI, ImageInfo
+
+from disruptor.dedup import MediaIndex
+
+
+def _info(size: int = 100) -> ImageInfo:
+    return ImageInfo(mimetype="image/png", size=size, width=10, height=10)
+
+
+def test_lookup_counts_hits_and_saved_bytes() -> None:
+    index = MediaIndex()
+    assert index.get("a") is None
+    index.put("a", ContentURI("mxc://example.com/a"), _info(100))
+    assert index.get("a").url == "mxc://example.com/a"
+    assert index.get("a").url == "mxc://example.com/a"
+    assert (index.hits, index.misses, index.saved_bytes) == (2, 1, 200)
+
+
+def test_only_file_properties_are_indexed() -> None:
+    index = MediaIndex()
+    info = _info()
+    info.thumbnail_url = ContentURI("mxc://example.com/thumb")
+    info["blurhash"] = "LEHV6nWB2yk8pyo0adR*.7kCMdnj"
+    index.put("a", ContentURI("mxc://example.com/a"), info)
+    copy = index.get("a").copy_info()
+    assert copy.thumbnail_url is None
+    assert "blurhash" not in copy.serialize()
+    # Callers can add their own thumbnails without changing the indexed info
+    copy.width = 20
+    assert index.get("a").info.width == 10
+
+
+def test_evicts_least_recently_used() -> None:
+    index = MediaIndex(max_size=2)
+    for name in ("a", "b"):
+        index.put(name, ContentURI(f"mxc://example.com/{name}"), _info())
+    index.get("a")
+    index.put("c", ContentURI("mxc://example.com/c"), _info())
+    assert list(index.entries) == ["a", "c"]
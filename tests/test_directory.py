@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import pytest
+
+from disruptor.source import SourceUnavailable
+from disruptor.source.directory import Directory, scan_directory
+from disruptor.workers import WorkerPool
+
+from .stubs import FakeClient, FakeDB
+
+PNG = bytes.fromhex("89504e470d0a1a0a0000000d4948445200000001000000010802000000907753de"
+                    "0000000c4944415408d763f8cfc000000301010018dd8db00000000049454e44ae426082")
+
+
+def _write(path: str, data: bytes = PNG) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def test_scan_directory(tmp_path) -> None:
+    root = str(tmp_path)
+    for name in ("a.png", "b.JPG", "notes.txt", ".hidden.png", "sub/c.png", ".git/d.png"):
+        _write(os.path.join(root, name))
+    found = scan_directory(root, recursive=True, extensions=(".png", ".jpg"))
+    assert sorted(os.path.relpath(path, root) for path in found) == ["a.png", "b.JPG",
+                                                                     "sub/c.png"]
+    assert found[os.path.join(root, "a.png")][1] == len(PNG)
+    flat = scan_directory(root, recursive=False, extensions=(".png",))
+    assert list(flat) == [os.path.join(root, "a.png")]
+
+
+def test_uploads_new_and_changed_files_only(bot, tmp_path) -> None:
+    root = str(tmp_path)
+    _write(os.path.join(root, "a.png"))
+    _write(os.path.join(root, "b.png"), PNG + b"\0")
+    bot.db = FakeDB()
+    bot.client = FakeClient()
+    bot.media_index = None
+
+    async def run() -> None:
+        bot.workers = WorkerPool(bot.metrics)
+        config = {"path": root, "rescan_interval": 0}
+        source = Directory(bot, config)
+        try:
+            await source.prepare()
+            await source.scan()
+            assert len(bot.client.uploads) == 2
+            assert {image.title for image in source.choices} == {"a.png", "b.png"}
+            assert (await source.fetch()).info.width == 1
+
+            # Touching a file doesn't upload it again, changing it does
+            os.utime(os.path.join(root, "a.png"), ns=(1, 1))
+            _write(os.path.join(root, "b.png"), PNG + b"\0\0")
+            await source.scan()
+            assert len(bot.client.uploads) == 3
+
+            os.remove(os.path.join(root, "a.png"))
+            await source.scan()
+            assert [image.title for image in source.choices] == ["b.png"]
+            assert [path for _, path in bot.db.files] == [os.path.join(root, "b.png")]
+            await source.stop()
+
+            # The index is loaded from the database after a restart
+            restarted = Directory(bot, config)
+            await restarted.prepare()
+            assert [image.title for image in restarted.choices] == ["b.png"]
+            await restarted.stop()
+        finally:
+            bot.workers.shutdown()
+
+    asyncio.run(run())
+    assert len(bot.client.uploads) == 3
+
+
+def test_empty_directory_is_unavailable(bot, tmp_path) -> None:
+    bot.db = FakeDB()
+
+    async def run() -> None:
+        bot.workers = WorkerPool(bot.metrics)
+        source = Directory(bot, {"path": str(tmp_path), "rescan_interval": 0})
+        try:
+            await source.prepare()
+            await source.scan()
+            with pytest.raises(SourceUnavailable):
+                await source.fetch()
+            await source.stop()
+        finally:
+            bot.workers.shutdown()
+
+    asyncio.run(run())
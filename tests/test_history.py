@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import time
+
+from mautrix.types import RoomID
+
+from disruptor.history import ImageHistory
+
+from .stubs import make_image
+
+clock_function = (time, "time")
+
+
+def test_pick_skips_images_recently_sent_in_room(clock: list[float]) -> None:
+    history = ImageHistory(min_reuse_interval=100)
+    history.record(RoomID("!a"), make_image("one"))
+    history.record(RoomID("!b"), make_image("two"))
+    assert history.pick(RoomID("!a")).title == "two.jpg"
+    assert history.pick(RoomID("!b")).title == "one.jpg"
+    assert history.pick(RoomID("!c")) is not None
+    history.record(RoomID("!a"), make_image("two"))
+    assert history.pick(RoomID("!a")) is None
+    clock[0] += 101
+    assert history.pick(RoomID("!a")) is not None
+
+
+def test_evicts_least_recently_sent(clock: list[float]) -> None:
+    history = ImageHistory(max_size=2)
+    for name in ("one", "two", "three"):
+        history.record(RoomID("!a"), make_image(name))
+        clock[0] += 1
+    assert [entry.image.title for entry in history.images.values()] == ["two.jpg", "three.jpg"]
+    # Evicted images are forgotten in room state too
+    assert len(history.room_sends[RoomID("!a")]) == 2
+
+
+def test_prunes_expired_sends_in_idle_rooms(clock: list[float]) -> None:
+    history = ImageHistory(min_reuse_interval=100)
+    for i in range(50):
+        history.record(RoomID(f"!idle{i}"), make_image(f"image{i}"))
+    assert len(history.room_sends) == 50
+    clock[0] += 150
+    history.record(RoomID("!active"), make_image("new"))
+    assert list(history.room_sends) == [RoomID("!active")]
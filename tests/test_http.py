@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable
+import asyncio
+import logging
+
+from aiohttp import ClientConnectionError, ClientSession, web
+from aiohttp.test_utils import TestServer
+import pytest
+
+from disruptor.http import HTTPClient
+
+log = logging.getLogger("test.http")
+
+
+def _serve(responses: list[Callable[[], web.Response]], config: dict[str, Any] | None,
+           use: Callable[[HTTPClient, str], Awaitable[Any]]) -> tuple[Any, int]:
+    calls = 0
+
+    async def handler(_: web.Request) -> web.Response:
+        nonlocal calls
+        calls += 1
+        return responses[min(calls, len(responses)) - 1]()
+
+    async def run() -> Any:
+        app = web.Application()
+        app.router.add_get("/", handler)
+        async with TestServer(app) as server, ClientSession() as session:
+            client = HTTPClient(session, config, log)
+            try:
+                return await use(client, str(server.make_url("/")))
+            finally:
+                await client.close()
+
+    return asyncio.run(run()), calls
+
+
+async def _get_status(client: HTTPClient, url: str) -> tuple[int, str]:
+    async with client.get(url) as resp:
+        return resp.status, await resp.text()
+
+
+def test_retries_temporary_failures() -> None:
+    responses = [lambda: web.Response(status=503), lambda: web.Response(status=502),
+                 lambda: web.Response(text="cat")]
+    result, calls = _serve(responses, {"retry_backoff": 0.01}, _get_status)
+    assert result == (200, "cat")
+    assert calls == 3
+
+
+def test_gives_up_after_retries() -> None:
+    result, calls = _serve([lambda: web.Response(status=500)],
+                           {"retries": 1, "retry_backoff": 0.01}, _get_status)
+    assert result[0] == 500
+    assert calls == 2
+
+
+def test_doesnt_retry_client_errors() -> None:
+    result, calls = _serve([lambda: web.Response(status=404)], {"retry_backoff": 0.01},
+                           _get_status)
+    assert result[0] == 404
+    assert calls == 1
+
+
+def test_honors_retry_after() -> None:
+    def limited() -> web.Response:
+        return web.Response(status=429, headers={"Retry-After": "0.1"})
+
+    result, calls = _serve([limited, lambda: web.Response(text="cat")], {"retry_backoff": 10},
+                           _get_status)
+    assert result == (200, "cat")
+    # Waiting longer than the limit isn't worth it, the caller gets the 429 instead
+    def long_wait() -> web.Response:
+        return web.Response(status=429, headers={"Retry-After": "3600"})
+
+    result, calls = _serve([long_wait], {"max_retry_delay": 30}, _get_status)
+    assert result[0] == 429
+    assert calls == 1
+
+
+def test_retries_connection_errors() -> None:
+    async def run() -> int:
+        attempts = 0
+        async with ClientSession() as session:
+            client = HTTPClient(session, None, log)
+            client.retry_backoff = 0.01
+
+            async def refuse(*args: Any, **kwargs: Any) -> None:
+                nonlocal attempts
+                attempts += 1
+                raise ClientConnectionError("refused")
+
+            session.request = refuse
+            with pytest.raises(ClientConnectionError):
+                await client._request("GET", "http://example.com")
+        return attempts
+
+    assert asyncio.run(run()) == 3
+
+
+def test_own_session_only_with_config() -> None:
+    async def run() -> tuple[bool, bool, bool]:
+        async with ClientSession() as session:
+            shared = HTTPClient(session, None, log)
+            own = HTTPClient(session, {"limit_per_host": 2}, log)
+            await shared.close()
+            await own.close()
+            return shared.session is session, own.session is session, own.session.closed
+
+    assert asyncio.run(run()) == (True, False, True)
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("PIL")
+from PIL import Image as PILImage, ImageOps  # noqa: E402
+
+from disruptor.imaging import (EXIF_ORIENTATION, encode_blurhash, image_size,  # noqa: E402
+                               make_thumbnail, strip_jpeg_metadata, transcode)
+
+
+def _image(size: tuple[int, int], mode: str = "RGB") -> PILImage.Image:
+    noise = PILImage.effect_noise(size, 80)
+    gradient = PILImage.linear_gradient("L").resize(size)
+    bands = [noise, gradient, noise.transpose(PILImage.Transpose.FLIP_LEFT_RIGHT)]
+    if mode == "RGBA":
+        bands.append(gradient.transpose(PILImage.Transpose.FLIP_TOP_BOTTOM))
+    return PILImage.merge(mode, bands)
+
+
+def _encode(img: PILImage.Image, format: str = "JPEG", **kwargs) -> bytes:
+    out = BytesIO()
+    img.save(out, format=format, **kwargs)
+    return out.getvalue()
+
+
+def test_blurhash_matches_reference_implementation() -> None:
+    blurhash = pytest.importorskip("blurhash")
+    img = _image((32, 24))
+    pixels = [[list(img.getpixel((x, y))) for x in range(32)] for y in range(24)]
+    assert encode_blurhash(img) == blurhash.encode(pixels, 4, 3)
+    assert encode_blurhash(img, 2, 2) == blurhash.encode(pixels, 2, 2)
+
+
+def test_image_size_from_truncated_file() -> None:
+    data = _encode(_image((640, 480)))
+    assert image_size(data[:4096]) == (640, 480)
+
+
+def test_thumbnail_keeps_aspect_ratio_and_transparency() -> None:
+    thumbnail = make_thumbnail(_encode(_image((800, 400))), 200)
+    assert (thumbnail.mimetype, thumbnail.width, thumbnail.height) == ("image/jpeg", 200, 100)
+    assert PILImage.open(BytesIO(thumbnail.data)).size == (200, 100)
+    assert len(thumbnail.blurhash) == 28
+    transparent = make_thumbnail(_encode(_image((100, 300), "RGBA"), "PNG"), 150)
+    assert (transparent.mimetype, transparent.width, transparent.height) == ("image/png", 50, 150)
+
+
+def test_thumbnail_applies_exif_rotation() -> None:
+    exif = PILImage.Exif()
+    exif[EXIF_ORIENTATION] = 6
+    thumbnail = make_thumbnail(_encode(_image((400, 200)), exif=exif), 100)
+    assert (thumbnail.width, thumbnail.height) == (50, 100)
+
+
+def _segments(data: bytes) -> list[int]:
+    markers = []
+    pos = 2
+    while data[pos + 1] != 0xDA:
+        markers.append(data[pos + 1])
+        pos += 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+    return markers
+
+
+def test_strip_jpeg_metadata() -> None:
+    exif = PILImage.Exif()
+    exif[0x010F] = "Camera maker"
+    data = _encode(_image((64, 64)), exif=exif, comment=b"hello", icc_profile=b"\0" * 128)
+    assert {0xE1, 0xE2, 0xFE} <= set(_segments(data))
+    stripped = strip_jpeg_metadata(data)
+    markers = _segments(stripped)
+    assert 0xE1 not in markers and 0xFE not in markers
+    # Small color profiles are kept
+    assert 0xE2 in markers
+    # The compressed image data isn't touched
+    assert data.endswith(stripped[stripped.index(b"\xff\xda"):])
+    assert PILImage.open(BytesIO(stripped)).tobytes() == PILImage.open(BytesIO(data)).tobytes()
+
+
+def test_strip_jpeg_metadata_keeps_rotation_and_drops_large_profiles() -> None:
+    exif = PILImage.Exif()
+    exif[EXIF_ORIENTATION] = 3
+    data = _encode(_image((64, 64)), exif=exif, icc_profile=b"\0" * 100_000)
+    markers = _segments(strip_jpeg_metadata(data))
+    assert 0xE1 in markers
+    assert 0xE2 not in markers
+
+
+def test_strip_jpeg_metadata_drops_everything_but_rotation_from_exif() -> None:
+    exif = PILImage.Exif()
+    exif[EXIF_ORIENTATION] = 6
+    exif[0x010F] = "Camera maker"
+    gps = exif.get_ifd(0x8825)
+    gps[1] = "N"
+    gps[2] = (52.0, 22.0, 1.0)
+    data = _encode(_image((64, 32)), exif=exif)
+    stripped = strip_jpeg_metadata(data)
+    assert _segments(stripped).count(0xE1) == 1
+    assert b"Camera maker" not in stripped
+    kept = PILImage.open(BytesIO(stripped)).getexif()
+    assert dict(kept) == {EXIF_ORIENTATION: 6}
+    assert kept.get_ifd(0x8825) == {}
+    assert ImageOps.exif_transpose(PILImage.open(BytesIO(stripped))).size == (32, 64)
+
+
+def test_strip_jpeg_metadata_leaves_other_data_alone() -> None:
+    png = _encode(_image((16, 16)), "PNG")
+    assert strip_jpeg_metadata(png) is png
+    truncated = _encode(_image((16, 16)), comment=b"hello")[:30]
+    assert strip_jpeg_metadata(truncated) is truncated
+
+
+def test_transcode_downscales_to_fit() -> None:
+    result = transcode(_encode(_image((1600, 900)), "PNG"), "image/png", 800, 800)
+    assert (result.mimetype, result.width, result.height) == ("image/jpeg", 800, 450)
+    assert PILImage.open(BytesIO(result.data)).format == "JPEG"
+    webp = transcode(_encode(_image((300, 300), "RGBA"), "PNG"), "image/png", 100, 100,
+                     format="webp")
+    assert webp.mimetype == "image/webp"
+    assert PILImage.open(BytesIO(webp.data)).mode == "RGBA"
+
+
+def test_transcode_keeps_original_when_it_wouldnt_help() -> None:
+    small_jpeg = _encode(_image((100, 100)))
+    assert transcode(small_jpeg, "image/jpeg", 800, 800) is None
+    # Converting a tiny PNG that already fits would make it bigger
+    tiny_png = _encode(PILImage.new("RGB", (100, 100), "white"), "PNG")
+    assert transcode(tiny_png, "image/png", 800, 800) is None
+    frames = [_image((64, 64)), _image((64, 64)).rotate(90)]
+    gif = _encode(frames[0], "GIF", save_all=True, append_images=frames[1:])
+    assert transcode(gif, "image/gif", 32, 32) is None
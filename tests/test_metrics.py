@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import pytest
+
+from disruptor.metrics import Counter, Gauge, Histogram, Metric, Metrics
+
+
+def test_metric_subclass_must_implement_samples() -> None:
+    class Incomplete(Metric):
+        type_name = "untyped"
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "Missing samples")
+
+
+def test_counter_and_gauge_render() -> None:
+    counter = Counter("fetches_total", "Fetches", ("source",))
+    counter.inc(source="a")
+    counter.inc(2, source='quo"te')
+    assert counter.render() == ("# HELP fetches_total Fetches\n"
+                                "# TYPE fetches_total counter\n"
+                                'fetches_total{source="a"} 1\n'
+                                'fetches_total{source="quo\\"te"} 2')
+    gauge = Gauge("depth", "Depth")
+    gauge.set(0.5)
+    assert gauge.render().endswith("\ndepth 0.5")
+    gauge.clear()
+    assert gauge.render() == "# HELP depth Depth\n# TYPE depth gauge"
+
+
+def test_histogram_buckets_are_cumulative() -> None:
+    histogram = Histogram("latency", "Latency", buckets=(1, 0.1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    assert histogram.render().split("\n")[2:] == ['latency_bucket{le="0.1"} 1',
+                                                  'latency_bucket{le="1"} 2',
+                                                  'latency_bucket{le="+Inf"} 3',
+                                                  "latency_sum 5.55",
+                                                  "latency_count 3"]
+
+
+def test_all_metrics_render() -> None:
+    metrics = Metrics()
+    metrics.observe_fetch("root", "fetch", "ok", 0.2)
+    text = metrics.render()
+    assert text.endswith("\n")
+    assert 'disruptor_source_fetches_total{source="root",method="fetch",outcome="ok"} 1' in text
+    assert text.count("# TYPE ") == len(metrics.all)
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import asyncio
+
+from disruptor.source.pipeline import RefillPipeline
+
+
+def test_results_in_submission_order_with_bounded_concurrency() -> None:
+    async def run() -> tuple[list, int]:
+        active = peak = 0
+
+        async def job(i: int) -> int:
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            # Later jobs finish first
+            await asyncio.sleep(0.01 * (5 - i))
+            active -= 1
+            if i == 2:
+                raise ValueError("broken image")
+            return i
+
+        results = [result async for result in RefillPipeline(2).run(job(i) for i in range(5))]
+        return results, peak
+
+    results, peak = asyncio.run(run())
+    assert results[:2] == [0, 1]
+    assert isinstance(results[2], ValueError)
+    assert results[3:] == [3, 4]
+    assert peak == 2
+
+
+def test_stopping_early_cancels_remaining_jobs() -> None:
+    async def run() -> list[int]:
+        finished = []
+
+        async def job(i: int) -> int:
+            await asyncio.sleep(0.01 * i)
+            finished.append(i)
+            return i
+
+        pipeline = RefillPipeline(4).run(job(i) for i in range(4))
+        assert await pipeline.__anext__() == 0
+        await pipeline.aclose()
+        await asyncio.sleep(0.05)
+        return finished
+
+    assert asyncio.run(run()) == [0]
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from collections import Counter
+import asyncio
+import random
+import time
+
+import pytest
+
+from disruptor.source import CancelDisruption, SourceUnavailable
+from disruptor.source.random import AliasTable, ChildHealth, Random
+
+
+def test_alias_table_matches_weights() -> None:
+    random.seed(1)
+    table = AliasTable([10, 20, 30], [0.5, 0.3, 0.2])
+    counts = Counter(table.sample() for _ in range(50_000))
+    assert set(counts) == {10, 20, 30}
+    for index, weight in ((10, 0.5), (20, 0.3), (30, 0.2)):
+        assert counts[index] / 50_000 == pytest.approx(weight, abs=0.01)
+
+
+def test_alias_table_zero_weights() -> None:
+    table = AliasTable([1, 2], [0, 0])
+    assert {table.sample() for _ in range(100)} == {1, 2}
+
+
+def test_health_decays_over_time(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    health = ChildHealth(half_life=60)
+    for _ in range(10):
+        health.record(False, 2, alpha=0.2)
+    assert health.error_rate > 0.8
+    now += 60
+    assert health.error_rate == pytest.approx(0.446, abs=0.01)
+    now += 600
+    assert health.error_rate < 0.01
+    assert health.latency < 0.01
+
+
+def _random(bot, *children: dict) -> Random:
+    config = {"sources": [{"type": "test_stub", "weight": 1, "config": child}
+                          for child in children]}
+    source = Random(bot, config)
+    asyncio.run(source.prepare())
+    return source
+
+
+def test_fails_over_to_healthy_child(bot) -> None:
+    source = _random(bot, {"mode": "error"}, {"mode": "ok", "name": "good"})
+    for _ in range(10):
+        assert asyncio.run(source.fetch()).title == "good.jpg"
+
+
+def test_failed_child_is_tried_again_after_decay(bot, monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    source = _random(bot, {"mode": "error"}, {"mode": "ok"})
+    for _ in range(20):
+        asyncio.run(source.fetch())
+    broken = source.sources[0]
+    assert source.health[0].error_rate > source.max_error_rate
+    tried = broken.fetches
+    for _ in range(20):
+        asyncio.run(source.fetch())
+    assert broken.fetches == tried
+    now += 600
+    for _ in range(20):
+        asyncio.run(source.fetch())
+    assert broken.fetches > tried
+
+
+def test_all_children_failing_is_unavailable(bot) -> None:
+    source = _random(bot, {"mode": "error"}, {"mode": "unavailable"})
+    with pytest.raises(SourceUnavailable):
+        asyncio.run(source.fetch())
+
+
+def test_deliberate_cancel_is_passed_through(bot) -> None:
+    source = _random(bot, {"mode": "cancel"})
+    with pytest.raises(CancelDisruption) as exc_info:
+        asyncio.run(source.fetch())
+    assert not isinstance(exc_info.value, SourceUnavailable)
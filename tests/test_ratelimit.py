@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+import pytest
+
+from disruptor import ratelimit
+from disruptor.ratelimit import DatabaseBackend, Limit, MemoryBackend, RateLimiter
+
+from .stubs import FakeDB
+
+clock_function = (ratelimit, "time")
+
+
+def _check(limiter: RateLimiter, *requests: tuple[Limit, str]) -> Limit | None:
+    return asyncio.run(limiter.check(*requests))
+
+
+def test_allows_burst_then_emission_rate(clock: list[float]) -> None:
+    limit = Limit(name="user", rate=3, per=60)
+    limiter = RateLimiter(MemoryBackend())
+    for _ in range(3):
+        assert _check(limiter, (limit, "@a")) is None
+    assert _check(limiter, (limit, "@a")) is limit
+    # Other keys have their own allowance
+    assert _check(limiter, (limit, "@b")) is None
+    clock[0] += 19
+    assert _check(limiter, (limit, "@a")) is limit
+    clock[0] += 1
+    assert _check(limiter, (limit, "@a")) is None
+    assert _check(limiter, (limit, "@a")) is limit
+
+
+def test_denied_request_doesnt_count_against_other_limits(clock: list[float]) -> None:
+    user = Limit(name="user", rate=1, per=60)
+    room = Limit(name="room", rate=2, per=60)
+    limiter = RateLimiter(MemoryBackend())
+    assert _check(limiter, (user, "@a"), (room, "!r")) is None
+    assert _check(limiter, (user, "@a"), (room, "!r")) is user
+    # The denied request above didn't use the room's second slot
+    assert _check(limiter, (user, "@b"), (room, "!r")) is None
+    assert _check(limiter, (user, "@c"), (room, "!r")) is room
+
+
+def test_memory_backend_sweeps_expired_keys(clock: list[float]) -> None:
+    backend = MemoryBackend(sweep_interval=10)
+    limiter = RateLimiter(backend)
+    _check(limiter, (Limit(name="user", rate=1, per=5), "@a"))
+    assert list(backend.tats) == ["user:@a"]
+    clock[0] += 30
+    asyncio.run(backend.get(["user:@b"]))
+    assert backend.tats == {}
+
+
+def test_database_backend_loads_and_flushes(clock: list[float]) -> None:
+    limit = Limit(name="user", rate=1, per=60)
+    db = FakeDB({"user:@a": clock[0] + 30})
+    backend = DatabaseBackend(db, logging.getLogger("test.ratelimit"))
+    limiter = RateLimiter(backend)
+    # Limited by the TAT stored before a restart
+    assert _check(limiter, (limit, "@a")) is limit
+    assert _check(limiter, (limit, "@b")) is None
+    assert "user:@b" not in db.ratelimits
+    db.fail = True
+    with pytest.raises(RuntimeError):
+        asyncio.run(backend.flush())
+    assert "user:@b" in backend.dirty
+    db.fail = False
+    asyncio.run(backend.flush())
+    assert db.ratelimits["user:@b"] == clock[0] + 60
+    assert backend.dirty == {}
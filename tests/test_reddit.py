@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+from typing import Any, Optional
+from collections import OrderedDict
+import asyncio
+
+import pytest
+
+from disruptor.source.reddit import Reddit
+
+from .stubs import make_image
+
+
+def _post(post_id: str, hint: str = "image", nsfw: bool = False) -> dict[str, Any]:
+    return {"data": {"id": post_id, "post_hint": hint, "over_18": nsfw, "title": post_id,
+                     "url": f"https://i.redd.it/{post_id}.jpg",
+                     "permalink": f"/r/cats/comments/{post_id}/"}}
+
+
+class FakeListing:
+    """Serves pages of posts by subreddit and ``after`` cursor."""
+
+    def __init__(self, pages: dict[tuple[str, Optional[str]], tuple[list, Optional[str]]]
+                 ) -> None:
+        self.pages = pages
+        self.requests: list[tuple[str, Optional[str]]] = []
+
+    async def fetch_posts(self, subreddit: str, after: Optional[str] = None
+                          ) -> tuple[Optional[list], Optional[str]]:
+        self.requests.append((subreddit, after))
+        return self.pages.get((subreddit, after), ([], None))
+
+
+def _reddit(bot, monkeypatch: pytest.MonkeyPatch, listing: FakeListing, **config: Any
+            ) -> Reddit:
+    async def reupload(self: Reddit, url: Any, title: str, **_: Any) -> Any:
+        return make_image(title)
+
+    monkeypatch.setattr(Reddit, "_reupload", reupload)
+    # Without prefetching, warming up doesn't load anything, so tests control every load
+    source = Reddit(bot, {"user_agent": "test", "prefetch": 0, "persist_cache": False,
+                          **config})
+    monkeypatch.setattr(source, "fetch_posts", listing.fetch_posts)
+    return source
+
+
+def test_skips_seen_and_unsuitable_posts(bot, monkeypatch: pytest.MonkeyPatch) -> None:
+    listing = FakeListing({("cats", None): ([_post("a"), _post("b", hint="link"),
+                                             _post("c", nsfw=True), _post("a")], None)})
+    source = _reddit(bot, monkeypatch, listing, subreddit="cats", min_cache_size=1)
+
+    async def run() -> list[str]:
+        await source.prepare()
+        await bot.tasks.stop()
+        # An empty cache is reloaded by the fetch
+        titles = [(await source.fetch()).title]
+        # The front page hasn't changed, so the same post isn't cached again
+        await source.load_disruption_content()
+        return titles + [content["title"] for content in source.cache]
+
+    assert asyncio.run(run()) == ["a.jpg"]
+
+
+def test_seen_ids_are_bounded(bot) -> None:
+    source = Reddit(bot, {"subreddit": "cats"})
+    source.seen_ids = OrderedDict()
+    source.dedup_size = 2
+    assert source._mark_seen("a") and source._mark_seen("b")
+    assert not source._mark_seen("a")
+    # "b" is now the oldest, so it's forgotten first
+    assert source._mark_seen("c")
+    assert list(source.seen_ids) == ["a", "c"]
+    assert source._mark_seen("b")
+
+
+def test_loads_pages_until_enough_posts(bot, monkeypatch: pytest.MonkeyPatch) -> None:
+    listing = FakeListing({
+        ("cats", None): ([_post("a1")], "p2"),
+        ("cats", "p2"): ([_post("a2")], "p3"),
+        ("cats", "p3"): ([_post("a3")], "p4"),
+        ("dogs", None): ([_post("b1"), _post("b2")], "q2"),
+    })
+    source = _reddit(bot, monkeypatch, listing, subreddits=["cats", "dogs"], min_cache_size=2)
+
+    async def run() -> None:
+        await source.prepare()
+        await bot.tasks.stop()
+        await source.load_disruption_content()
+        assert sorted(content["title"] for content in source.cache) == ["a1", "a2", "b1", "b2"]
+        assert source.cursors == {"cats": "p3", "dogs": "q2"}
+        source.cache.clear()
+        listing.requests.clear()
+        await source.load_disruption_content()
+        # The next load continues from the stored cursor after checking the front page
+        assert listing.requests[:2] == [("cats", None), ("cats", "p3")]
+
+    asyncio.run(run())
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+from typing import Any
+import asyncio
+import io
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+from yarl import URL
+import pytest
+
+from disruptor.source.abstract import MediaTooLarge
+from disruptor.workers import WorkerPool
+
+from .stubs import FakeClient, StubSource
+
+pytest.importorskip("PIL")
+from PIL import Image as PILImage  # noqa: E402
+
+
+def _png(size: tuple[int, int]) -> bytes:
+    # Noise doesn't compress, so the file is big enough to arrive in several chunks
+    image = PILImage.effect_noise(size, 64).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "PNG")
+    return out.getvalue()
+
+
+def _reupload(bot, data: bytes, config: dict[str, Any], chunked: bool = False
+              ) -> tuple[Any, list]:
+    async def handler(request: web.Request) -> web.StreamResponse:
+        if not chunked:
+            return web.Response(body=data, content_type="image/png")
+        # No Content-Length, so the size is only known while reading
+        resp = web.StreamResponse(headers={"Content-Type": "image/png"})
+        resp.enable_chunked_encoding()
+        await resp.prepare(request)
+        for i in range(0, len(data), 16 * 1024):
+            await resp.write(data[i:i + 16 * 1024])
+        await resp.write_eof()
+        return resp
+
+    async def run() -> Any:
+        app = web.Application()
+        app.router.add_get("/cat.png", handler)
+        async with TestServer(app) as server, ClientSession() as session:
+            bot.http = session
+            bot.client = FakeClient()
+            bot.media_index = None
+            bot.workers = WorkerPool(bot.metrics)
+            source = StubSource(bot, config)
+            try:
+                image = await source._reupload(URL(str(server.make_url("/cat.png"))))
+            finally:
+                await source.stop()
+                bot.workers.shutdown()
+            return image, bot.client.uploads
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_reupload_sends_the_whole_file(bot, stream: bool) -> None:
+    data = _png((512, 512))
+    assert len(data) > 3 * 64 * 1024
+    image, uploads = _reupload(bot, data, {"stream_uploads": stream})
+    assert uploads == [(data, "image/png")]
+    assert image.info.size == len(data)
+    assert (image.info.width, image.info.height) == (512, 512)
+    assert image.title == "cat.png"
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_reupload_rejects_files_over_max_bytes(bot, chunked: bool) -> None:
+    data = _png((512, 512))
+    with pytest.raises(MediaTooLarge):
+        _reupload(bot, data, {"max_bytes": len(data) - 1}, chunked=chunked)
+    assert bot.client.uploads == []
+    image, uploads = _reupload(bot, data, {"max_bytes": len(data)}, chunked=chunked)
+    assert uploads == [(data, "image/png")]
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from mautrix.errors import MatrixUnknownRequestError, MLimitExceeded
+from mautrix.types import RoomID
+
+from disruptor.sendqueue import QueuedSend, SendQueue, _retry_after
+
+log = logging.getLogger("test")
+
+
+def test_retry_after() -> None:
+    assert _retry_after(ValueError("not a rate limit")) is None
+    assert _retry_after(MLimitExceeded(429, "slow down")) == 0
+    unknown = MatrixUnknownRequestError(429, '{"errcode": "M_UNKNOWN", "retry_after_ms": 1500}')
+    assert _retry_after(unknown) == 1.5
+    assert _retry_after(MatrixUnknownRequestError(429, "<html>")) == 0
+
+
+def _pause_after(error: Exception, **kwargs: float) -> tuple[float, list[str]]:
+    async def run() -> tuple[float, list[str]]:
+        results: list[str] = []
+
+        async def send(room_id: RoomID, content: object) -> None:
+            if not results:
+                results.append("limited")
+                raise error
+
+        queue = SendQueue(send, log, **kwargs)
+        queue.start()
+        start = time.monotonic()
+        queue.put(QueuedSend(RoomID("!a:example.com"), None, results.append))
+        while not queue.idle:
+            await asyncio.sleep(0.01)
+        pause = queue.paused_until - start
+        await queue.stop()
+        return pause, results
+
+    return asyncio.run(run())
+
+
+def test_rate_limit_pauses_for_retry_after() -> None:
+    error = MatrixUnknownRequestError(429, '{"retry_after_ms": 300}')
+    pause, results = _pause_after(error, retry_backoff=10, max_retry_backoff=10)
+    assert results == ["limited", "sent"]
+    assert 0.3 <= pause < 0.5
+
+
+def test_rate_limit_without_delay_backs_off() -> None:
+    pause, results = _pause_after(MLimitExceeded(429, "slow down"), retry_backoff=0.2)
+    assert results == ["limited", "sent"]
+    assert 0.1 <= pause < 0.4
+
+
+def test_coalesces_pending_entries_per_room() -> None:
+    async def run() -> tuple[list[tuple[RoomID, object]], list[tuple[int, str]]]:
+        sent = []
+        results = []
+
+        async def send(room_id: RoomID, content: object) -> None:
+            await asyncio.sleep(0.01)
+            sent.append((room_id, content))
+
+        queue = SendQueue(send, log, concurrency=2)
+        for i, room_id in enumerate(["!a", "!a", "!b", "!a"]):
+            queue.put(QueuedSend(RoomID(room_id), i, lambda r, i=i: results.append((i, r))))
+        queue.start()
+        while not queue.idle:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return sent, results
+
+    sent, results = asyncio.run(run())
+    assert sorted(sent) == [("!a", 3), ("!b", 2)]
+    assert sorted(results) == [(0, "coalesced"), (1, "coalesced"), (2, "sent"), (3, "sent")]
+
+
+def test_drops_stale_entries() -> None:
+    async def run() -> list[str]:
+        results = []
+
+        async def send(room_id: RoomID, content: object) -> None:
+            pass
+
+        queue = SendQueue(send, log, max_age=1)
+        queue.put(QueuedSend(RoomID("!a"), None, results.append, created=time.monotonic() - 5))
+        queue.start()
+        while not queue.idle:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return results
+
+    assert asyncio.run(run()) == ["stale"]
+
+
+def test_entry_max_age_limits_queued_and_inflight_sends() -> None:
+    async def run() -> list[tuple[str, str]]:
+        results = []
+
+        async def send(room_id: RoomID, content: object) -> None:
+            if room_id == "!slow":
+                await asyncio.sleep(1)
+
+        queue = SendQueue(send, log, max_age=30)
+        queue.put(QueuedSend(RoomID("!old"), None, lambda r: results.append(("!old", r)),
+                             created=time.monotonic() - 2, max_age=1))
+        queue.put(QueuedSend(RoomID("!slow"), None, lambda r: results.append(("!slow", r)),
+                             max_age=0.1))
+        queue.start()
+        await asyncio.sleep(0.02)
+        while not queue.idle:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return results
+
+    assert sorted(asyncio.run(run())) == [("!old", "stale"), ("!slow", "stale")]
+
+
+def test_limits_sends_per_room() -> None:
+    async def run() -> int:
+        active: dict[RoomID, int] = {}
+        peak = 0
+
+        async def send(room_id: RoomID, content: object) -> None:
+            nonlocal peak
+            active[room_id] = active.get(room_id, 0) + 1
+            peak = max(peak, active[room_id])
+            await asyncio.sleep(0.02)
+            active[room_id] -= 1
+
+        queue = SendQueue(send, log, concurrency=4, per_room=1)
+        queue.start()
+        for _ in range(3):
+            queue.put(QueuedSend(RoomID("!a"), None, lambda _: None))
+            await asyncio.sleep(0.005)
+        while not queue.idle:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return peak
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from typing import Any
+import asyncio
+
+import pytest
+
+from disruptor.source.shared import PoolEntry, SharedPool
+
+
+@pytest.fixture(autouse=True)
+def clean_pools(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(SharedPool, "_pools", {})
+
+
+class Upstream:
+    def __init__(self, delay: float = 0) -> None:
+        self.delay = delay
+        self.next = 0
+        self.calls: list[int] = []
+
+    async def fetch(self, count: int) -> list[dict[str, Any]]:
+        self.calls.append(count)
+        await asyncio.sleep(self.delay)
+        items = [{"id": self.next + i} for i in range(count)]
+        self.next += count
+        return items
+
+
+def _ids(entries) -> list[int]:
+    return [entry.data["id"] for entry in entries]
+
+
+def test_every_subscriber_sees_every_entry_once() -> None:
+    upstream = Upstream()
+    a, b = object(), object()
+    pool = SharedPool.subscribe("key", a, upstream.fetch)
+    SharedPool.subscribe("key", b, upstream.fetch)
+
+    async def run() -> None:
+        assert _ids(await pool.take(a, 3)) == [0, 1, 2]
+        assert _ids(await pool.take(b, 2)) == [0, 1]
+        assert _ids(await pool.take(b, 2)) == [2, 3]
+        assert _ids(await pool.take(a, 1)) == [3]
+
+    asyncio.run(run())
+    assert upstream.calls == [3, 1]
+
+
+def test_concurrent_takers_share_one_fetch() -> None:
+    upstream = Upstream(delay=0.05)
+    subscribers = [object() for _ in range(4)]
+    for subscriber in subscribers:
+        pool = SharedPool.subscribe("key", subscriber, upstream.fetch)
+
+    async def run() -> list[list[PoolEntry]]:
+        return await asyncio.gather(*(pool.take(sub, 2) for sub in subscribers))
+
+    results = asyncio.run(run())
+    assert [_ids(entries) for entries in results] == [[0, 1]] * 4
+    assert upstream.calls == [2]
+
+
+def test_take_with_enough_entries_does_not_wait_for_fetch() -> None:
+    upstream = Upstream()
+    a, b = object(), object()
+    pool = SharedPool.subscribe("key", a, upstream.fetch)
+    SharedPool.subscribe("key", b, upstream.fetch)
+
+    async def run() -> None:
+        await pool.take(a, 2)
+        upstream.delay = 10
+        slow = asyncio.create_task(pool.take(a, 1))
+        await asyncio.sleep(0.01)
+        assert pool.fetch_lock.locked()
+        assert _ids(await asyncio.wait_for(pool.take(b, 2), 0.1)) == [0, 1]
+        slow.cancel()
+
+    asyncio.run(run())
+
+
+def test_pool_is_removed_after_last_unsubscribe() -> None:
+    upstream = Upstream()
+    a, b = object(), object()
+    pool = SharedPool.subscribe("key", a, upstream.fetch)
+    assert SharedPool.subscribe("key", b, upstream.fetch) is pool
+    pool.unsubscribe(a)
+    assert SharedPool._pools == {"key": pool}
+    pool.unsubscribe(b)
+    assert SharedPool._pools == {}
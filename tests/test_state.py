@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import asyncio
+
+from disruptor import state
+from disruptor.state import IdleEvictingDict, MonologueInfo
+
+clock_function = (state, "time")
+
+
+def test_creates_missing_entries(clock: list[float]) -> None:
+    entries = IdleEvictingDict(MonologueInfo, ttl=60)
+    assert entries.get("!a") is None
+    entries["!a"].message("@user")
+    assert entries["!a"].streak == 1
+    assert len(entries) == 1
+
+
+def test_evicts_only_idle_entries(clock: list[float]) -> None:
+    entries = IdleEvictingDict(MonologueInfo, ttl=60)
+    entries["!a"].message("@user")
+    clock[0] += 30
+    entries["!b"].message("@user")
+    clock[0] += 31
+    # Reading !b evicts !a, which was idle for longer than the TTL
+    entries["!b"]
+    assert list(entries) == ["!b"]
+    assert entries["!a"].streak == 0
+
+
+def test_recently_used_entries_move_to_the_end(clock: list[float]) -> None:
+    entries = IdleEvictingDict(MonologueInfo, ttl=60)
+    entries["!a"], entries["!b"]
+    clock[0] += 30
+    entries["!a"]
+    clock[0] += 31
+    assert entries.evict_idle() == 1
+    assert list(entries) == ["!a"]
+
+
+def test_locked_entries_are_kept(clock: list[float]) -> None:
+    entries = IdleEvictingDict(MonologueInfo, ttl=60)
+
+    async def run() -> None:
+        async with entries["!a"].lock:
+            clock[0] += 120
+            assert entries.evict_idle() == 0
+        clock[0] += 120
+        assert entries.evict_idle() == 1
+
+    asyncio.run(run())
+    assert len(entries) == 0
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+
+import pytest
+
+from disruptor.tasks import BreakerState, CircuitBreaker, TaskCoordinator
+
+log = logging.getLogger("test.tasks")
+
+
+def test_breaker_opens_after_threshold(clock: list[float]) -> None:
+    breaker = CircuitBreaker(threshold=3, backoff=10)
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.state == BreakerState.CLOSED
+    breaker.record_failure()
+    assert breaker.state == BreakerState.OPEN
+    assert 7.5 <= breaker.retry_delay <= 12.5
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_probe(clock: list[float]) -> None:
+    breaker = CircuitBreaker(threshold=1, backoff=10)
+    breaker.record_failure()
+    clock[0] += 13
+    assert breaker.allow()
+    assert breaker.state == BreakerState.HALF_OPEN
+    # Only one probe at a time
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == BreakerState.OPEN
+    # The second opening backs off for longer
+    assert 15 <= breaker.retry_delay <= 25
+    clock[0] += 26
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == BreakerState.CLOSED
+    assert breaker.allow()
+
+
+def test_run_is_single_flight() -> None:
+    async def run() -> int:
+        tasks = TaskCoordinator(log)
+        owner = object()
+        calls = 0
+
+        async def work() -> int:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        first = tasks.run(owner, "refill", work)
+        assert tasks.run(owner, "refill", work) is first
+        assert tasks.run(owner, "other", work) is not first
+        assert await first == 2
+        second = tasks.run(owner, "refill", work)
+        assert second is not first
+        assert await second == 3
+        return calls
+
+    assert asyncio.run(run()) == 3
+
+
+def test_failures_open_breaker_and_log_delay(caplog: pytest.LogCaptureFixture) -> None:
+    async def run() -> TaskCoordinator:
+        tasks = TaskCoordinator(log, threshold=2, backoff=2)
+        owner = object()
+
+        async def work() -> None:
+            raise RuntimeError("upstream down")
+
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await tasks.run(owner, "refill", work)
+        assert tasks.run(owner, "refill", work) is None
+        assert tasks.breaker(owner).is_open
+        return tasks
+
+    with caplog.at_level(logging.WARNING, logger=log.name):
+        asyncio.run(run())
+    message = caplog.records[-1].getMessage()
+    assert message.startswith("Background refill for")
+    # Short pauses are shown with a decimal instead of rounding to a whole second
+    assert re.search(r"pausing for \d+\.\d seconds$", message)
+
+
+def test_limited_tasks_share_global_cap() -> None:
+    async def run() -> int:
+        tasks = TaskCoordinator(log, max_tasks=2)
+        active = peak = 0
+
+        async def work() -> None:
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+        await asyncio.gather(*(tasks.spawn(object(), work()) for _ in range(6)))
+        return peak
+
+    assert asyncio.run(run()) == 2
+
+
+def test_cancel_stops_only_the_owners_tasks() -> None:
+    async def run() -> None:
+        tasks = TaskCoordinator(log)
+        a, b = object(), object()
+        slow_a = tasks.spawn(a, asyncio.sleep(10), limited=False)
+        slow_b = tasks.spawn(b, asyncio.sleep(10), limited=False)
+        await asyncio.sleep(0)
+        await tasks.cancel(a)
+        assert slow_a.cancelled()
+        assert not slow_b.done()
+        assert tasks.running == 1
+        await tasks.stop()
+        assert slow_b.cancelled()
+        assert tasks.running == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_limited_tasks_close_their_coroutine() -> None:
+    async def run() -> list:
+        tasks = TaskCoordinator(log, max_tasks=1)
+        owner = object()
+        coros = [asyncio.sleep(10) for _ in range(2)]
+        for coro in coros:
+            tasks.spawn(owner, coro)
+        await asyncio.sleep(0)
+        # This one is cancelled before it gets to run at all
+        coros.append(asyncio.sleep(10))
+        tasks.spawn(owner, coros[-1])
+        await tasks.cancel(owner)
+        return coros
+
+    coros = asyncio.run(run())
+    assert all(coro.cr_frame is None for coro in coros)
+
+
+def test_work_started_from_limited_task_doesnt_need_another_slot() -> None:
+    async def run() -> list[int]:
+        tasks = TaskCoordinator(log, max_tasks=2)
+        owners = [object() for _ in range(2)]
+
+        async def child() -> int:
+            await asyncio.sleep(0.01)
+            return 1
+
+        async def parent(owner: object) -> int:
+            return await tasks.run(owner, "reload", child)
+
+        return await asyncio.wait_for(
+            asyncio.gather(*(tasks.spawn(owner, parent(owner)) for owner in owners)), 1)
+
+    assert asyncio.run(run()) == [1, 1]
+
+
+def test_released_slot_lets_other_work_run() -> None:
+    async def run() -> list[str]:
+        tasks = TaskCoordinator(log, max_tasks=1)
+        order = []
+        budget = asyncio.Event()
+
+        async def waiting() -> None:
+            async with tasks.released():
+                await budget.wait()
+            order.append("waiting")
+
+        async def ready() -> None:
+            order.append("ready")
+            budget.set()
+
+        first = tasks.spawn(object(), waiting())
+        await asyncio.sleep(0)
+        await asyncio.wait_for(asyncio.gather(first, tasks.spawn(object(), ready())), 1)
+        # The slot was taken back after waiting
+        assert tasks.slots._value == 1
+        return order
+
+    assert asyncio.run(run()) == ["ready", "waiting"]
+
+
+def test_cancelled_while_retaking_slot_doesnt_release_twice() -> None:
+    async def run() -> int:
+        tasks = TaskCoordinator(log, max_tasks=1)
+        owner = object()
+        event = asyncio.Event()
+
+        async def waiting() -> None:
+            async with tasks.released():
+                await event.wait()
+
+        waiter = tasks.spawn(owner, waiting())
+        await asyncio.sleep(0)
+        blocker = tasks.spawn(object(), asyncio.sleep(10))
+        await asyncio.sleep(0)
+        event.set()
+        await asyncio.sleep(0)
+        # The waiter is now waiting to get its slot back
+        await tasks.cancel(owner)
+        assert waiter.cancelled()
+        blocker.cancel()
+        await asyncio.gather(blocker, return_exceptions=True)
+        return tasks.slots._value
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+
+import pytest
+
+from disruptor.imaging import image_size
+from disruptor.metrics import Metrics
+from disruptor.workers import LoopLagMonitor, WorkerPool
+
+
+def _blocking(duration: float) -> str:
+    time.sleep(duration)
+    return threading.current_thread().name
+
+
+def test_runs_outside_the_event_loop() -> None:
+    async def run() -> tuple[str, int]:
+        pool = WorkerPool(Metrics(), max_workers=2)
+        try:
+            # The loop keeps running while workers block
+            ticks = 0
+
+            async def tick() -> None:
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.create_task(tick())
+            name = await pool.run(_blocking, 0.1)
+            ticker.cancel()
+            return name, ticks
+        finally:
+            pool.shutdown()
+
+    name, ticks = asyncio.run(run())
+    assert name.startswith("disruptor-worker")
+    assert ticks >= 5
+
+
+def test_bounds_running_and_queued_work() -> None:
+    async def run() -> int:
+        pool = WorkerPool(Metrics(), max_workers=1, queue_size=1)
+        peak = 0
+
+        async def submit() -> None:
+            nonlocal peak
+            task = pool.run(_blocking, 0.02)
+            await asyncio.sleep(0)
+            peak = max(peak, pool.pending)
+            await task
+
+        try:
+            await asyncio.gather(*(submit() for _ in range(5)))
+        finally:
+            pool.shutdown()
+        return peak
+
+    assert asyncio.run(run()) == 2
+
+
+def test_records_task_latency() -> None:
+    metrics = Metrics()
+
+    async def run() -> None:
+        pool = WorkerPool(metrics)
+        try:
+            with pytest.raises(ValueError):
+                await pool.run(int, "not a number")
+        finally:
+            pool.shutdown()
+
+    asyncio.run(run())
+    assert 'disruptor_worker_task_seconds_count{function="int"} 1' in metrics.render()
+
+
+def test_process_pool_runs_module_level_functions() -> None:
+    pytest.importorskip("PIL")
+    from io import BytesIO
+
+    from PIL import Image
+
+    out = BytesIO()
+    Image.new("RGB", (30, 20)).save(out, "PNG")
+
+    async def run() -> tuple[int, int]:
+        pool = WorkerPool(Metrics(), kind="process", max_workers=1)
+        try:
+            return await pool.run(image_size, out.getvalue())
+        finally:
+            pool.shutdown()
+
+    assert asyncio.run(run()) == (30, 20)
+
+
+def test_unknown_pool_type() -> None:
+    with pytest.raises(ValueError):
+        WorkerPool(Metrics(), kind="fiber")
+
+
+def test_lag_monitor_reports_blocked_loop(caplog: pytest.LogCaptureFixture) -> None:
+    metrics = Metrics()
+    log = logging.getLogger("test.loop")
+
+    async def run() -> None:
+        monitor = LoopLagMonitor(metrics, log, interval=0.01)
+        monitor.start()
+        await asyncio.sleep(0.02)
+        time.sleep(1.1)
+        await asyncio.sleep(0.02)
+        monitor.stop()
+
+    with caplog.at_level(logging.WARNING, logger=log.name):
+        asyncio.run(run())
+    assert any("Event loop was blocked" in record.getMessage() for record in caplog.records)
+    assert metrics.loop_lag.sums[()] >= 1